@@ -6,70 +6,74 @@ of the selected motor for use with this design.
 """
 
 import numpy as np
-from matplotlib import pyplot as plt
-from daqhats import mcc118, hats
-from daqhats_utils import select_hat_device, chan_list_to_mask
-import swptools as swp
-import json
+from daqbackend import open_polarimeter, READ_ALL_AVAILABLE
+from swpjitter import JitterAnalyzer
+import swpsettings
 import os.path
 import time
 
-# SET NUMBER OF SAMPLES HERE -> Dictated by Delay in seconds
-delay = 1000
-Rotation_Period = np.array([])
-dthdt = np.array([])
-Timeout = delay + 5
+# SET DURATION OF THE RUN HERE [s]. Stop early with Ctrl+C; the statistics so far are kept.
+duration = 1000
+# Statistics are written here every checkpoint_interval seconds while the run goes on.
+checkpoint_file = 'data/jitter_checkpoint.json'
+checkpoint_interval = 60
+poll_interval = 0.1
+# Polarimeter whose motor is analyzed, by name from the 'polarimeters' list of daqsettings.json (None: the first one).
+polarimeter_name = None
 
 # Initialize daq settings
-daq_settings_file = 'settings/daqsettings.json'
-
-if not os.path.isfile(daq_settings_file):
-    print(f'Error: simulation file {daq_settings_file} not found.')
-    print('Run \'gen_default_json.py\' to generate default file first.')
-    exit()
-else:
-    with open(daq_settings_file, 'r') as f:
-        daq_params = json.load(f)
-        samples_per_channel = daq_params['samples_per_channel']
-        scan_rate = daq_params['scan_rate']
-        channels = daq_params['channels']
-
-        channel_mask = chan_list_to_mask(channels)
-        num_channels = len(channels)
-        address = select_hat_device(hats.HatIDs.MCC_118)
-        hat = mcc118(address)
-        options = hats.OptionFlags.CONTINUOUS
-
-sample_period = 1/scan_rate
+daq_params = swpsettings.load_or_exit('daq')
+samples_per_channel = daq_params['samples_per_channel']
+scan_rate = daq_params['scan_rate']
+channels = daq_params['channels']
 
-# Read for as long as the timeout settings indicate. Isolate for period of each chunk.
-hat.a_in_scan_start(channel_mask, samples_per_channel, scan_rate, options)
-time.sleep(delay)
-read_result = hat.a_in_scan_read(samples_per_channel, Timeout)
+hat, polarimeter = open_polarimeter(daq_params, polarimeter_name)
 
-trigger_data = read_result.data[1::2]
+if not os.path.isdir(os.path.dirname(checkpoint_file)):
+    os.makedirs(os.path.dirname(checkpoint_file))
 
-chunk_border_indices = swp.extract_chunks(trigger_data)
-num_chunks = len(chunk_border_indices)-1
+# Read continuously for the whole run, feeding each block of trigger data to the analyzer as it arrives.
+# Only the running statistics are kept, so memory use does not depend on the duration.
+analyzer = JitterAnalyzer(scan_rate, checkpoint_file=checkpoint_file, checkpoint_interval=checkpoint_interval)
+hat_buffer_size = int(max(samples_per_channel, scan_rate))
+hat.scan_start(hat_buffer_size, scan_rate, continuous=True)
+end_time = time.monotonic() + duration
+try:
+    while time.monotonic() < end_time:
+        read_result = hat.scan_read(READ_ALL_AVAILABLE, 0)
+        analyzer.feed(hat.channel_data(read_result.data, polarimeter.trigger))
+        if read_result.hardware_overrun or read_result.buffer_overrun:
+            print(f'Warning: DAQ overrun, restarting scan ({analyzer.discontinuities + 1} so far).')
+            # Data read before the overrun is kept, but no period or Allan average spans the gap. The scan is cleaned
+            # up before restarting, as in StreamReader.
+            analyzer.discontinuity()
+            hat.scan_stop()
+            hat.scan_cleanup()
+            hat.scan_start(hat_buffer_size, scan_rate, continuous=True)
+        time.sleep(poll_interval)
+except KeyboardInterrupt:
+    print('Run interrupted.')
+finally:
+    hat.scan_stop()
+    hat.scan_cleanup()
+    analyzer.checkpoint()
 
-hat.a_in_scan_stop()
-hat.a_in_scan_cleanup()
+periods = analyzer.periods
+print(f"The Rotation Period is {np.around(periods.mean,5)} +/- {np.around(periods.std()/np.sqrt(max(periods.count,1)),5)} with a standard deviation of {np.around(periods.std(),5)}, a maximium value of {np.around(periods.max,5)} and a minimum value of {np.around(periods.min,5)}.")
+print(analyzer.summary())
+print(f'Statistics saved to {checkpoint_file}')
 
-for k in range(num_chunks):
-    chunk_period = (chunk_border_indices[k+1] - chunk_border_indices[k])*sample_period
-    av_rot_speeds = 1/chunk_period
-    Rotation_Period = np. append(Rotation_Period, chunk_period)
-    if not (k == 0 or k == num_chunks-1):
-        dthdt = np.append(dthdt, (av_rot_speeds[k+1] - av_rot_speeds[k])/sample_period)
-
-mean = np.mean(Rotation_Period)
-std = np.std(Rotation_Period, ddof=1)
-un_mean = std/np.sqrt(Rotation_Period.size)
-maxval = max(Rotation_Period)
-minval = min(Rotation_Period)
-
-print(f"The Rotation Period is {np.around(mean,5)} +/- {np.around(un_mean,5)} with a standard deviation of {np.around(std,5)}, a maximium value of {np.around(maxval,5)} and a minimum value of {np.around(minval,5)}.")
-
-sample_num = np.arange(0, Rotation_Period.size - 1, 1)
-plt.plot(sample_num, Rotation_Period)
-plt.show()
\ No newline at end of file
+# matplotlib is only imported once the run is over.
+from matplotlib import pyplot as plt
+fig, (ax1, ax2) = plt.subplots(1, 2, figsize = [13,4])
+hist = analyzer.histogram
+if hist.edges is not None:
+    ax1.stairs(hist.counts, hist.edges)
+ax1.set_xlabel('Rotation period [s]')
+ax1.grid(True)
+factors, adev = analyzer.allan.deviation()
+ax2.loglog(factors*periods.mean, adev, 'o-')
+ax2.set_xlabel('Averaging time [s]')
+ax2.set_ylabel('Allan deviation of the period [s]')
+ax2.grid(True)
+plt.show()
@@ -0,0 +1,192 @@
+"""
+Parallel batch analysis of recorded raw traces.
+
+Every .swpraw recording (see swprecord.py) is split into shards of at most --shard-seconds of samples and the
+shards are processed by a ProcessPoolExecutor. Each worker replays its sample range through extract_chunks /
+get_stokes_from_chunks and writes the per-rotation records to its own part log in the work directory. The parts
+are then merged into one time-ordered binary Stokes log a block of records at a time, so memory use does not
+depend on the amount of data. A manifest in the work directory lists the completed shards: running the same
+command again after an interruption (or with more recordings added) only processes what is missing.
+
+Usage: python batch_analyze.py data/*.swpraw --output data/week.npy --workers 8
+"""
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+import time
+import numpy as np
+import swplog
+import swprecord
+
+MANIFEST_FILE = 'manifest.json'
+
+
+def plan_shards(paths, shard_seconds):
+    '''Splits every recording into consecutive sample ranges of at most shard_seconds. Returns a list of shard dicts.'''
+    shards = []
+    for path in paths:
+        replay = swprecord.RawReplay(path)
+        shard_samples = max(int(shard_seconds*replay.scan_rate), 1)
+        stat = os.stat(path)
+        for start in range(0, len(replay), shard_samples):
+            shards.append({'path': os.path.abspath(path), 'start': start, 'stop': min(start + shard_samples, len(replay)),
+                           'size': stat.st_size, 'mtime': stat.st_mtime,
+                           'duration': (min(start + shard_samples, len(replay)) - start)/replay.scan_rate})
+    return shards
+
+
+def shard_key(shard):
+    return f"{shard['path']}:{shard['start']}:{shard['stop']}"
+
+
+def part_name(shard):
+    '''Part log file name, unique per recording and sample range.'''
+    digest = hashlib.sha1(shard['path'].encode()).hexdigest()[:12]
+    return f"{os.path.splitext(os.path.basename(shard['path']))[0]}_{digest}_{shard['start']}.npy"
+
+
+def analyze_shard(shard, part_path, settings):
+    '''Worker: replays one shard and writes its per-rotation records to part_path. Returns (records, seconds).
+
+    The part is written under a temporary name and renamed when complete, so an interrupted shard never looks done.
+    '''
+    t0 = time.perf_counter()
+    replay = swprecord.RawReplay(shard['path'])
+    tmp_path = part_path + '.tmp'
+    if os.path.isfile(tmp_path):
+        os.remove(tmp_path)
+
+    with swplog.StokesLogger(tmp_path) as logger:
+        for timestamps, S_chunks in swprecord.replay_stokes(replay, settings['wp_phi'], settings['trigger_phase'],
+                                                            settings['bg_level'], settings['window'],
+                                                            shard['start'], shard['stop'], settings['subsample']):
+            logger.log_many(swprecord.stokes_records(timestamps, S_chunks, swplog.RECORD_DTYPE))
+    num_records = logger.count
+
+    os.replace(tmp_path, part_path)
+    return num_records, time.perf_counter() - t0
+
+
+def load_manifest(work_dir, settings):
+    '''Returns the completed shards recorded in the work directory, or none if they used other settings.'''
+    path = os.path.join(work_dir, MANIFEST_FILE)
+    if not os.path.isfile(path):
+        return {}
+    with open(path, 'r') as f:
+        manifest = json.load(f)
+    if manifest.get('settings') != settings:
+        print('Calibration or window settings changed since the last run, reprocessing everything.')
+        return {}
+    return manifest['shards']
+
+
+def save_manifest(work_dir, settings, completed):
+    path = os.path.join(work_dir, MANIFEST_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'settings': settings, 'shards': completed}, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def is_complete(shard, entry, work_dir):
+    '''True if the manifest entry matches the recording as it is now and its part log exists.'''
+    return (entry is not None and entry['size'] == shard['size'] and entry['mtime'] == shard['mtime']
+            and os.path.isfile(os.path.join(work_dir, entry['part'])))
+
+
+def merge_parts(part_paths, output, block_records = 100000):
+    '''Merges time-ordered part logs into one time-ordered binary Stokes log.
+
+    Every part contributes its next block of records; everything up to the earliest last timestamp among those
+    blocks is final, so it is sorted and written and the rest stays for the next round. At most about
+    block_records records are held in memory whatever the number and size of the parts. Returns the record count.
+    '''
+    logs = [log for log in (swplog.read_log(path) for path in part_paths) if len(log)]
+    positions = [0]*len(logs)
+    per_part = max(block_records//max(len(logs), 1), 1024)
+
+    if os.path.isfile(output):
+        os.remove(output)
+    with swplog.StokesLogger(output) as out:
+        while True:
+            active = [k for k in range(len(logs)) if positions[k] < len(logs[k])]
+            if not active:
+                break
+            blocks = {k: logs[k][positions[k]:positions[k] + per_part] for k in active}
+            # Parts with more records after this block bound what can be written this round.
+            limits = [blocks[k]['timestamp'][-1] for k in active if positions[k] + per_part < len(logs[k])]
+            cutoff = min(limits) if limits else np.inf
+
+            taken = []
+            for k in active:
+                count = np.searchsorted(blocks[k]['timestamp'], cutoff, side='right')
+                taken.append(blocks[k][:count])
+                positions[k] += count
+            merged = np.concatenate(taken)
+            out.log_many(merged[np.argsort(merged['timestamp'], kind='stable')])
+    return out.count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reprocess raw recordings in parallel into one time-ordered Stokes log.')
+    parser.add_argument('recordings', nargs='+', help='.swpraw files')
+    parser.add_argument('--output', required=True, help='merged binary Stokes log (.npy)')
+    parser.add_argument('--work-dir', default=None, help='part logs and manifest (default: <output>.parts)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='worker processes (default: all cores)')
+    parser.add_argument('--shard-seconds', type=float, default=600, help='longest stretch of a recording per task [s]')
+    parser.add_argument('--window', type=int, default=100000, help='samples per processing window')
+    parser.add_argument('--wp-phi', type=float, default=None, help='waveplate retardance (default: recorded)')
+    parser.add_argument('--trigger-phase', type=float, default=None, help='trigger phase (default: recorded)')
+    parser.add_argument('--bg-level', type=float, default=None, help='background level (default: recorded)')
+    parser.add_argument('--integer-edges', action='store_true', help='use integer trigger edges (default: recorded edge mode)')
+    parser.add_argument('--clean', action='store_true', help='delete the work directory after a successful merge')
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or args.output + '.parts'
+    os.makedirs(work_dir, exist_ok=True)
+    settings = {'wp_phi': args.wp_phi, 'trigger_phase': args.trigger_phase, 'bg_level': args.bg_level, 'window': args.window,
+                'subsample': False if args.integer_edges else None}
+
+    shards = plan_shards(args.recordings, args.shard_seconds)
+    manifest = load_manifest(work_dir, settings)
+    completed = {shard_key(s): manifest[shard_key(s)] for s in shards if is_complete(s, manifest.get(shard_key(s)), work_dir)}
+    pending = [s for s in shards if shard_key(s) not in completed]
+    total_duration = sum(s['duration'] for s in pending)
+    print(f'{len(shards)} shards in {len(args.recordings)} recordings, {len(completed)} already done, '
+          f'{len(pending)} to process ({round(total_duration/3600,2)} h of data) on {args.workers} workers')
+
+    t_start = time.perf_counter()
+    done_duration = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(analyze_shard, s, os.path.join(work_dir, part_name(s)), settings): s for s in pending}
+        try:
+            for n, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                shard = futures[future]
+                num_records, seconds = future.result()
+                completed[shard_key(shard)] = {'part': part_name(shard), 'records': num_records,
+                                               'size': shard['size'], 'mtime': shard['mtime']}
+                save_manifest(work_dir, settings, completed)
+
+                done_duration += shard['duration']
+                elapsed = time.perf_counter() - t_start
+                eta = elapsed*(total_duration - done_duration)/done_duration if done_duration > 0 else 0
+                print(f"[{n}/{len(pending)}] {os.path.basename(shard['path'])} samples {shard['start']}-{shard['stop']}: "
+                      f"{num_records} rotations in {round(seconds,1)} s | {round(done_duration/elapsed,1)}x real time, "
+                      f"ETA {round(eta)} s", flush=True)
+        except KeyboardInterrupt:
+            print('Interrupted, completed shards are kept. Run the same command again to resume.')
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise SystemExit(1)
+
+    # Parts in planning order, i.e. in order of recording and sample range.
+    parts = [os.path.join(work_dir, completed[shard_key(s)]['part']) for s in shards]
+    t0 = time.perf_counter()
+    num_records = merge_parts(parts, args.output)
+    print(f'Merged {num_records} records from {len(parts)} parts into {args.output} in {round(time.perf_counter()-t0,1)} s')
+
+    if args.clean:
+        for path in parts:
+            os.remove(path)
+        os.remove(os.path.join(work_dir, MANIFEST_FILE))
+        os.rmdir(work_dir)
@@ -0,0 +1,201 @@
+"""
+Benchmarks for the swptools hot paths and a complete polvis frame.
+
+Simulated traces are generated for every combination of samples_per_channel, scan_rate, rotation speed and
+noise level. Each stage is timed on them (median and 95th percentile latency), frames/sec is derived for the
+complete frame (chunk extraction, Stokes solve, warnings and polarization ellipse, as in polvis.process_frame
+and render_frame) and peak memory of one frame is measured with tracemalloc. Results are saved as JSON so runs
+on different commits can be compared.
+
+Usage:
+    python benchmark.py --output bench.json
+    python benchmark.py --samples 1000 20000 --scan-rates 20000 --compare bench.json
+"""
+import argparse
+import itertools
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+import numpy as np
+import swptools as swp
+import swpsettings
+from daqbackend import motor_model_from_settings
+
+WP_PHI = 1.982
+TRIGGER_PHASE = 0.404
+SIM_S = 3*np.array([1, 0.3, 0.4, 0.5])
+
+
+def time_call(fn, repeat):
+    '''Returns the wall-clock time of each of repeat calls of fn [s] (after one warm-up call).'''
+    fn()
+    times = np.zeros(repeat)
+    for k in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times[k] = time.perf_counter() - t0
+    return times
+
+
+def peak_memory(fn):
+    '''Returns the peak memory allocated by python/numpy during one call of fn [bytes].'''
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def simulate_frame(num_samples, scan_rate, rpm, noise, simpams = None):
+    '''Returns simulated (input_data, trigger_data) for one block.
+
+    With simpams (simsettings.json contents), the motor drift/jitter, trigger glitches and clipping set there are
+    simulated too.
+    '''
+    w = 2*np.pi*rpm/60
+    t = np.arange(num_samples)/scan_rate
+    rng = np.random.default_rng(0)
+    if simpams is None:
+        input_data = swp.simulate_polarization_data(SIM_S, w, t, 1, noise, 1000*20/(2**12), 0.003, WP_PHI, TRIGGER_PHASE, rng=rng)
+        trigger_data = 5*(np.mod(w*t, 2*np.pi) < np.pi/12)
+    else:
+        theta, trigger_data = motor_model_from_settings(simpams, w, rng=rng).simulate(t)
+        clip_V = simpams.get('sim_clip_V', 10)
+        input_data = swp.simulate_polarization_data(SIM_S, 1, theta, 1, noise, 1000*20/(2**12), 0.003, WP_PHI, TRIGGER_PHASE,
+                                                    rng=rng, clip_V=clip_V)
+        trigger_data = np.clip(trigger_data, -clip_V, clip_V) if clip_V > 0 else trigger_data
+    return input_data, trigger_data
+
+
+def full_frame(input_data, trigger_data, engine = 'chunked', subsample = True):
+    '''Everything polvis does per frame apart from acquisition and matplotlib drawing.'''
+    borders = swp.extract_chunks(trigger_data, subsample=subsample)
+    num_chunks = len(borders) - 1
+    Nroll = np.mean(np.diff(borders)) if num_chunks > 0 else 0
+    S = swp.get_frame_stokes(input_data, borders, WP_PHI, TRIGGER_PHASE, engine=engine, verbose=False)
+    S = S/S[0]
+    DOP = np.sqrt(S[1]**2 + S[2]**2 + S[3]**2)
+    warnings = (Nroll < (60 if subsample else 180), DOP - 1 > .03, np.mean(input_data) < 0.08, num_chunks < 3)
+    x, y = swp.get_polarization_ellipse(S, verbose=False)
+    return S, DOP, warnings, x, y
+
+
+def bench_case(num_samples, scan_rate, rpm, noise, repeat, simpams = None):
+    '''Times every stage for one parameter combination. Returns a dict of results.'''
+    w = 2*np.pi*rpm/60
+    t = np.arange(num_samples)/scan_rate
+    input_data, trigger_data = simulate_frame(num_samples, scan_rate, rpm, noise, simpams)
+    borders = swp.extract_chunks(trigger_data)
+    fractional_borders = swp.extract_chunks(trigger_data, subsample=True)
+    S = swp.get_frame_stokes(input_data, borders, WP_PHI, TRIGGER_PHASE, verbose=False)
+
+    rolling = swp.RollingStokes(WP_PHI, TRIGGER_PHASE)
+    simulator = swp.FrameSimulator(w, t, 1, noise, 0, 0.003, WP_PHI, TRIGGER_PHASE, seed=0)
+    frame_S = np.tile(SIM_S, (64, 1))
+
+    # The per-chunk loop get_stokes_from_chunks replaced, including the frame average it also returns.
+    def per_chunk():
+        S = [swp.get_stokes_from_chunk(input_data[borders[k]:borders[k+1]], WP_PHI, TRIGGER_PHASE, verbose=False)
+             for k in range(len(borders)-1)]
+        return np.mean(S, axis=0)
+
+    stages = {
+        'simulate_polarization_data': lambda: swp.simulate_polarization_data(SIM_S, w, t, 1, noise, 0, 0.003, WP_PHI, TRIGGER_PHASE),
+        'FrameSimulator.frames (64 frames)': lambda: simulator.frames(frame_S),
+        'extract_chunks': lambda: swp.extract_chunks(trigger_data),
+        'extract_chunks (subsample)': lambda: swp.extract_chunks(trigger_data, subsample=True),
+        'get_stokes_from_chunk (all chunks)': per_chunk,
+        'get_stokes_from_chunks': lambda: swp.get_stokes_from_chunks(input_data, borders, WP_PHI, TRIGGER_PHASE, verbose=False),
+        'get_stokes_from_chunks (subsample)': lambda: swp.get_stokes_from_chunks(input_data, fractional_borders, WP_PHI, TRIGGER_PHASE, verbose=False),
+        'RollingStokes.feed': lambda: rolling.feed(input_data, fractional_borders, scan_rate),
+        'get_stokes_lockin': lambda: swp.get_stokes_lockin(input_data, borders, WP_PHI, TRIGGER_PHASE, verbose=False),
+        'get_polarization_ellipse': lambda: swp.get_polarization_ellipse(S, verbose=False),
+        'frame': lambda: full_frame(input_data, trigger_data),
+        'frame (lockin)': lambda: full_frame(input_data, trigger_data, engine='lockin'),
+    }
+
+    results = {}
+    for name, fn in stages.items():
+        times = time_call(fn, repeat)
+        results[name] = {'median_ms': 1e3*float(np.median(times)), 'p95_ms': 1e3*float(np.percentile(times, 95))}
+
+    # Accuracy: largest deviation of the normalized Stokes vector from the simulated one, per engine.
+    errors = {engine: float(np.max(np.abs(full_frame(input_data, trigger_data, engine)[0] - SIM_S/SIM_S[0])))
+              for engine in ('chunked', 'lockin')}
+    errors['chunked (integer edges)'] = float(np.max(np.abs(full_frame(input_data, trigger_data, subsample=False)[0] - SIM_S/SIM_S[0])))
+
+    frame_ms = results['frame']['median_ms']
+    return {'samples_per_channel': num_samples, 'scan_rate': scan_rate, 'rpm': rpm, 'noise': noise,
+            'num_chunks': len(borders) - 1, 'stages': results, 'stokes_error': errors,
+            'frames_per_s': 1e3/frame_ms if frame_ms > 0 else float('inf'),
+            'realtime_factor': (num_samples/scan_rate)/(frame_ms/1e3) if frame_ms > 0 else float('inf'),
+            'peak_memory_kb': peak_memory(lambda: full_frame(input_data, trigger_data))/1024}
+
+
+def case_key(case):
+    return f"{case['samples_per_channel']}@{case['scan_rate']}Hz/{case['rpm']}rpm/ns{case['noise']}"
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_case(case):
+    print(f"{case_key(case)}: {case['num_chunks']} chunks, {round(case['frames_per_s'],1)} frames/s "
+          f"({round(case['realtime_factor'],1)}x real time), peak {round(case['peak_memory_kb'])} kB, "
+          f"max Stokes error {', '.join(f'{engine} {err:.4f}' for engine, err in case['stokes_error'].items())}")
+    for name, res in case['stages'].items():
+        print(f"    {name:<36} {res['median_ms']:9.3f} ms  (p95 {res['p95_ms']:.3f} ms)")
+
+
+def compare(results, baseline):
+    '''Prints the median latency ratio (new/old) of every stage present in both result sets.'''
+    old_cases = {case_key(case): case for case in baseline['cases']}
+    print(f"\nComparison against {baseline.get('commit')} (ratio new/old, < 1 is faster):")
+    for case in results['cases']:
+        old = old_cases.get(case_key(case))
+        if old is None:
+            continue
+        print(f'  {case_key(case)}')
+        for name, res in case['stages'].items():
+            if name in old['stages'] and old['stages'][name]['median_ms'] > 0:
+                print(f"    {name:<36} {res['median_ms']/old['stages'][name]['median_ms']:6.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the swptools hot paths and a full polvis frame.')
+    parser.add_argument('--samples', type=int, nargs='+', default=[1000, 5000, 20000], help='samples_per_channel values')
+    parser.add_argument('--scan-rates', type=int, nargs='+', default=[20000, 100000], help='scan_rate values [Hz]')
+    parser.add_argument('--rpm', type=float, nargs='+', default=[4500, 5100, 6000], help='waveplate speeds [RPM]')
+    parser.add_argument('--noise', type=float, nargs='+', default=[0, 0.03], help='noise levels [V]')
+    parser.add_argument('--repeat', type=int, default=20, help='timed calls per stage')
+    parser.add_argument('--output', default=None, help='write results as JSON')
+    parser.add_argument('--compare', default=None, help='JSON results of an earlier run to compare against')
+    parser.add_argument('--sim-settings', default=None,
+                        help='simsettings.json whose motor drift/jitter, trigger glitch and clipping entries are simulated')
+    args = parser.parse_args()
+
+    simpams = None
+    if args.sim_settings:
+        simpams = swpsettings.load('sim', args.sim_settings)
+
+    results = {'commit': git_commit(), 'timestamp': time.time(), 'python': platform.python_version(),
+               'numpy': np.__version__, 'machine': platform.machine(), 'sim_settings': simpams, 'cases': []}
+    for num_samples, scan_rate, rpm, noise in itertools.product(args.samples, args.scan_rates, args.rpm, args.noise):
+        case = bench_case(num_samples, scan_rate, rpm, noise, args.repeat, simpams)
+        results['cases'].append(case)
+        print_case(case)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+        print(f'Results written to {args.output}')
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare(results, json.load(f))
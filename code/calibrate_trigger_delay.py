@@ -4,37 +4,26 @@
 
 # Import vital packages/tools.
 import numpy as np
-from matplotlib import pyplot as plt
-from daqhats import mcc118, OptionFlags, HatIDs, HatError
-from daqhats_utils import select_hat_device, chan_list_to_mask
+from daqbackend import open_polarimeter
 import swptools as swp
-import json
-import os.path
-
-# Store locations of generated simulation parameters, daq settings and spinning waveplate settings (json files).
-daq_settings_file = 'settings/daqsettings.json'
-swp_settings_file = 'settings/swpsettings.json'
-sim_settings_file = 'settings/sim_settings_file.json'
-
-# Print error if the Data Acquisition System (DAQ) settings path is not an existing regular file.
-# File must be in location specified. Suggests generation of a default json file
-if not os.path.isfile(daq_settings_file):
-    print(f'Error: simulation file {sim_settings_file} not found.')
-    print('Run \'gen_default_json.py\' to generate default file first.')
-    exit()
-else:
-    with open(daq_settings_file,'r') as f:
-        daq_params = json.load(f)
-        samples_per_channel = daq_params['samples_per_channel']
-        scan_rate = daq_params['scan_rate']
-        channels = daq_params['channels']
-        timeout = daq_params['timeout']
+import swpsettings
+import time
+
+# Polarimeter to calibrate, by name from the 'polarimeters' list of daqsettings.json (None: the first one).
+polarimeter_name = None
+# Trigger edge mode (see swptools.subsample_edges): the phase found only holds for the mode it was measured with, so
+# the mode is saved with it and used by polvis.
+subsample_triggers = swp.SUBSAMPLE_EDGES
 
-        channel_mask = chan_list_to_mask(channels)
-        num_channels = len(channels)
-        address = select_hat_device(HatIDs.MCC_118)
-        hat = mcc118(address)
-        options = OptionFlags.CONTINUOUS
+# Print error if the Data Acquisition System (DAQ) settings file (see swpsettings.py) is missing or invalid.
+# Suggests generation of a default json file.
+daq_params = swpsettings.load_or_exit('daq')
+samples_per_channel = daq_params['samples_per_channel']
+scan_rate = daq_params['scan_rate']
+channels = daq_params['channels']
+timeout = daq_params['timeout']
+
+hat, polarimeter = open_polarimeter(daq_params, polarimeter_name)
 
 
 num_samples = samples_per_channel
@@ -43,74 +32,43 @@ total_time = period*num_samples
 t = np.linspace(0, total_time-period, num_samples)
 
 # Set the number of traces to average.
-# Preset: 9, to have a round RMSE.
-num_traces = 9
-phase_zeros = np.zeros(num_traces)
-
+num_traces = 100
+traces = []
 for trace in range(num_traces):
-    hat.a_in_scan_start(channel_mask, samples_per_channel, scan_rate, options)
-    read_result = hat.a_in_scan_read(samples_per_channel, timeout)
-
-    input_data = read_result.data[::2]
-    trigger_data = read_result.data[1::2]  
-
-    chunk_border_indecies = swp.extract_triggers(trigger_data)
-    num_chunks = len(chunk_border_indecies)-1
-
-    hat.a_in_scan_stop()
-    hat.a_in_scan_cleanup()
-
-    # Calculating 1000 cos(2wt) terms per trace
-    calculated_terms = np.array([]) 
-    phases = np.linspace(0, 2*np.pi, 1000)
-    
-    for phs in phases:
-        n0 = 0
-        for k in range(num_chunks):
-            chunk = input_data[chunk_border_indecies[k]:chunk_border_indecies[k+1]]
-            wt = np.linspace(0, 2*np.pi, len(chunk))
-            n0 += np.trapz(chunk*np.cos(2*(wt-phs)), wt)
-        # Dividing by num_chunks for scaling in later plot
-        calculated_terms = np.append(calculated_terms, n0/num_chunks) 
-
-    '''
-    Could use a cleaner implementation using something like
-    zero_crossings = np.where(np.diff(np.sign(calculated_terms)))[0]
-    however this doesnt account for exact zeros being present in the array and
-    will miscount them. 
-    Could noise variation in input_data cause multiple close zero crossings to 
-    be read?
-    '''
-    
-    # Finding where cos(2wt) crosses zero
-    zero_crossings = np.array([])
-    for k in range(len(calculated_terms)-2):
-        if (calculated_terms[k] <= 0 and calculated_terms[k+1] > 0) or (calculated_terms[k] >= 0 and calculated_terms[k+1] < 0):
-            zero_crossings = np.append(k, zero_crossings)
-
-    zero_crossings = zero_crossings.astype(int)
-    print((phases[zero_crossings]))
-
-    phase_zeros[trace] = min(phases[zero_crossings])
+    read_result = hat.acquire(samples_per_channel, scan_rate, timeout)
 
+    input_data = hat.channel_data(read_result.data, polarimeter.photodiode)
+    trigger_data = hat.channel_data(read_result.data, polarimeter.trigger)
+    traces.append((input_data, trigger_data))
 
+# Zero crossing of the cos(2wt) term, solved in closed form per trace.
+t0 = time.perf_counter()
+phase_zeros_mean, phase_zeros_standard_error, phase_zeros = swp.calibrate_trigger_phase(traces, subsample=subsample_triggers)
+print(f'Calibrated {len(phase_zeros)} traces in {round(1e3*(time.perf_counter()-t0),1)} ms')
 print(phase_zeros)
-phase_zeros_mean = np.mean(phase_zeros)
-phase_zeros_standard_deviation = np.sqrt(np.var(phase_zeros))
-phase_zeros_standard_error = phase_zeros_standard_deviation/np.sqrt(num_traces)
+
+if len(phase_zeros) == 0:
+    print('Error: no complete rotations found in the trigger data.')
+    exit()
+
+# cos(2wt) term of the last trace against phase, averaged per chunk for scaling in the plot.
+chunk_border_indecies = swp.extract_chunks(trigger_data, subsample=subsample_triggers)
+coeffs = swp.chunk_coefficients(input_data, chunk_border_indecies, 0)
+phases = np.linspace(0, 2*np.pi, 1000)
+calculated_terms = np.mean(coeffs[:,1])*np.cos(2*phases) + np.mean(coeffs[:,2])*np.sin(2*phases)
 
 # Updating waveplate offset.
 print('Zero crossing:' + str(round(phase_zeros_mean,3)) + '+/-' +str(round(phase_zeros_standard_error,3)))
-print('Updating settings file ' + swp_settings_file)
+print('Updating settings file ' + polarimeter.swp_settings)
 
-with open('settings/swpsettings.json','r') as f:
-    swp_params = json.load(f)
-    print(f'Waveplate offset changed from '+str(round(swp_params['trigger_phase'],3)) + ' to ' + str(round(phase_zeros_mean,3)))
-    swp_params['trigger_phase'] = phase_zeros_mean
-
-with open('settings/swpsettings.json','w') as f:
-    json.dump(swp_params, f)
+swp_params = swpsettings.load_or_exit('swp', polarimeter.swp_settings)
+print(f'Waveplate offset changed from '+str(round(swp_params['trigger_phase'],3)) + ' to ' + str(round(phase_zeros_mean,3)))
+swp_params['trigger_phase'] = float(phase_zeros_mean)
+swp_params['subsample_edges'] = bool(subsample_triggers)
+swpsettings.save('swp', swp_params, polarimeter.swp_settings)
 
+# matplotlib is only needed for the final plot, so it is not imported before the acquisition.
+from matplotlib import pyplot as plt
 fig, (ax1,ax2) = plt.subplots(1, 2, figsize = [13,4])
 
 ax1.plot(phases, calculated_terms)
@@ -0,0 +1,323 @@
+"""
+Pluggable DAQ backends.
+
+All acquisition goes through the small DAQBackend interface (scan start/read/stop/cleanup on a fixed set of
+channels), so polvis and the calibration scripts run unchanged on an MCC118 or on the deterministic software
+stand-in built on swptools.simulate_polarization_data. The backend is chosen with the 'backend' key of
+daqsettings.json ('mcc118', the default, or 'sim'). Several polarimeters (photodiode/trigger channel pairs on
+one or more hats, each with its own calibration) can be listed there too, see polarimeters_from_settings.
+"""
+import time
+from collections import namedtuple
+import numpy as np
+import swptools as swp
+import swpsettings
+
+# One photodiode/trigger channel pair on the hat at address (None: the only hat, or ask), calibrated by the
+# swpsettings file swp_settings.
+Polarimeter = namedtuple('Polarimeter', ['name', 'address', 'photodiode', 'trigger', 'swp_settings'])
+
+# Same fields as the daqhats scan read result; data is always returned as a numpy array here.
+ScanResult = namedtuple('ScanResult', ['running', 'hardware_overrun', 'buffer_overrun', 'triggered', 'timeout', 'data'])
+
+# samples_per_channel value that reads everything currently buffered.
+READ_ALL_AVAILABLE = -1
+
+# Samples per channel the MCC118 buffers in CONTINUOUS mode when a smaller buffer is requested.
+MIN_CONTINUOUS_BUFFER = 10000
+
+
+def channel_list_to_mask(channels):
+    '''Returns the channel mask for a list of channel numbers (same as daqhats_utils.chan_list_to_mask).'''
+    mask = 0
+    for chan in channels:
+        mask |= 1 << chan
+    return mask
+
+
+class DAQBackend:
+    '''Interface shared by all acquisition backends.
+
+    - channels: scanned channel numbers. Data is interleaved in ascending channel order, one value per channel per sample.
+    '''
+    def __init__(self, channels):
+        self.channels = sorted(channels)
+        self.channel_mask = channel_list_to_mask(self.channels)
+        self.num_channels = len(self.channels)
+
+    def column(self, channel):
+        '''Position of channel in the interleaved scan data.'''
+        return self.channels.index(channel)
+
+    def channel_data(self, data, channel):
+        '''Samples of one channel from interleaved scan data, as a strided view.'''
+        return data[self.column(channel)::self.num_channels]
+
+    def scan_start(self, samples_per_channel, scan_rate, continuous = True):
+        '''Starts a hardware-paced scan. In continuous mode samples_per_channel sets the scan buffer size.'''
+        raise NotImplementedError
+
+    def scan_read(self, samples_per_channel, timeout):
+        '''Reads samples_per_channel samples (READ_ALL_AVAILABLE for all buffered), waiting up to timeout seconds
+        (negative waits indefinitely, 0 returns immediately). Returns a ScanResult.'''
+        raise NotImplementedError
+
+    def scan_stop(self):
+        '''Stops a running scan. Buffered data can still be read.'''
+        raise NotImplementedError
+
+    def scan_cleanup(self):
+        '''Releases the scan buffer.'''
+        raise NotImplementedError
+
+    def acquire(self, samples_per_channel, scan_rate, timeout):
+        '''Acquires one block of samples_per_channel samples: start, read, stop and cleanup. Returns a ScanResult.'''
+        self.scan_start(samples_per_channel, scan_rate)
+        try:
+            return self.scan_read(samples_per_channel, timeout)
+        finally:
+            self.scan_stop()
+            self.scan_cleanup()
+
+
+class MCC118Backend(DAQBackend):
+    '''MCC118 DAQ hat through the daqhats library.
+
+    - address: hat address, or None to select it with daqhats_utils.select_hat_device
+    '''
+    def __init__(self, channels, address = None):
+        super().__init__(channels)
+        from daqhats import mcc118, hats
+        from daqhats_utils import select_hat_device
+
+        self._options = hats.OptionFlags
+        if address is None:
+            address = select_hat_device(hats.HatIDs.MCC_118)
+        self.address = address
+        self.hat = mcc118(address)
+
+    def scan_start(self, samples_per_channel, scan_rate, continuous = True):
+        options = self._options.CONTINUOUS if continuous else self._options.DEFAULT
+        self.hat.a_in_scan_start(self.channel_mask, samples_per_channel, scan_rate, options)
+
+    def scan_read(self, samples_per_channel, timeout):
+        read_result = self.hat.a_in_scan_read(samples_per_channel, timeout)
+        return ScanResult(read_result.running, read_result.hardware_overrun, read_result.buffer_overrun,
+                          read_result.triggered, read_result.timeout, np.asarray(read_result.data, dtype=float))
+
+    def scan_stop(self):
+        self.hat.a_in_scan_stop()
+
+    def scan_cleanup(self):
+        self.hat.a_in_scan_cleanup()
+
+
+class SimulatedBackend(DAQBackend):
+    '''Deterministic software stand-in for the MCC118.
+
+    Each (photodiode, trigger) channel pair gets a photodiode signal from swptools.simulate_polarization_data and
+    a 5 V Hall trigger pulse once per rotation of its own simulated motor; any other channels read 0 V. Motor speed drift and
+    jitter, trigger glitches and clipping at the +/-10 V input range follow the simulation settings
+    (see motor_model_from_settings). Samples become available
+    at scan_rate in wall-clock time like on the hat. In continuous mode, letting more than the buffer size of
+    samples accumulate unread raises buffer_overrun and stops the scan, as the MCC118 does.
+
+    - simpams: simulation settings (simsettings.json contents)
+    - pairs: (photodiode, trigger) channel pairs (default: the first two channels in the order given)
+    - sim_S: simulated Stokes vector (default from simpams, see sim_stokes_from_settings)
+    - rotation_rate: waveplate rotation frequency [Hz]
+    - pacing: when False samples are available immediately, for benchmarking faster than real time
+    - seed: seed for the noise generator, making runs reproducible
+    '''
+    def __init__(self, channels, simpams, sim_S = None, rotation_rate = 5100/60, pacing = True, seed = 0, pairs = None):
+        super().__init__(channels)
+        if self.num_channels < 2:
+            raise ValueError('Simulated backend needs a photodiode and a trigger channel.')
+        self.pairs = [(channels[0], channels[1])] if pairs is None else [tuple(pair) for pair in pairs]
+        if any(chan not in self.channels for pair in self.pairs for chan in pair):
+            raise ValueError(f'Simulated channel pairs {self.pairs} are not all among the scanned channels {self.channels}.')
+        self.simpams = simpams
+        self.sim_S = sim_stokes_from_settings(simpams) if sim_S is None else np.asarray(sim_S, dtype=float)
+        self.w = 2*np.pi*rotation_rate
+        self.pacing = pacing
+        self.seed = seed
+        self._running = False
+        self._scan_rate = None
+
+    def scan_start(self, samples_per_channel, scan_rate, continuous = True):
+        # Like the MCC118, which refuses a new scan until the previous one is cleaned up.
+        if self._scan_rate is not None:
+            raise RuntimeError('A scan is already set up; call scan_stop and scan_cleanup before starting another.')
+        self._scan_rate = scan_rate
+        self._continuous = continuous
+        self._buffer_size = max(samples_per_channel, MIN_CONTINUOUS_BUFFER) if continuous else samples_per_channel
+        self._t0 = time.monotonic()
+        self._num_read = 0
+        self._overrun = False
+        self._stopped_at = 0
+        self._running = True
+        self._rng = np.random.default_rng(self.seed)
+        self._motors = [motor_model_from_settings(self.simpams, self.w, rng=self._rng) for _ in self.pairs]
+
+    def scan_read(self, samples_per_channel, timeout):
+        deadline = None if timeout < 0 else time.monotonic() + timeout
+        while True:
+            available = self._available()
+            if self._overrun or samples_per_channel == READ_ALL_AVAILABLE or available >= samples_per_channel:
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            time.sleep(min(0.001 + (samples_per_channel - available)/self._scan_rate, 0.05))
+
+        timed_out = samples_per_channel != READ_ALL_AVAILABLE and available < samples_per_channel and not self._overrun
+        num = available if samples_per_channel == READ_ALL_AVAILABLE else min(available, samples_per_channel)
+        data = self._generate(self._num_read, num)
+        self._num_read += num
+        return ScanResult(self._running, False, self._overrun, True, timed_out, data)
+
+    def scan_stop(self):
+        # Freeze the number of generated samples so buffered data can still be read after stopping.
+        if self._running:
+            self._stopped_at = self._produced()
+        self._running = False
+
+    def scan_cleanup(self):
+        self._running = False
+        self._scan_rate = None
+
+    def _produced(self):
+        '''Total samples per channel acquired since scan_start.'''
+        if not self._running:
+            return self._stopped_at
+        if self.pacing:
+            produced = int((time.monotonic() - self._t0)*self._scan_rate)
+        else:
+            produced = self._num_read + self._buffer_size
+        if not self._continuous:
+            produced = min(produced, self._buffer_size)
+        return produced
+
+    def _available(self):
+        available = self._produced() - self._num_read
+        if self._continuous and available > self._buffer_size:
+            # Unread data would have been overwritten: the hat stops the scan and reports an overrun.
+            self._overrun = True
+            self._stopped_at = self._num_read + self._buffer_size
+            self._running = False
+            available = self._buffer_size
+        elif not self._continuous and self._num_read + available >= self._buffer_size:
+            self._stopped_at = self._buffer_size
+            self._running = False
+        return available
+
+    def _generate(self, first, num):
+        '''Interleaved samples first..first+num-1 of the current scan.'''
+        t = (first + np.arange(num))/self._scan_rate
+        simpams = self.simpams
+        clip_V = simpams.get('sim_clip_V', 10)
+        data = np.zeros((num, self.num_channels))
+        for (photodiode, trigger_channel), motor in zip(self.pairs, self._motors):
+            theta, trigger = motor.simulate(t)
+            # The motor model gives the rotation angle directly, so it is passed as t with w = 1.
+            data[:, self.column(photodiode)] = swp.simulate_polarization_data(self.sim_S, 1, theta, simpams['sim_siglevel'],
+                                                    simpams['sim_ns_level'], simpams['sim_digitize'], simpams['sim_bg_level'],
+                                                    simpams['sim_wp_phi'], simpams['sim_trigger_phase'], rng=self._rng,
+                                                    clip_V=clip_V)
+            data[:, self.column(trigger_channel)] = np.clip(trigger, -clip_V, clip_V) if clip_V > 0 else trigger
+        return data.ravel()
+
+
+def sim_stokes_from_settings(simpams):
+    '''Returns the simulated Stokes vector selected by sim_poltype and sim_DOP in the simulation settings.'''
+    if simpams['sim_poltype'] == 'right':
+        pol = np.array([0, 0, 1])
+    elif simpams['sim_poltype'] == 'lin':
+        pol = np.array([1, 0, 0])
+    else:
+        pol = np.array([np.sqrt(.3), np.sqrt(.3), np.sqrt(.4)])
+    return 3*np.concatenate([[1], simpams['sim_DOP']*pol])
+
+
+def motor_model_from_settings(simpams, w, seed = None, rng = None):
+    '''Returns the swptools.MotorModel described by the motor and trigger entries of the simulation settings.
+
+    Entries missing from older settings files default to an ideal motor and trigger.
+    '''
+    return swp.MotorModel(w, drift=simpams.get('sim_speed_drift', 0), drift_period=simpams.get('sim_drift_period', 60),
+                          jitter=simpams.get('sim_jitter', 0), trigger_noise=simpams.get('sim_trigger_noise', 0),
+                          bounce=simpams.get('sim_trigger_bounce', 0), missed=simpams.get('sim_missed_triggers', 0),
+                          seed=seed, rng=rng)
+
+
+def open_backend(daqpams, simpams = None, sim_settings_file = None, address = None, pairs = None, **kwargs):
+    '''Opens the backend named by daqpams['backend'] ('mcc118' by default, or 'sim') on daqpams['channels'].
+
+    For the simulated backend the simulation settings are read from sim_settings_file (default
+    settings/simsettings.json, see swpsettings.py) unless simpams is given.
+
+    - address: MCC118 hat address (None: the only hat, or ask). Also seeds the simulated backend, so simulated
+      hats at different addresses produce different noise.
+    - pairs: (photodiode, trigger) channel pairs the simulated backend generates signals on
+    Extra keyword arguments are passed to the backend constructor.
+    '''
+    backend = daqpams.get('backend', 'mcc118')
+    if backend == 'mcc118':
+        return MCC118Backend(daqpams['channels'], address, **kwargs)
+    elif backend == 'sim':
+        if simpams is None:
+            simpams = swpsettings.load('sim', sim_settings_file)
+        kwargs.setdefault('seed', address or 0)
+        return SimulatedBackend(daqpams['channels'], simpams, pairs=pairs, **kwargs)
+    else:
+        raise ValueError(f'Unknown DAQ backend: {backend}')
+
+
+def polarimeters_from_settings(daqpams):
+    '''Returns the Polarimeters measured with the DAQ settings.
+
+    Each entry of the 'polarimeters' list in daqsettings.json gives a name, the hat 'address' (omitted or null for
+    the only hat), the 'photodiode' and 'trigger' channels and the 'swp_settings' file holding its calibration
+    (default settings/swpsettings.json). Without that list, 'channels' is a single [photodiode, trigger] pair.
+    '''
+    entries = daqpams.get('polarimeters') or [{'name': 'polarimeter', 'photodiode': daqpams['channels'][0], 'trigger': daqpams['channels'][1]}]
+    polarimeters = [Polarimeter(entry.get('name', f'polarimeter{k}'), entry.get('address'), entry['photodiode'], entry['trigger'],
+                                entry.get('swp_settings', swpsettings.SETTINGS_FILES['swp']))
+                    for k, entry in enumerate(entries)]
+    if len({p.name for p in polarimeters}) < len(polarimeters):
+        raise ValueError('Polarimeter names in the DAQ settings must be unique.')
+    return polarimeters
+
+
+def select_polarimeter(daqpams, name = None):
+    '''Returns the Polarimeter called name in the DAQ settings, or the first one when name is None.'''
+    polarimeters = polarimeters_from_settings(daqpams)
+    if name is None:
+        return polarimeters[0]
+    for polarimeter in polarimeters:
+        if polarimeter.name == name:
+            return polarimeter
+    raise ValueError(f'No polarimeter called {name} in the DAQ settings ({", ".join(p.name for p in polarimeters)}).')
+
+
+def open_polarimeter(daqpams, name = None, **kwargs):
+    '''Opens the hat of one polarimeter (see select_polarimeter), scanning only its two channels.
+
+    Returns (backend, polarimeter). Pick its samples from a read with backend.channel_data.
+    '''
+    polarimeter = select_polarimeter(daqpams, name)
+    channels = [polarimeter.photodiode, polarimeter.trigger]
+    backend = open_backend(dict(daqpams, channels=channels), address=polarimeter.address, pairs=[channels], **kwargs)
+    return backend, polarimeter
+
+
+def open_backends(daqpams, polarimeters = None, **kwargs):
+    '''Opens every hat used by polarimeters (default: all in the DAQ settings), each scanning all channels of its
+    polarimeters. Returns {address: backend}.
+    '''
+    polarimeters = polarimeters_from_settings(daqpams) if polarimeters is None else polarimeters
+    backends = {}
+    for address in dict.fromkeys(p.address for p in polarimeters):
+        pairs = [(p.photodiode, p.trigger) for p in polarimeters if p.address == address]
+        channels = sorted({chan for pair in pairs for chan in pair})
+        backends[address] = open_backend(dict(daqpams, channels=channels), address=address, pairs=pairs, **kwargs)
+    return backends
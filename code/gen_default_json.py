@@ -11,6 +11,11 @@ if not os.path.isdir('settings'):
 	os.mkdir('./settings')
 
 # ------- Simulation data ----
+# Motor and trigger non-idealities for stress tests (0 = ideal): sim_speed_drift is the amplitude of a slow
+# sinusoidal speed variation (fraction of the speed) with period sim_drift_period [s], sim_jitter the std of the
+# rotation period (fraction), sim_trigger_noise the noise on the Hall signal [V], sim_trigger_bounce and
+# sim_missed_triggers the probabilities per rotation of a double trigger and of a missing one. Signals saturate
+# at +/-sim_clip_V like the MCC118 inputs.
 if os.path.isfile(sim_settings_file):
 	print(f'Found simulation data file: {sim_settings_file}... Skipping')
 else:
@@ -21,7 +26,14 @@ else:
 					'sim_bg_level': 0.003,
 					'sim_wp_phi': 1.982,
 					'sim_trigger_phase': 0.404,
-					'sim_poltype': 'right'
+					'sim_poltype': 'right',
+					'sim_speed_drift': 0,
+					'sim_drift_period': 60,
+					'sim_jitter': 0,
+					'sim_trigger_noise': 0,
+					'sim_trigger_bounce': 0,
+					'sim_missed_triggers': 0,
+					'sim_clip_V': 10
 				}
 	print(f'No simulation file found. Creating file: {sim_settings_file}')
 	with open(sim_settings_file,'w') as f:
@@ -34,6 +46,7 @@ else:
 	swp_dict = {	'trigger_phase': 0.404,
 					'wp_phi': 1.982,
 					'bg_level': 0.003,
+					'subsample_edges': False,
 					'auto_scale_y_trace': False,
 					'log_data_file': '',
 					'protect_overwrite': True
@@ -43,13 +56,17 @@ else:
 		json.dump(swp_dict, f)
 
 # ------- DAQ Settings Data ----
+# 'channels' is the [photodiode, trigger] channel pair of a single polarimeter. To measure several, add a
+# 'polarimeters' list of {"name", "address" (hat), "photodiode", "trigger", "swp_settings" (its calibration file)}
+# entries; see daqbackend.polarimeters_from_settings and swpmulti.py.
 if os.path.isfile(daq_settings_file):
 	print(f'Found DAQ data file: {daq_settings_file}... Skipping')
 else:
 	daq_dict = {	'samples_per_channel': 1000,
 					'scan_rate': 20000,
 					'channels': [0,2],
-                                        'timeout': 5
+                                        'timeout': 5,
+					'backend': 'mcc118'
 				}
 	print(f'No DAQ json file found. Creating file: {daq_settings_file}')
 	with open(daq_settings_file,'w') as f:
@@ -3,159 +3,281 @@
 # # Import vital packages/tools.
 import swptools as swp
 import numpy as np
-from matplotlib import pyplot as plt, animation
-import json
+import argparse
+import sys
 import os.path
-import csv
+import time
 import datetime
+import swplog
+import swprecord
+import swpsettings
+import swpstats
+from swppipeline import Pipeline
 
 # When run_offline = True, simulated polarization data will be used.
 run_offline = True
-# Save data log in file specified within swp_settings_file.
+# Save data log in file specified within settings/swpsettings.json.
 # Select either Poincare sphere (poincare = True) or trace (poincare = False) for display.
 do_save = False
 poincare = True
+# Stokes engine: 'chunked' integrates each complete rotation between triggers, 'lockin' fits the whole
+# block (partial rotations included) onto the 0, 2w and 4w harmonics. See swptools.get_frame_stokes.
+engine = 'chunked'
+# Locate trigger edges to a fraction of a sample and demodulate on the exact angle grid between them (see
+# swptools.subsample_edges). Accuracy then holds down to about 60 points per rotation instead of 180, allowing
+# lower scan rates or faster waveplate rotation. None uses the edge mode the trigger phase was calibrated with
+# (subsample_edges in swpsettings); True or False overrides it, which requires recalibrating with that mode.
+subsample_triggers = None
+# Rolling average across blocks, updated after every rotation (see swptools.RollingStokes): None computes each
+# block on its own, 'sliding' averages the last rolling_window rotations and 'exponential' weights rotations with
+# time constant rolling_time_constant [s]. Uses the chunked coefficients whatever the engine setting. The estimate
+# after every rotation is output (log, headless output and server), timestamped at the trigger edge closing it.
+rolling_average = None
+rolling_window = 85
+rolling_time_constant = 1.0
+# Per-rotation output: besides the frame average, keep the Stokes vector of every rotation with the time of its
+# trigger edge. The log (do_save) and headless output then get one record per rotation instead of one per frame.
+per_rotation_output = False
+# Live mode only: stream_acquisition = True keeps one CONTINUOUS scan running in a background thread
+# (see swpstream.py) and processes every complete rotation acquired since the previous frame.
+stream_acquisition = True
+# Run acquisition and Stokes computation in background threads connected by bounded queues (see swppipeline.py),
+# so the display only shows the latest result and never slows down the measurement.
+use_pipeline = True
+# Record the raw photodiode and trigger samples to data/raw_<date>_<time>.swpraw for later replay with a
+# corrected calibration (see swprecord.py). Gap-free with stream_acquisition, block by block otherwise.
+record_raw = False
+# Polarimeter shown, by name from the 'polarimeters' list of daqsettings.json (None: the first one). Its channels
+# and calibration file are taken from there. swpmulti.py monitors all of them at once.
+polarimeter_name = None
+# Performance statistics (see swpstats.py): show_stats overlays per-stage latencies, frames/sec, chunks per frame,
+# points per chunk and dropped samples on the display, and with stats_file set they are also written there as JSON
+# every stats_interval seconds. With both off the instrumentation costs nothing.
+show_stats = False
+stats_file = None
+stats_interval = 10
+# Display: with blit = True the static parts of the figure (axes, Poincare sphere, unit circle) are drawn once and
+# only the moving artists (Stokes vector and point, ellipse, bars and text) are redrawn over them, every
+# frame_interval ms. blit = False redraws the whole figure every frame, which takes an interval of ~150 ms.
+blit = True
+frame_interval = 40
+# Publish every computed frame to local subscribers (see swpserver.py), e.g. a polarization controller: serve_address
+# is 'host:port' or 'unix:/path' (None disables), serve_format 'json' (one line per record) or 'binary'.
+serve_address = None
+serve_format = 'json'
+
+def load_settings():
+    '''
+    Reads the simulation (offline only), DAQ and spinning waveplate settings (see swpsettings.py) into the module
+    globals used by the functions below. Prints an error and exits if a file is missing or invalid.
+    '''
+    global simpams, sim_digitize, sim_siglevel, sim_ns_level, sim_DOP, sim_bg_level, sim_wp_phi, sim_trigger_phase, sim_S
+    global daqpams, num_samples, scan_rate, channels, timeout, period, total_time, t
+    global polarimeter, photodiode_column, trigger_column
+    from daqbackend import select_polarimeter
+
+    if run_offline:
+        # Retrieving simulation parameters.
+        simpams = swpsettings.load_or_exit('sim')
+        sim_digitize = simpams['sim_digitize']
+        sim_siglevel = simpams['sim_siglevel']
+        sim_ns_level = simpams['sim_ns_level']
+        sim_DOP = simpams['sim_DOP']
+        sim_bg_level = simpams['sim_bg_level']
+        sim_wp_phi = simpams['sim_wp_phi']
+        sim_trigger_phase = simpams['sim_trigger_phase']
+        sim_poltype = simpams['sim_poltype']
+        if sim_poltype == 'right':
+            sim_S = np.array([1,0,0,1])
+        elif sim_poltype == 'lin':
+            sim_S = np.array([1,1,0,0])
+        else:
+            sim_S = np.array([1,np.sqrt(.3),np.sqrt(.3),np.sqrt(.4)])
+
+    # Retrieving Data Acquisition System (DAQ) parameters.
+    daqpams = swpsettings.load_or_exit('daq')
+    num_samples = daqpams['samples_per_channel']
+    scan_rate = daqpams['scan_rate']
+    timeout = daqpams['timeout']
+    # Defines sampling period, total sampling time and a time array of same length as samples.
+    period = 1/scan_rate
+    total_time = period*num_samples
+    t = np.linspace(0, total_time-period, num_samples)
+
+    # Only the polarimeter's two channels are scanned, interleaved in ascending channel order.
+    polarimeter = select_polarimeter(daqpams, polarimeter_name)
+    channels = [polarimeter.photodiode, polarimeter.trigger]
+    photodiode_column = sorted(channels).index(polarimeter.photodiode)
+    trigger_column = 1 - photodiode_column
+
+    load_calibration()
+
+def load_calibration():
+    '''
+    Reads the spinning waveplate (SWP) calibration of the polarimeter and restarts the rolling average with it.
+    process_frame calls this again whenever the file changes on disk, so a recalibration applies without a restart.
+    '''
+    global swp_params, trigger_phase, wp_phi, auto_scale_y_trace, bg_level, data_log_file, rolling, fractional_edges
+
+    swp_params = swpsettings.load_or_exit('swp', polarimeter.swp_settings)
+    trigger_phase = swp_params['trigger_phase']
+    wp_phi = swp_params['wp_phi']
+    auto_scale_y_trace = swp_params['auto_scale_y_trace']
+    bg_level = swp_params['bg_level']
+    data_log_file = "data/" + swp_params['log_data_file']
+    fractional_edges = swp_params['subsample_edges'] if subsample_triggers is None else subsample_triggers
+    if fractional_edges != swp_params['subsample_edges']:
+        print(f"Warning: trigger_phase was calibrated with {'fractional' if swp_params['subsample_edges'] else 'integer'} "
+              f"trigger edges, recalibrate for subsample_triggers = {subsample_triggers}.")
+
+    # Bases cached for the previous trigger phase will not be used again.
+    swp.demod_cache_clear()
+
+    rolling = None
+    if rolling_average:
+        rolling = swp.RollingStokes(wp_phi, trigger_phase, rolling_average, rolling_window, rolling_time_constant)
+
+def setup():
+    '''
+    Loads the settings and opens everything a run needs: the log, the raw recorder and either the DAQ backend or
+    the simulator. Importing polvis does none of this, so its functions can be reused elsewhere: set the flags
+    above, call setup(), then fetch_input_data/process_frame or one of the run_* functions, and shutdown().
+    '''
+    global logger, recorder, hat, reader, stream_cursor, simulator, stats, server
+    load_settings()
+
+    if show_stats or stats_file:
+        stats = swpstats.Stats(stats_file, stats_interval)
+
+    # Records are buffered and appended to a binary .npy log (see swplog.py), or to a CSV file if
+    # log_data_file ends in .csv. Export a binary log with: python swplog.py export <log> <csv>.
+    if do_save:
+        print(f"{'Appending to' if os.path.isfile(data_log_file) else 'Creating'} log file {data_log_file}")
+        logger = swplog.open_logger(data_log_file)
+
+    # Raw recording with a snapshot of the calibration in use.
+    recorder = None
+    if record_raw:
+        raw_file = f"data/raw_{datetime.datetime.now():%Y%m%d_%H%M%S}.swpraw"
+        print(f'Recording raw samples to {raw_file}')
+        recorder = swprecord.RawRecorder(raw_file, scan_rate, channels, {'trigger_phase': trigger_phase, 'wp_phi': wp_phi, 'bg_level': bg_level, 'subsample': fractional_edges},
+                                         photodiode_column, trigger_column)
+
+    # Live server for other programs. Publishing never blocks the processing; slow clients lose frames instead.
+    server = None
+    if serve_address:
+        from swpserver import StokesServer
+        server = StokesServer(serve_address, serve_format)
+        server.start()
+        print(f'Publishing Stokes frames ({serve_format}) on {server.bound_address}')
+
+    # Opening the DAQ backend named in daqsettings (MCC118 hat or simulated stand-in) on the configured channels.
+    if not run_offline:
+        from daqbackend import open_polarimeter
+        hat = open_polarimeter(daqpams, polarimeter_name)[0]
+
+        if stream_acquisition:
+            from swpstream import StreamReader
+            reader = StreamReader(hat, scan_rate, recorder=recorder)
+            reader.start()
+            reader.wait_for_samples(num_samples, timeout)
+            stream_cursor = 0
+
+    # Offline frames share one time base, so the simulator's phase tables and trigger trace are built once.
+    # Motor drift/jitter and trigger glitches set in simsettings make consecutive frames follow one simulated run.
+    if run_offline:
+        from daqbackend import motor_model_from_settings
+        sim_w = 2*np.pi*5100/60
+        sim_motor = motor_model_from_settings(simpams, sim_w)
+        if not (sim_motor.drift or sim_motor.jitter or sim_motor.trigger_noise or sim_motor.bounce or sim_motor.missed):
+            sim_motor = None
+        simulator = swp.FrameSimulator(sim_w, t, sim_siglevel, sim_ns_level, sim_digitize, sim_bg_level, sim_wp_phi, sim_trigger_phase,
+                                       clip_V=simpams['sim_clip_V'], motor=sim_motor)
+
+def shutdown():
+    '''
+    Stops the acquisition thread and closes the log and the raw recording opened by setup(). Prints the
+    performance statistics (and writes them to stats_file) if enabled.
+    '''
+    if stats.enabled:
+        if pipeline is not None:
+            stats.extra['pipeline'] = pipeline.stats()
+        if stats_file:
+            stats.dump()
+        print(f'Performance statistics:\n{stats.summary()}', file=sys.stderr)
+    if not run_offline and stream_acquisition:
+        reader.stop()
+    if server is not None:
+        server.stop()
+        print(f'Stokes server: {server.stats()}', file=sys.stderr)
+    if do_save:
+        logger.close()
+    if recorder is not None:
+        recorder.close()
+        print(f'Recorded {recorder.samples_written} samples to {recorder.path}')
+
+
+def setup_figure():
+    '''
+    Builds the three-panel figure and its artists. matplotlib is only imported here, so headless runs never load it.
+    '''
+    global fig, ax1, ax2, ax3, ln1, bar, bar2, pt, ln3, txt1, txt2, txt_err, txt_pipe, txt_stats
+    from matplotlib import pyplot as plt
+
+    # Setting up figure canvas.
+    fig, (ax1, ax2, ax3) = plt.subplots(1, 3, figsize=(15, 5))
+    # Initiating plots.
+    ln1, = ax1.plot([], [], lw=2)
+    bar = ax2.bar([0, 1, 2, 3], [0, 0, 0, 0], align='center')
+    bar2 = ax2.bar([0, 1, 2, 3], [0, 0, 0, 0], align='edge',alpha = .3)
+
+    # ===== Axis 3 is eith scope trace or Poincare sphere
+    if poincare:
+        ax3.get_xaxis().set_ticks([])
+        ax3.get_yaxis().set_ticks([])
+        ax3.axis('off')
+        # ax3.get_zaxis().set_ticks([])
+        ax3 = fig.add_subplot(1,3,3, projection = '3d')
+        # A one-point line rather than a scatter, since it projects itself when drawn on its own (blitting).
+        pt, = ax3.plot([0.5],[0.5],[0.707],'o',color='tab:blue',markersize=10)
+
+        tht = np.linspace(0, 2 * np.pi, 360)
+        ax3.plot([-1, 1], [0, 0], [0, 0], lw=2, color='black')
+        ax3.plot([0, 0], [-1, 1], [0, 0], lw=2, color='black')
+        ax3.plot([0, 0], [0, 0], [-1, 1], lw=2, color='black')
+        ax3.plot(np.cos(tht), np.sin(tht), 0 * tht, color='lightgray', alpha=0.6)
+
+        # ... and Wireframe
+        ax3.plot(np.cos(tht), 0 * tht, np.sin(tht), color='black', alpha=0.5)
+        ax3.plot(0 * tht, np.sin(tht), np.cos(tht), color='black', alpha=0.5)
+        ax3.plot(np.sin(tht), np.cos(tht), 0 * tht, color='black', alpha=0.5)
+        for phi0 in np.linspace(-np.pi / 2, np.pi / 2, 12):
+            ax3.plot(np.cos(tht) * np.cos(phi0), np.sin(tht) * np.cos(phi0), np.sin(phi0), color='lightgray', alpha=0.4)
+
+        # Label the axes
+        ax3.text(1.4, 0, 0, 'H', color='tab:red', fontsize=20)
+        ax3.text(-1., 0, 0, 'V', color='tab:red', fontsize=20)
+        ax3.text(0, -1.3, 0, '-45', color='tab:red', fontsize=20)
+        ax3.text(0, 0.8, 0, '+45', color='tab:red', fontsize=20)
+        ax3.text(0, 0, 1.0, 'R', color='tab:red', fontsize=20)
+        ax3.text(0, 0, -1.1, 'L', color='tab:red', fontsize=20)
+
+        ln3, = ax3.plot(np.array([0,0.5]),np.array([0,0.0]),np.array([0,0.0]),color='tab:red',lw=3)
 
-if not run_offline:
-    from daqhats import mcc118, hats
-    from daqhats_utils import select_hat_device, chan_list_to_mask
-
-# Store locations of generated simulation parameters, daq settings and spinning waveplate settings (json files).
-sim_settings_file = 'settings/simsettings.json'
-daq_settings_file = 'settings/daqsettings.json'
-swp_settings_file = 'settings/swpsettings.json'
-
-if run_offline:
-    # Print error if the simulation settings path is not an existing regular file. File must be in location specified. 
-    # Suggests generation of a default json file.
-    if not os.path.isfile(sim_settings_file):
-        print(f'Error: simulation file {sim_settings_file} not found.')
-        print('Run \'gen_default_json.py\' to generate default file first.')
-        exit()
     else:
-        # Retrieving hardcoded simulation parameters from json file.
-        with open(sim_settings_file,'r') as f:
-            simpams = json.load(f)
-            sim_digitize = simpams['sim_digitize']
-            sim_siglevel = simpams['sim_siglevel']
-            sim_ns_level = simpams['sim_ns_level']
-            sim_DOP = simpams['sim_DOP']
-            sim_bg_level = simpams['sim_bg_level']
-            sim_wp_phi = simpams['sim_wp_phi']
-            sim_trigger_phase = simpams['sim_trigger_phase']
-            sim_poltype = simpams['sim_poltype']
-            if sim_poltype == 'right':
-                sim_S = np.array([1,0,0,1])
-            elif sim_poltype == 'lin':
-                sim_S = np.array([1,1,0,0])
-            else:
-                sim_S = np.array([1,np.sqrt(.3),np.sqrt(.3),np.sqrt(.4)])
-                
-# Print error if the Data Acquisition System (DAQ) settings path is not an existing regular file. 
-# File must be in location specified. Suggests generation of a default json file.
-if not os.path.isfile(daq_settings_file):
-    print(f'Error: simulation file {sim_settings_file} not found.')
-    print('Run \'gen_default_json.py\' to generate default file first.')
-    
-    exit()
-
-else:
-    # Retrieving hardcoded DAQ parameters from json file. 
-    with open(daq_settings_file,'r') as f:
-        daqpams = json.load(f)
-        num_samples = daqpams['samples_per_channel']
-        scan_rate = daqpams['scan_rate']
-        channels = daqpams['channels']
-        timeout = daqpams['timeout']
-        # Defines sampling period, total sampling time and a time array of same length as samples.
-        period = 1/scan_rate
-        total_time = period*num_samples
-        t = np.linspace(0, total_time-period, num_samples)
-        
-        # Communicating DAQ channels and address.
-        if not run_offline:
-            channel_mask = chan_list_to_mask(channels)
-            num_channels = len(channels)
-            address = select_hat_device(hats.HatIDs.MCC_118)
-            hat = mcc118(address)
-            options = hats.OptionFlags.CONTINUOUS
-
-# Print error if the spinning wave plate (SWP) settings path is not an existing regular file. 
-# File must be in location specified. Suggests generation of a default json file.
-if not os.path.isfile(swp_settings_file):
-    print(f'Error: settings file {swp_settings_file} not found.')
-    print('Run \'gen_default_json.py\' to generate default file first.')
-    exit()
-
-else:
-
-    # Retrieving hardcoded SWP settings from json file. 
-    with open(swp_settings_file,'r') as f:
-        swp_params = json.load(f)
-        trigger_phase = swp_params['trigger_phase']
-        wp_phi = swp_params['wp_phi']
-        auto_scale_y_trace = swp_params['auto_scale_y_trace']
-        bg_level = swp_params['bg_level']
-        data_log_file = "data/" + swp_params['log_data_file']
-
-if do_save:
-    try:
-        with open(data_log_file, "r") as file:
-            print("CSV File Exists")
-    except:
-        print("Creating New CSV File")
-        with open(data_log_file, 'w') as file:
-            writer = csv.writer(file)
-            field = ["Timestamp", "S0", "S1", "S2", "S3", "DOP"]
-            writer.writerow(field)
-
-# Setting up figure canvas.
-fig, (ax1, ax2, ax3) = plt.subplots(1, 3, figsize=(15, 5))
-# Initiating plots.
-ln1, = ax1.plot([], [], lw=2)
-bar = ax2.bar([0, 1, 2, 3], [0, 0, 0, 0], align='center')
-bar2 = ax2.bar([0, 1, 2, 3], [0, 0, 0, 0], align='edge',alpha = .3)
-
-# ===== Axis 3 is eith scope trace or Poincare sphere
-if poincare:
-    ax3.get_xaxis().set_ticks([])
-    ax3.get_yaxis().set_ticks([])
-    ax3.axis('off')
-    # ax3.get_zaxis().set_ticks([])
-    ax3 = fig.add_subplot(1,3,3, projection = '3d')
-    pt = ax3.scatter([0.5],[0.5],[0.707],facecolor='tab:blue',s=100)
-
-    tht = np.linspace(0, 2 * np.pi, 360)
-    ax3.plot([-1, 1], [0, 0], [0, 0], lw=2, color='black')
-    ax3.plot([0, 0], [-1, 1], [0, 0], lw=2, color='black')
-    ax3.plot([0, 0], [0, 0], [-1, 1], lw=2, color='black')
-    ax3.plot(np.cos(tht), np.sin(tht), 0 * tht, color='lightgray', alpha=0.6)
-
-    # ... and Wireframe
-    ax3.plot(np.cos(tht), 0 * tht, np.sin(tht), color='black', alpha=0.5)
-    ax3.plot(0 * tht, np.sin(tht), np.cos(tht), color='black', alpha=0.5)
-    ax3.plot(np.sin(tht), np.cos(tht), 0 * tht, color='black', alpha=0.5)
-    for phi0 in np.linspace(-np.pi / 2, np.pi / 2, 12):
-        ax3.plot(np.cos(tht) * np.cos(phi0), np.sin(tht) * np.cos(phi0), np.sin(phi0), color='lightgray', alpha=0.4)
-
-    # Label the axes
-    ax3.text(1.4, 0, 0, 'H', color='tab:red', fontsize=20)
-    ax3.text(-1., 0, 0, 'V', color='tab:red', fontsize=20)
-    ax3.text(0, -1.3, 0, '-45', color='tab:red', fontsize=20)
-    ax3.text(0, 0.8, 0, '+45', color='tab:red', fontsize=20)
-    ax3.text(0, 0, 1.0, 'R', color='tab:red', fontsize=20)
-    ax3.text(0, 0, -1.1, 'L', color='tab:red', fontsize=20)
-
-    ln3, = ax3.plot(np.array([0,0.5]),np.array([0,0.0]),np.array([0,0.0]),color='tab:red',lw=3)
-
-else:
-    ln3, = ax3.plot([],[], lw=2, label = 'trace')
-    pt = ax3.plot([],[], label = 'dummy')
-
-# Initiating text variables.
-txt1 = ax2.text(-.5250,-.970,'',fontsize = 12)
-txt2 = ax1.text(-.95, 0.9, '', fontsize = 12, color = 'blue')
-txt_err = ax1.text(-1.25,-1.35,'', fontsize = 10, color = 'red')
+        ln3, = ax3.plot([],[], lw=2, label = 'trace')
+        pt = ax3.plot([],[], label = 'dummy')
+
+    # Initiating text variables.
+    txt1 = ax2.text(-.5250,-.970,'',fontsize = 12)
+    txt2 = ax1.text(-.95, 0.9, '', fontsize = 12, color = 'blue')
+    txt_err = ax1.text(-1.25,-1.35,'', fontsize = 10, color = 'red')
+    txt_pipe = fig.text(0.01, 0.01, '', fontsize = 8, color = 'gray')
+    txt_stats = fig.text(0.01, 0.99, '', fontsize = 8, color = 'gray', family = 'monospace', va = 'top')
+
+    # Time from the end of animate_fun to the end of the canvas redraw it triggers (blitting times its own).
+    if stats.enabled and not blit:
+        fig.canvas.mpl_connect('draw_event', record_redraw)
 
 
 def init_animation():
@@ -173,9 +295,7 @@ def init_animation():
 
     # Add unit circle around polarization ellipse.
     t_circ = np.linspace(0,2*np.pi,1000)
-    x = [np.cos(T) for T in t_circ]
-    y = [np.sin(T) for T in t_circ]
-    ax1.plot(x,y, color = 'gray', linestyle = '--', alpha = 0.5)
+    ax1.plot(np.cos(t_circ), np.sin(t_circ), color = 'gray', linestyle = '--', alpha = 0.5)
 
     # Graph parameters for bar graph.
     ax2.set_xlim(-0.6, 3.6)
@@ -197,22 +317,18 @@ def init_animation():
         ax3.set_title('Trace')
         ax3.grid()
         ax3.set_aspect(int(1000/6))
+        # Blitting never rescales the axes, so they are set to one block of samples here once and for all.
+        if blit:
+            ax3.set_xlim(0, num_samples)
+            ax3.set_aspect('auto')
     else:
         ax3.set_title("Poincare Sphere")
         # define points for poincare sphere
         u = np.linspace(0.0, 2 * np.pi, 20)
         v = np.linspace(0.0, np.pi, 40)
-        lu = np.size(u)
-        lv = np.size(v)
-        X = np.zeros((lu, lv))
-        Y = np.zeros((lu, lv))
-        Z = np.zeros((lu, lv))
-
-        for uu in range(0, lu):
-            for vv in range(0, lv):
-                X[uu, vv] = np.cos(u[uu]) * np.sin(v[vv])
-                Y[uu, vv] = np.sin(u[uu]) * np.sin(v[vv])
-                Z[uu, vv] = np.cos(v[vv])
+        X = np.outer(np.cos(u), np.sin(v))
+        Y = np.outer(np.sin(u), np.sin(v))
+        Z = np.outer(np.ones_like(u), np.cos(v))
 
         # Plot the surface
         srf = ax3.plot_surface(X, Y, Z, alpha=.1, color='lightgray')
@@ -224,15 +340,16 @@ def init_animation():
 def fetch_input_data(idx):
     '''
     If run_offline, generates and returns simulated input data.
-    If not run_offline, fetches live input data from raspberry pi mcc118 using daqhats and returns the 
-    zeroed difference between the input and background.
+    If not run_offline, fetches live input data from the DAQ backend (raspberry pi mcc118).
+    Either way the background is removed here (swptools.remove_background), once, and the raw samples are recorded.
+    Also returns the wall-clock time of the first sample of the block, for per-rotation timestamps.
     '''
+    t0 = time.perf_counter()
     # OFFLINE SCENARIO
     
-    # Define simulated angle phi and angular frequency [rad/s]. 
+    # Define simulated angle phi (angular frequency is set in the simulator). 
     if run_offline:
         sim_phi = float(idx/18.)
-        w = 2*np.pi*5100/60     
 
         # Demonstrates different polarization types by cycling the simulated Stokes vectors
         # every 50 frames from elliptical -> linear -> circular
@@ -248,82 +365,139 @@ def fetch_input_data(idx):
             sim_S = 3*np.array([1,0,0,sim_DOP])
         
         # Stores the simulated data input through external function along with trigger data.
-        input_data = swp.simulate_polarization_data(sim_S, w, t, sim_siglevel, sim_ns_level, sim_digitize, sim_bg_level, sim_wp_phi, sim_trigger_phase)
-        trigger_data = 5*(np.mod(w*t, 2*np.pi) < np.pi/12)
+        input_data, trigger_data = simulator.frames(sim_S)
+        input_data, trigger_data = input_data[0], trigger_data[0]
+        block_time = time.time()
+        if recorder is not None:
+            block = np.empty((len(input_data), 2))
+            block[:, photodiode_column], block[:, trigger_column] = input_data, trigger_data
+            recorder.write(block, discontinuity=True)
+        input_data = swp.remove_background(input_data, bg_level)
     
     # Begins input data scan through mcc118 hat and reads in list.
     # Stores input data and subtracts background data/light incident on photodetector.
     # *** bg_level is currently from gen_default_json and hardcoded in, need to change that -WS ***
-    else:
-        hat.a_in_scan_start(channel_mask, num_samples, scan_rate, options)
-        read_result = hat.a_in_scan_read(num_samples, timeout)
+    elif stream_acquisition:
+        # Every complete rotation since the previous frame, falling back to the latest block until a
+        # full rotation has arrived.
+        global stream_cursor
+        reader.wait_until(stream_cursor + num_samples, timeout)
+        # Samples overwritten in the ring buffer before this frame got to them.
+        stats.dropped(reader.ring.oldest() - stream_cursor)
+        raw_data, stream_cursor = reader.read_rotations(stream_cursor, trigger_column)
+        if raw_data is None:
+            raw_data = reader.latest(num_samples)
+            first_sample = reader.ring.total_written - len(raw_data)
+        else:
+            # The block ends with the sample after the trigger edge the cursor now points at.
+            first_sample = stream_cursor + 2 - len(raw_data)
+        block_time = reader.sample_time(first_sample)
+        input_data = swp.remove_background(raw_data[:, photodiode_column], bg_level)
+        trigger_data = raw_data[:, trigger_column]
 
-        input_data = abs(np.array(read_result.data[::2])) - bg_level
-        trigger_data = read_result.data[1::2]
+    else:
+        read_result = hat.acquire(num_samples, scan_rate, timeout)
+        block_time = time.time() - num_samples/scan_rate
 
-        hat.a_in_scan_stop()
-        hat.a_in_scan_cleanup()
+        # Both channels are strided views into the interleaved block.
+        raw_data = read_result.data
+        input_data = swp.remove_background(hat.channel_data(raw_data, polarimeter.photodiode), bg_level)
+        trigger_data = hat.channel_data(raw_data, polarimeter.trigger)
+        if recorder is not None:
+            recorder.write(raw_data, discontinuity=True)
 
-    return input_data, trigger_data, idx
+    stats.record('acquire', time.perf_counter() - t0)
+    return input_data, trigger_data, idx, block_time
 
-def animate_fun(idx):
+def process_frame(input_data, trigger_data, block_time = None):
     
     '''
-    Partitions input data into chunks and reverse engineers Stokes vectors from chunks.
-    
-    Determines the degree of polarization (DOP) from the calculated Stokes vectors.
+    Partitions input data (background removed, as returned by fetch_input_data) into chunks and reverse engineers
+    Stokes vectors from chunks.
     
-    Updates plots and text on canvas.
+    Determines the degree of polarization (DOP) from the calculated Stokes vectors, saves it if specified and
+    collects the warnings. Returns a dict with everything render_frame needs.
     '''
     
-    global phs, t, sim_S
+    t0 = time.perf_counter()
     estr = 'warnings: '
 
-    # Retrieving input data, trigger data and the current frame index.
-    input_data, trigger_data, idx = fetch_input_data(idx)
+    # Pick up a recalibration written while running.
+    if swpsettings.changed('swp', polarimeter.swp_settings):
+        print('Settings file changed, reloading the calibration.', file=sys.stderr)
+        load_calibration()
 
     # Separating data into "chunks" and retrieving total number of chunks created (based on swp frequency).
-    chunk_border_indices = swp.extract_chunks(trigger_data, TEST = input_data)
+    with stats.stage('extract_chunks'):
+        chunk_border_indices = swp.extract_chunks(trigger_data, TEST = input_data, subsample = fractional_edges)
     num_chunks = len(chunk_border_indices)-1
     
-    # Holds rolling average of points per chunk (PPC). Used for accuracy warning.
-    # For each chunk we calculate the 0, 2w, and 4w components, averaged over all chunks.
-    Nroll = 0 
-    
-    # Creating chunks and calculating Stokes vectors of each chunk (see "polarimeter_analysis" doc). 
-    S = np.zeros(4)
-    for k in range(num_chunks):
-        chunk = np.array(input_data[chunk_border_indices[k]:chunk_border_indices[k+1]]) - bg_level
-        S += swp.get_stokes_from_chunk(chunk, wp_ret=wp_phi, phs_ofst=trigger_phase, verbose=False)
-        # Update (PPC)
-        Nroll = (Nroll*k + len(chunk))/(k+1)
-    
-    S /= num_chunks
-    S /= S[0]
+    # Average points per chunk (PPC), for the statistics.
+    Nroll = np.mean(np.diff(chunk_border_indices)) if num_chunks > 0 else 0
+
+    # Calculating the 0, 2w, and 4w components and the Stokes vector of the block with the selected engine
+    # (see "polarimeter_analysis" doc).
+    with stats.stage('stokes'):
+        rotations = None
+        frame_time = time.time() if block_time is None else block_time
+
+        # With a rolling average, every rotation of the block updates the running estimate. The estimate after each
+        # rotation is output, timestamped at the edge closing that rotation, and the latest one is shown.
+        if rolling is not None:
+            S_rolling = rolling.feed(input_data, chunk_border_indices, scan_rate)
+            rotations = swprecord.stokes_records(frame_time + chunk_border_indices[1:]/scan_rate, S_rolling, swplog.RECORD_DTYPE)
+            S = rolling.latest()
+
+        # Per-rotation Stokes vectors of every chunk in one vectorized pass, timestamped at their opening trigger edge.
+        elif per_rotation_output:
+            S_chunks = swp.get_stokes_from_chunks(input_data, chunk_border_indices, wp_ret=wp_phi, phs_ofst=trigger_phase, verbose=False)[0]
+            rotations = swprecord.stokes_records(frame_time + chunk_border_indices[:-1]/scan_rate, S_chunks, swplog.RECORD_DTYPE)
+            if engine == 'chunked':
+                S = S_chunks.mean(axis=0) if num_chunks > 0 else np.full(4, np.nan)
+            else:
+                S = swp.get_frame_stokes(input_data, chunk_border_indices, wp_ret=wp_phi, phs_ofst=trigger_phase, engine=engine, verbose=False)
+        else:
+            S = swp.get_frame_stokes(input_data, chunk_border_indices, wp_ret=wp_phi, phs_ofst=trigger_phase, engine=engine, verbose=False)
+        S /= S[0]
     
     # Calculating degree of polarization (DOP).
     DOP = np.sqrt(S[1]**2 + S[2]**2 + S[3]**2)
     
     # Saving if specified.
     if do_save: 
-        with open(data_log_file,'a') as file:
-            tnow = datetime.datetime.now()
-            inwriter = csv.writer(file)
-            inwriter.writerow([f"{tnow}, {S[0]}, {S[1]}, {S[2]}, {S[3]}, {DOP}"])
-
-    # Possible warnings.
-    if Nroll < 180:
-        estr+=f'PPC too low ({int(Nroll)})    '
-    if DOP-1 > .03:
-        estr += f'Unphysical DOP ({round(DOP,3)})    '
-    if np.mean(input_data) < 0.08:
-        estr += f'Light level too low    '
-    if num_chunks < 3:
-        estr += f'Insufficient chunks    '
-    if not run_offline and (np.mean(input_data) < 2 or max(input_data) > 10):
-        estr += f'Signal voltage out of range (adjust gain)      '
+        with stats.stage('log'):
+            if rotations is not None:
+                logger.log_many(rotations)
+            else:
+                logger.log(time.time(), S, DOP)
+
+    # Possible warnings, the same checks as swpmulti.
+    mean_signal = np.mean(input_data)
+    warnings = swp.frame_warnings(input_data, chunk_border_indices, DOP, fractional_edges, check_voltage=not run_offline)
+    if not run_offline and stream_acquisition and reader.overruns:
+        warnings.append(f'DAQ overruns ({reader.overruns})')
+    estr += ''.join(w + '    ' for w in warnings)
+
+    if server is not None:
+        with stats.stage('publish'):
+            records = rotations if rotations is not None else np.array([(time.time(), S[0], S[1], S[2], S[3], DOP)], dtype=swplog.RECORD_DTYPE)
+            server.publish(records, estr[len('warnings: '):].strip())
+
+    stats.frame(len(input_data), num_chunks, Nroll)
+    stats.record('process_frame', time.perf_counter() - t0)
+    return {'S': S, 'DOP': DOP, 'mean_signal': mean_signal, 'warnings': estr, 'input_data': input_data, 'rotations': rotations}
+
+def render_frame(frame):
+    '''
+    Updates plots and text on canvas from a frame computed by process_frame.
+    '''
+    t0 = time.perf_counter()
+    S = frame['S']
+    DOP = frame['DOP']
+    input_data = frame['input_data']
+
     # Displaying error(s) and DOP on canvas.
-    txt_err.set_text(f'({round(np.mean(input_data),2)},{round(S[1],2)},{round(S[2],2)},{round(S[3],2)})\n'+estr)
+    txt_err.set_text(f'({round(frame["mean_signal"],2)},{round(S[1],2)},{round(S[2],2)},{round(S[3],2)})\n'+frame['warnings'])
     
     txt1.set_text(f'DOP: {round(DOP,3)}')
     
@@ -334,7 +508,7 @@ def animate_fun(idx):
     
     # Mean input added to canvas if online.
     else:
-        txt2.set_text(f'Mean Signal: {np.mean(input_data)}')
+        txt2.set_text(f'Mean Signal: {frame["mean_signal"]}')
     
     #Updating plots.
     for i in range(len(S)):
@@ -342,23 +516,256 @@ def animate_fun(idx):
         #if run_offline:
            # bar2[i].set_height(sim_S[i]/sim_S[0])
 
-    x, y = swp.get_polarization_ellipse(S)
+    with stats.stage('ellipse'):
+        x, y = swp.get_polarization_ellipse(S)
     ln1.set_data(x,y)
 
     if not poincare:
-        ln3.set_data(range(len(input_data)),3*input_data)
-        ax3.set_xlim(0, len(input_data))
+        # Min/max per pixel column is all the screen can show; the figure width bounds the width of the axes. Blitting
+        # keeps the axes fixed, so the latest samples_per_channel samples are shown whatever the block length.
+        if blit:
+            input_data = input_data[-num_samples:]
+        x, y = decimate_trace(3*input_data, 2*int(fig.bbox.width))
+        ln3.set_data(x, y)
+        if not blit:
+            ax3.set_xlim(0, len(input_data))
     else:
         dtx = np.array([0,S[1]])
         dty = np.array([0,S[2]])
         dtz = np.array([0,S[3]])
         ln3.set_data(dtx, dty)
         ln3.set_3d_properties(dtz)
-        pt._offsets3d = ([S[1]], [S[2]], [S[3]])
+        pt.set_data_3d([S[1]], [S[2]], [S[3]])
+    stats.record('render', time.perf_counter() - t0)
+
+def decimate_trace(data, max_points):
+    '''
+    Returns (x, y) of data reduced to at most max_points points: the minimum and maximum of each bucket of
+    samples, so the envelope and any spikes stay visible.
+    '''
+    if len(data) <= max_points:
+        return np.arange(len(data)), data
+    bucket = -(-len(data)//(max_points//2))
+    blocks = data[:len(data)//bucket*bucket].reshape(-1, bucket)
+    x = np.repeat(np.arange(len(blocks))*bucket, 2)
+    y = np.column_stack([blocks.min(axis=1), blocks.max(axis=1)]).ravel()
+    return x, y
+
+class BlitRenderer:
+    '''
+    Draws the moving artists over a cached image of the rest of the figure (matplotlib blitting). The cache is
+    rebuilt after every full draw, e.g. on the first show, a resize or rotating the Poincare sphere.
+    '''
+    def __init__(self, fig, artists):
+        self.fig = fig
+        self.canvas = fig.canvas
+        self.artists = artists
+        self.background = None
+        for artist in artists:
+            artist.set_animated(True)
+        self.canvas.mpl_connect('draw_event', self._on_draw)
+
+    def _on_draw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self._draw_artists()
+
+    def _draw_artists(self):
+        for artist in self.artists:
+            self.fig.draw_artist(artist)
+
+    def update(self):
+        '''Shows the current state of the moving artists.'''
+        if self.background is None:
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self.background)
+        self._draw_artists()
+        self.canvas.blit(self.fig.bbox)
+        self.canvas.flush_events()
+
+def animated_artists():
+    '''
+    Everything render_frame and animate_fun change, i.e. what blitting redraws each frame.
+    '''
+    artists = [ln1, *bar, txt1, txt2, txt_err, ln3, txt_pipe, txt_stats]
+    if poincare:
+        artists.append(pt)
+    return artists
+
+def acquire_frame():
+    '''
+    Acquisition stage of the pipeline: fetches the next block of input data. Simulated blocks are paced to the
+    time the DAQ would need to acquire them.
+    '''
+    global acquire_idx
+    t0 = time.perf_counter()
+    input_data, trigger_data, _, block_time = fetch_input_data(acquire_idx)
+    acquire_idx += 1
+    if run_offline:
+        time.sleep(max(0, total_time - (time.perf_counter() - t0)))
+    return input_data, trigger_data, block_time
+
+def animate_fun(idx):
+    '''
+    Without the pipeline, acquires, processes and renders one frame. With the pipeline, renders the latest
+    frame computed in the background (if any) together with the pipeline stats.
+    '''
+    if pipeline is None:
+        input_data, trigger_data, idx, block_time = fetch_input_data(idx)
+        render_frame(process_frame(input_data, trigger_data, block_time))
+    else:
+        frame = pipeline.latest()
+        if frame is not None:
+            render_frame(frame)
+        txt_pipe.set_text(pipeline.summary())
+
+    if stats.enabled:
+        if pipeline is not None:
+            stats.extra['pipeline'] = pipeline.stats()
+        if show_stats:
+            txt_stats.set_text(stats.summary())
+        stats.maybe_dump()
+        global render_done
+        render_done = time.perf_counter()
 
     return ln1, bar, txt1, ln3,
 
-# Begins animation.
-annie = animation.FuncAnimation(fig, animate_fun, init_func=init_animation, interval=150, cache_frame_data=False)
-plt.show()
- 
+def record_redraw(event):
+    '''
+    draw_event callback: records the matplotlib redraw that followed animate_fun.
+    '''
+    global render_done
+    if render_done is not None:
+        stats.record('redraw', time.perf_counter() - render_done)
+        render_done = None
+
+def blit_step():
+    '''
+    Timer callback of the blitted display: updates the artists for the next frame and blits them.
+    '''
+    global blit_idx
+    animate_fun(blit_idx)
+    blit_idx += 1
+    with stats.stage('redraw'):
+        renderer.update()
+
+def run_gui():
+    '''
+    Runs the interactive matplotlib display, with the acquisition and computation stages in the background
+    if specified.
+    '''
+    global pipeline, acquire_idx, renderer, blit_idx
+    from matplotlib import pyplot as plt, animation
+
+    setup_figure()
+    if use_pipeline:
+        acquire_idx = 0
+        pipeline = Pipeline(acquire_frame, lambda data: process_frame(*data))
+        pipeline.start()
+
+    # Begins animation.
+    if blit:
+        init_animation()
+        renderer = BlitRenderer(fig, animated_artists())
+        blit_idx = 0
+        timer = fig.canvas.new_timer(interval=frame_interval)
+        timer.add_callback(blit_step)
+        timer.start()
+    else:
+        annie = animation.FuncAnimation(fig, animate_fun, init_func=init_animation, interval=150, cache_frame_data=False)
+    plt.show()
+
+    if pipeline is not None:
+        pipeline.stop()
+        print(f'Pipeline stats: {pipeline.stats()}')
+
+def run_headless(rate, duration, output):
+    '''
+    Runs the same acquisition and processing loop as the display without importing matplotlib, streaming one
+    line per frame (timestamp, S0, S1, S2, S3, DOP, warnings) to output ('-' for stdout). With per_rotation_output,
+    one line per rotation is written instead (timestamp of its trigger edge), the frame warnings on the last one; with
+    a rolling average, one line per rotation with the estimate after it.
+    An output ending in .npy gets the same records as a binary Stokes log (see swplog.py), without warnings.
+
+    - rate: maximum frame rate [Hz], 0 runs as fast as acquisition allows
+    - duration: run time [s], 0 runs until interrupted
+    '''
+    binary = output.endswith('.npy')
+    if binary:
+        out = swplog.StokesLogger(output)
+    else:
+        out = sys.stdout if output == '-' else open(output, 'a')
+        out.write('# timestamp, S0, S1, S2, S3, DOP, warnings\n')
+    frame_period = 1/rate if rate > 0 else 0
+
+    idx = 0
+    num_records = 0
+    t_start = time.perf_counter()
+    try:
+        while duration <= 0 or time.perf_counter() - t_start < duration:
+            t0 = time.perf_counter()
+            input_data, trigger_data, idx, block_time = fetch_input_data(idx)
+            frame = process_frame(input_data, trigger_data, block_time)
+            if frame['rotations'] is not None:
+                records = frame['rotations']
+            else:
+                S = frame['S']
+                records = np.array([(time.time(), S[0], S[1], S[2], S[3], frame['DOP'])], dtype=swplog.RECORD_DTYPE)
+            num_records += len(records)
+
+            if binary:
+                out.log_many(records)
+            elif len(records):
+                warnings = frame['warnings'][len('warnings: '):].strip()
+                lines = [f"{r['timestamp']:.4f}, {r['S0']:.5f}, {r['S1']:.5f}, {r['S2']:.5f}, {r['S3']:.5f}, {r['DOP']:.5f}, " for r in records]
+                lines[-1] += warnings
+                out.write('\n'.join(lines) + '\n')
+                out.flush()
+            idx += 1
+            stats.maybe_dump()
+            time.sleep(max(0, frame_period - (time.perf_counter() - t0)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    elapsed = time.perf_counter() - t_start
+    print(f'Processed {idx} frames ({num_records} records) in {round(elapsed,2)} s ({round(idx/elapsed,2)} frames/s)', file=sys.stderr)
+
+pipeline = None
+recorder = None
+server = None
+rolling = None
+stats = swpstats.NullStats()
+render_done = None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Real-time visualization (or headless logging) of the polarization state.')
+    parser.add_argument('--headless', action='store_true', help='run without matplotlib and stream Stokes frames as text')
+    parser.add_argument('--rate', type=float, default=0, help='headless: maximum frame rate in Hz (default: as fast as acquisition allows)')
+    parser.add_argument('--duration', type=float, default=0, help='headless: run time in seconds (default: until interrupted)')
+    parser.add_argument('--output', default='-', help='headless: output file, - for stdout (default), .npy for a binary Stokes log')
+    parser.add_argument('--per-rotation', action='store_true', help='output one Stokes record per rotation instead of per frame')
+    parser.add_argument('--stats', default=None, help='write per-stage timing statistics to this JSON file every stats_interval seconds')
+    parser.add_argument('--serve', default=None, help='publish every Stokes frame to clients of this address (host:port or unix:/path)')
+    parser.add_argument('--serve-format', default=None, choices=('json', 'binary'), help='format of the published frames (default: serve_format)')
+    args = parser.parse_args()
+    if args.per_rotation:
+        per_rotation_output = True
+    if args.stats:
+        stats_file = args.stats
+    if args.serve:
+        serve_address = args.serve
+    if args.serve_format:
+        serve_format = args.serve_format
+
+    setup()
+    if args.headless:
+        run_headless(args.rate, args.duration, args.output)
+    else:
+        run_gui()
+    shutdown()
+
+    # Report how well the demodulation basis cache performed over the session.
+    print(f'Demodulation cache: {swp.demod_cache_info()}', file=sys.stderr if args.headless else sys.stdout)
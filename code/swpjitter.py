@@ -0,0 +1,210 @@
+"""
+Streaming motor jitter analysis.
+
+Trigger data is consumed block by block and every rotation period updates statistics held in constant memory:
+mean and variance (Welford), min/max, a fixed-bin histogram and the Allan deviation of the period at octave
+averaging factors. The same statistics are kept for the change in period between consecutive rotations
+(cycle-to-cycle jitter). Everything is checkpointed to JSON periodically, so a run of many hours can be
+inspected while it is going and is not lost if it is interrupted.
+"""
+import json
+import os
+import time
+import numpy as np
+import swptools as swp
+
+
+class RunningStats:
+    '''Count, mean, variance, min and max of a stream of values, updated a block at a time.'''
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        if len(values) == 0:
+            return
+        # Welford's update generalized to a block (Chan et al.), numerically stable over billions of values.
+        n = len(values)
+        block_mean = np.mean(values)
+        block_m2 = np.sum((values - block_mean)**2)
+        total = self.count + n
+        delta = block_mean - self.mean
+        self.mean += delta*n/total
+        self.m2 += block_m2 + delta**2*self.count*n/total
+        self.count = total
+        self.min = min(self.min, np.min(values))
+        self.max = max(self.max, np.max(values))
+
+    def std(self):
+        '''Sample standard deviation.'''
+        return np.sqrt(self.m2/(self.count - 1)) if self.count > 1 else np.nan
+
+    def to_dict(self):
+        return {'count': self.count, 'mean': self.mean, 'std': _json_float(self.std()),
+                'standard_error': _json_float(self.std()/np.sqrt(self.count)) if self.count else None,
+                'min': _json_float(self.min), 'max': _json_float(self.max)}
+
+
+class Histogram:
+    '''Fixed-bin histogram of a stream of values.
+
+    - center: middle of the binned range. When None, the mean of the first block is used.
+    - span: half-width of the binned range, as a fraction of center (or absolute when relative is False)
+    - bins: number of bins. Values outside the range are counted in underflow/overflow.
+    '''
+    def __init__(self, center = None, span = 0.05, bins = 200, relative = True):
+        self.center = center
+        self.span = span
+        self.relative = relative
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.underflow = 0
+        self.overflow = 0
+        self.edges = None
+        if center is not None:
+            self._set_edges(center)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        if len(values) == 0:
+            return
+        if self.edges is None:
+            self._set_edges(np.mean(values))
+        self.underflow += int(np.sum(values < self.edges[0]))
+        self.overflow += int(np.sum(values > self.edges[-1]))
+        self.counts += np.histogram(values, self.edges)[0]
+
+    def _set_edges(self, center):
+        self.center = float(center)
+        half_width = self.span*abs(self.center) if self.relative else self.span
+        self.edges = np.linspace(self.center - half_width, self.center + half_width, len(self.counts) + 1)
+
+    def to_dict(self):
+        return {'edges': None if self.edges is None else self.edges.tolist(), 'counts': self.counts.tolist(),
+                'underflow': self.underflow, 'overflow': self.overflow}
+
+
+class AllanDeviation:
+    '''Non-overlapping Allan deviation of a stream of values at averaging factors 1, 2, 4, ... 2**(octaves-1).
+
+    Level j keeps only a running sum of squared differences between consecutive averages of 2**j values, the
+    last such average and an unpaired leftover, so memory does not grow with the length of the run.
+    '''
+    def __init__(self, octaves = 24):
+        self.sum_sq = np.zeros(octaves)
+        self.num_diffs = np.zeros(octaves, dtype=np.int64)
+        self.reset()
+
+    def reset(self):
+        '''Forgets the carried-over averages, so values after a gap are not paired with those before it. The
+        accumulated differences are kept.'''
+        self.previous = [None]*len(self.sum_sq)
+        self.leftover = [None]*len(self.sum_sq)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        for j in range(len(self.sum_sq)):
+            if len(values) == 0:
+                break
+            sequence = values if self.previous[j] is None else np.r_[self.previous[j], values]
+            self.sum_sq[j] += np.sum(np.diff(sequence)**2)
+            self.num_diffs[j] += len(sequence) - 1
+            self.previous[j] = values[-1]
+
+            # Pairwise means feed the next octave.
+            if self.leftover[j] is not None:
+                values = np.r_[self.leftover[j], values]
+            self.leftover[j] = values[-1] if len(values) % 2 else None
+            values = values[:len(values)//2*2].reshape(-1, 2).mean(axis=1)
+
+    def deviation(self):
+        '''Returns (averaging factors, Allan deviations) for the levels with at least one difference.'''
+        valid = self.num_diffs > 0
+        factors = 2**np.arange(len(self.sum_sq))
+        return factors[valid], np.sqrt(0.5*self.sum_sq[valid]/self.num_diffs[valid])
+
+    def to_dict(self):
+        factors, adev = self.deviation()
+        return {'factors': factors.tolist(), 'deviation': adev.tolist(), 'num_diffs': self.num_diffs[:len(factors)].tolist()}
+
+
+class JitterAnalyzer:
+    '''Rotation period statistics of a continuously read Hall trigger trace.
+
+    - scan_rate: samples per second of the trigger trace
+    - threshold, schmidt: edge detection settings, as in extract_chunks
+    - hist_span, hist_bins: period histogram range (fraction of the mean period) and number of bins
+    - checkpoint_file: JSON file the statistics are written to every checkpoint_interval seconds (None disables)
+    '''
+    def __init__(self, scan_rate, threshold = 1, schmidt = 10, hist_span = 0.05, hist_bins = 200,
+                 checkpoint_file = None, checkpoint_interval = 60):
+        self.scan_rate = scan_rate
+        self.tracker = swp.EdgeTracker(threshold, schmidt)
+        self.periods = RunningStats()
+        self.period_changes = RunningStats()
+        self.histogram = Histogram(span=hist_span, bins=hist_bins)
+        self.allan = AllanDeviation()
+        self.checkpoint_file = checkpoint_file
+        self.checkpoint_interval = checkpoint_interval
+        self.discontinuities = 0
+        self.started_at = time.time()
+        self._last_edge = None
+        self._last_period = None
+        self._last_checkpoint = time.monotonic()
+
+    def feed(self, trigger_data):
+        '''Processes the next block of the trigger trace. Returns the rotation periods completed in it [s].'''
+        edges = self.tracker.feed(trigger_data)
+        if self._last_edge is not None:
+            edges = np.r_[self._last_edge, edges]
+        if len(edges):
+            self._last_edge = edges[-1]
+        periods = np.diff(edges)/self.scan_rate
+
+        if len(periods):
+            self.periods.update(periods)
+            self.histogram.update(periods)
+            self.allan.update(periods)
+            changes = np.diff(periods) if self._last_period is None else np.diff(np.r_[self._last_period, periods])
+            self.period_changes.update(changes)
+            self._last_period = periods[-1]
+
+        if self.checkpoint_file is not None and time.monotonic() - self._last_checkpoint > self.checkpoint_interval:
+            self.checkpoint()
+        return periods
+
+    def discontinuity(self):
+        '''Marks that the next block does not follow on from the previous one (e.g. after an overrun).'''
+        self.discontinuities += 1
+        self.tracker.reset()
+        self.allan.reset()
+        self._last_edge = None
+        self._last_period = None
+
+    def to_dict(self):
+        return {'started_at': self.started_at, 'updated_at': time.time(), 'scan_rate': self.scan_rate,
+                'samples': int(self.tracker.samples_seen), 'discontinuities': self.discontinuities,
+                'period': self.periods.to_dict(), 'period_change': self.period_changes.to_dict(),
+                'histogram': self.histogram.to_dict(), 'allan': self.allan.to_dict()}
+
+    def checkpoint(self, path = None):
+        '''Writes the statistics to path (default checkpoint_file), replacing the previous checkpoint atomically.'''
+        path = self.checkpoint_file if path is None else path
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+        os.replace(path + '.tmp', path)
+        self._last_checkpoint = time.monotonic()
+
+    def summary(self):
+        p = self.periods
+        return (f'{p.count} rotations: period {np.around(p.mean,7)} +/- {np.around(p.std()/np.sqrt(max(p.count,1)),7)} s, '
+                f'std {np.around(p.std(),7)} s, min {np.around(p.min,7)} s, max {np.around(p.max,7)} s, '
+                f'cycle-to-cycle std {np.around(self.period_changes.std(),7)} s')
+
+
+def _json_float(value):
+    '''None for inf/nan, which JSON cannot represent.'''
+    return float(value) if np.isfinite(value) else None
@@ -0,0 +1,202 @@
+"""
+Buffered Stokes logging.
+
+Records (timestamp, S0, S1, S2, S3, DOP) are buffered in memory and appended to a binary .npy file in chunks,
+with a periodic flush. The file is a standard NumPy array file with a fixed-size header that is rewritten on
+every flush, so np.load(path, mmap_mode='r') and read_log() open it directly. CSV is available as an export
+(export_csv) or, off the fast path, as a buffered CsvStokesLogger.
+
+Usage: python swplog.py export data/log.npy data/log.csv
+"""
+import argparse
+import ast
+import csv
+import datetime
+import os.path
+import time
+import numpy as np
+
+RECORD_DTYPE = np.dtype([('timestamp', '<f8'), ('S0', '<f8'), ('S1', '<f8'), ('S2', '<f8'), ('S3', '<f8'), ('DOP', '<f8')])
+
+# Total size of the .npy preamble (magic, version, header length and padded header dict). Fixed so the header can
+# be rewritten in place as the record count grows; a multiple of 64 as the format requires.
+HEADER_SIZE = 256
+NPY_MAGIC = b'\x93NUMPY\x01\x00'
+
+
+class StokesLogger:
+    '''Append-only binary log of timestamped Stokes records.
+
+    - path: .npy file; an existing log is appended to
+    - buffer_records: records held in memory between writes
+    - flush_interval: maximum time [s] records stay buffered
+    '''
+    def __init__(self, path, buffer_records = 256, flush_interval = 1.0, dtype = RECORD_DTYPE):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.flush_interval = flush_interval
+        self.buffer = np.zeros(buffer_records, dtype=self.dtype)
+        self.buffered = 0
+        self.last_flush = time.monotonic()
+
+        if os.path.isfile(path) and os.path.getsize(path) >= HEADER_SIZE:
+            dtype_on_disk, _ = _read_header(path)
+            if dtype_on_disk != self.dtype:
+                raise ValueError(f'Log {path} has records of type {dtype_on_disk}, expected {self.dtype}')
+            # Keep every complete record on disk, even those written after the last header update.
+            self.count = (os.path.getsize(path) - HEADER_SIZE)//self.dtype.itemsize
+            self.file = open(path, 'r+b')
+            self.file.seek(HEADER_SIZE + self.count*self.dtype.itemsize)
+            self.file.truncate()
+        else:
+            self.count = 0
+            self.file = open(path, 'w+b')
+            self._write_header()
+
+    def log(self, timestamp, S, DOP):
+        '''Buffers one record (S is the normalized Stokes vector).'''
+        self.buffer[self.buffered] = (timestamp, S[0], S[1], S[2], S[3], DOP)
+        self.buffered += 1
+        if self.buffered == len(self.buffer) or time.monotonic() - self.last_flush > self.flush_interval:
+            self.flush()
+
+    def log_many(self, records):
+        '''Buffers a structured array of records with this logger's dtype, written as log() does.'''
+        records = np.asarray(records, dtype=self.dtype)
+        while len(records):
+            taken = min(len(records), len(self.buffer) - self.buffered)
+            self.buffer[self.buffered:self.buffered + taken] = records[:taken]
+            self.buffered += taken
+            records = records[taken:]
+            if self.buffered == len(self.buffer):
+                self.flush()
+        if self.buffered and time.monotonic() - self.last_flush > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        '''Writes buffered records and updates the record count in the header.'''
+        if self.buffered:
+            self.file.write(self.buffer[:self.buffered].tobytes())
+            self.count += self.buffered
+            self.buffered = 0
+            self._write_header()
+        self.file.flush()
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _write_header(self):
+        position = self.file.tell()
+        self.file.seek(0)
+        self.file.write(_npy_header(self.dtype, self.count))
+        self.file.seek(max(position, HEADER_SIZE))
+
+
+class CsvStokesLogger:
+    '''Buffered CSV log with the same interface as StokesLogger (one row per record, ISO timestamps).'''
+    def __init__(self, path, buffer_records = 256, flush_interval = 1.0):
+        new_file = not os.path.isfile(path)
+        self.file = open(path, 'a', newline='')
+        self.writer = csv.writer(self.file)
+        if new_file:
+            self.writer.writerow(["Timestamp", "S0", "S1", "S2", "S3", "DOP"])
+        self.buffer_records = buffer_records
+        self.flush_interval = flush_interval
+        self.rows = []
+        self.last_flush = time.monotonic()
+
+    def log(self, timestamp, S, DOP):
+        self.rows.append([datetime.datetime.fromtimestamp(timestamp), S[0], S[1], S[2], S[3], DOP])
+        if len(self.rows) >= self.buffer_records or time.monotonic() - self.last_flush > self.flush_interval:
+            self.flush()
+
+    def log_many(self, records):
+        for rec in records:
+            self.log(rec['timestamp'], [rec['S0'], rec['S1'], rec['S2'], rec['S3']], rec['DOP'])
+
+    def flush(self):
+        self.writer.writerows(self.rows)
+        self.rows = []
+        self.file.flush()
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_logger(path, **kwargs):
+    '''Returns a CsvStokesLogger for .csv paths and a binary StokesLogger otherwise.'''
+    if path.endswith('.csv'):
+        return CsvStokesLogger(path, **kwargs)
+    return StokesLogger(path, **kwargs)
+
+
+def read_log(path):
+    '''Memory-maps a binary Stokes log as a structured array (fields timestamp, S0, S1, S2, S3, DOP).
+
+    The record count is taken from the file size, so records written after the last header update (e.g. before a
+    crash) are still visible.
+    '''
+    dtype, _ = _read_header(path)
+    count = (os.path.getsize(path) - HEADER_SIZE)//dtype.itemsize
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=HEADER_SIZE, shape=(count,))
+
+
+def export_csv(log_path, csv_path, chunk_records = 100000):
+    '''Exports a binary Stokes log to CSV in bounded-memory chunks.'''
+    records = read_log(log_path)
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["Timestamp", "S0", "S1", "S2", "S3", "DOP"])
+        for start in range(0, len(records), chunk_records):
+            chunk = records[start:start+chunk_records]
+            timestamps = [datetime.datetime.fromtimestamp(ts) for ts in chunk['timestamp']]
+            writer.writerows(zip(timestamps, chunk['S0'], chunk['S1'], chunk['S2'], chunk['S3'], chunk['DOP']))
+
+
+def _npy_header(dtype, count):
+    header = repr({'descr': dtype.descr, 'fortran_order': False, 'shape': (count,)})
+    header = header.ljust(HEADER_SIZE - len(NPY_MAGIC) - 2 - 1) + '\n'
+    return NPY_MAGIC + (len(header)).to_bytes(2, 'little') + header.encode('latin1')
+
+
+def _read_header(path):
+    '''Returns (dtype, record count in header) of a log written by StokesLogger.'''
+    with open(path, 'rb') as f:
+        preamble = f.read(HEADER_SIZE)
+    if preamble[:len(NPY_MAGIC)] != NPY_MAGIC or len(preamble) < HEADER_SIZE:
+        raise ValueError(f'{path} is not a Stokes log')
+    header = ast.literal_eval(preamble[len(NPY_MAGIC)+2:].decode('latin1'))
+    return np.dtype(header['descr']), header['shape'][0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stokes log tools.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser('export', help='export a binary log to CSV')
+    export_parser.add_argument('log')
+    export_parser.add_argument('csv')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        export_csv(args.log, args.csv)
+        print(f'Exported {len(read_log(args.log))} records to {args.csv}')
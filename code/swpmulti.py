@@ -0,0 +1,167 @@
+"""
+Monitoring several polarimeters from one host.
+
+Every polarimeter listed in daqsettings.json (see daqbackend.polarimeters_from_settings) is measured at once: one
+StreamReader per hat acquires all channels of that hat continuously, and every frame the complete rotations of
+each polarimeter since the previous frame are cut out of its hat's ring buffer, following its own trigger
+channel. The blocks are processed in a process pool, one task per polarimeter with its own calibration, so the
+Stokes computation of N beams spreads over the cores. Per-rotation records go to one binary Stokes log per
+polarimeter (see swplog.py) and a status line per polarimeter is printed periodically.
+
+Usage: python swpmulti.py --output-dir data/multi --duration 3600
+"""
+import argparse
+import concurrent.futures
+import multiprocessing
+import os
+import time
+import numpy as np
+import swplog
+import swprecord
+import swpsettings
+import swptools as swp
+from daqbackend import open_backends, polarimeters_from_settings
+from swpstream import StreamReader
+
+
+def process_rotations(polarimeter, input_data, trigger_data, first_time, scan_rate, subsample = None):
+    '''Per-rotation Stokes records of one block of a polarimeter, with their average and the frame warnings.
+
+    The calibration comes from the polarimeter's swp_settings file; swpsettings caches it in every worker process
+    and re-reads it when it changes, so a recalibration applies without a restart. subsample defaults to the edge mode
+    stored with the calibration. Returns (records, S, warnings).
+    '''
+    calibration = swpsettings.load('swp', polarimeter.swp_settings)
+    subsample = calibration['subsample_edges'] if subsample is None else subsample
+    # Background and warnings handled by the same functions as polvis, so both report the same numbers.
+    input_data = swp.remove_background(input_data, calibration['bg_level'])
+    borders = swp.extract_chunks(trigger_data, subsample=subsample)
+    S_chunks = swp.get_stokes_from_chunks(input_data, borders, calibration['wp_phi'], calibration['trigger_phase'], verbose=False)[0]
+    records = swprecord.stokes_records(first_time + borders[:-1]/scan_rate, S_chunks, swplog.RECORD_DTYPE)
+    S = S_chunks.mean(axis=0) if len(S_chunks) else np.full(4, np.nan)
+
+    DOP = np.sqrt(np.sum(S[1:]**2))
+    return records, S, swp.frame_warnings(input_data, borders, DOP, subsample)
+
+
+class MultiMonitor:
+    '''Continuous acquisition and concurrent processing of every polarimeter in the DAQ settings.
+
+    - daqpams: DAQ settings (daqsettings.json contents)
+    - workers: processes for the Stokes computation (default: one per polarimeter, at most one per core).
+      0 processes everything in the calling thread.
+    - subsample: locate trigger edges to a fraction of a sample (see swptools.subsample_edges); None uses the edge mode
+      stored with each polarimeter's calibration
+    Extra keyword arguments are passed to daqbackend.open_backend.
+    '''
+    def __init__(self, daqpams, workers = None, subsample = None, **backend_kwargs):
+        self.polarimeters = polarimeters_from_settings(daqpams)
+        self.scan_rate = daqpams['scan_rate']
+        self.num_samples = daqpams['samples_per_channel']
+        self.timeout = daqpams['timeout']
+        self.subsample = subsample
+        self.backends = open_backends(daqpams, self.polarimeters, **backend_kwargs)
+        self.readers = {address: StreamReader(backend, self.scan_rate) for address, backend in self.backends.items()}
+        self.cursors = {p.name: 0 for p in self.polarimeters}
+        self.rotations = {p.name: 0 for p in self.polarimeters}
+
+        if workers is None:
+            workers = min(len(self.polarimeters), os.cpu_count() or 1)
+        # Workers are spawned rather than forked, since the reader threads are running by the time they start.
+        self.pool = None
+        if workers > 0:
+            self.pool = concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def start(self):
+        '''Starts the scan of every hat and waits until each has a block of samples.'''
+        for reader in self.readers.values():
+            reader.start()
+        for reader in self.readers.values():
+            reader.wait_for_samples(self.num_samples, self.timeout)
+
+    def step(self):
+        '''Processes every complete rotation acquired since the previous call, for every polarimeter.
+
+        Returns {name: (records, S, warnings)} (see process_rotations); polarimeters without a new complete
+        rotation are left out.
+        '''
+        tasks = {}
+        for p in self.polarimeters:
+            reader = self.readers[p.address]
+            backend = self.backends[p.address]
+            raw_data, self.cursors[p.name] = reader.read_rotations(self.cursors[p.name], backend.column(p.trigger))
+            if raw_data is None:
+                continue
+            # The block ends with the sample after the trigger edge the cursor now points at.
+            first_time = float(reader.sample_time(self.cursors[p.name] + 2 - len(raw_data)))
+            args = (p, raw_data[:, backend.column(p.photodiode)], raw_data[:, backend.column(p.trigger)],
+                    first_time, self.scan_rate, self.subsample)
+            tasks[p.name] = self.pool.submit(process_rotations, *args) if self.pool is not None else process_rotations(*args)
+
+        results = {name: task.result() if self.pool is not None else task for name, task in tasks.items()}
+        for name, (records, _, _) in results.items():
+            self.rotations[name] += len(records)
+        return results
+
+    def overruns(self):
+        '''DAQ overruns so far per hat address.'''
+        return {address: reader.overruns for address, reader in self.readers.items()}
+
+    def stop(self):
+        '''Stops the scans and the worker processes.'''
+        for reader in self.readers.values():
+            reader.stop()
+        if self.pool is not None:
+            self.pool.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Monitor every polarimeter listed in daqsettings.json at once.')
+    parser.add_argument('--output-dir', default=None, help='write a binary Stokes log <name>.npy per polarimeter here')
+    parser.add_argument('--duration', type=float, default=0, help='run time in seconds (default: until interrupted)')
+    parser.add_argument('--interval', type=float, default=None, help='time between frames [s] (default: samples_per_channel/scan_rate)')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: one per polarimeter, up to the core count)')
+    parser.add_argument('--status-interval', type=float, default=1, help='time between status lines [s]')
+    args = parser.parse_args()
+
+    daqpams = swpsettings.load_or_exit('daq')
+    monitor = MultiMonitor(daqpams, args.workers)
+    interval = daqpams['samples_per_channel']/daqpams['scan_rate'] if args.interval is None else args.interval
+
+    loggers = {}
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+        loggers = {p.name: swplog.StokesLogger(os.path.join(args.output_dir, f'{p.name}.npy')) for p in monitor.polarimeters}
+    print(f"Monitoring {', '.join(f'{p.name} (hat {p.address}, channels {p.photodiode}/{p.trigger})' for p in monitor.polarimeters)}")
+
+    latest = {}
+    frames = 0
+    monitor.start()
+    t_start = time.perf_counter()
+    last_status = t_start
+    try:
+        while args.duration <= 0 or time.perf_counter() - t_start < args.duration:
+            t0 = time.perf_counter()
+            for name, (records, S, warnings) in monitor.step().items():
+                latest[name] = (S, warnings)
+                if name in loggers:
+                    loggers[name].log_many(records)
+            frames += 1
+
+            if time.perf_counter() - last_status >= args.status_interval:
+                last_status = time.perf_counter()
+                for name, (S, warnings) in latest.items():
+                    print(f"{name}: {monitor.rotations[name]} rotations, S = {np.round(S, 3)}, DOP {round(float(np.sqrt(np.sum(S[1:]**2))),3)}"
+                          f"{'  warnings: ' + ', '.join(warnings) if warnings else ''}", flush=True)
+            time.sleep(max(0, interval - (time.perf_counter() - t0)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        monitor.stop()
+        for logger in loggers.values():
+            logger.close()
+
+    elapsed = time.perf_counter() - t_start
+    print(f'Processed {frames} frames in {round(elapsed,2)} s: '
+          + ', '.join(f'{name} {count} rotations ({round(count/elapsed,1)}/s)' for name, count in monitor.rotations.items())
+          + f'; overruns {monitor.overruns()}')
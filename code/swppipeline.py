@@ -0,0 +1,216 @@
+"""
+Acquire -> compute -> render pipeline.
+
+Acquisition and Stokes computation run in their own threads, connected by bounded queues, so neither waits on
+the display. The renderer pulls the latest computed result at whatever rate it manages. Every queue counts the
+items it dropped and the time producers spent blocked on it, and every stage its rate and busy fraction, so
+the bottleneck stage can be read off the stats.
+"""
+import collections
+import threading
+import time
+
+
+class BoundedQueue:
+    '''Thread-safe queue of at most maxsize items.
+
+    - drop_oldest: when full, discard the oldest item (counted in `dropped`) instead of blocking the producer.
+      Otherwise put() blocks until there is room and the waiting time is accumulated in `blocked_time`.
+    '''
+    def __init__(self, maxsize, drop_oldest = False):
+        self.maxsize = maxsize
+        self.drop_oldest = drop_oldest
+        self.items = collections.deque()
+        self.cond = threading.Condition()
+        self.puts = 0
+        self.dropped = 0
+        self.blocked_time = 0.0
+        self.max_depth = 0
+
+    def put(self, item, stop_event = None):
+        '''Adds an item. Returns False if stop_event was set while waiting for room.'''
+        with self.cond:
+            if len(self.items) >= self.maxsize:
+                if self.drop_oldest:
+                    self.items.popleft()
+                    self.dropped += 1
+                else:
+                    t0 = time.perf_counter()
+                    while len(self.items) >= self.maxsize:
+                        if stop_event is not None and stop_event.is_set():
+                            return False
+                        self.cond.wait(0.1)
+                    self.blocked_time += time.perf_counter() - t0
+            self.items.append(item)
+            self.puts += 1
+            self.max_depth = max(self.max_depth, len(self.items))
+            self.cond.notify_all()
+        return True
+
+    def get(self, timeout = None):
+        '''Removes and returns the oldest item, or None if nothing arrived within timeout seconds.'''
+        with self.cond:
+            if not self.cond.wait_for(lambda: len(self.items) > 0, timeout):
+                return None
+            item = self.items.popleft()
+            self.cond.notify_all()
+            return item
+
+    def get_latest(self):
+        '''Removes every queued item and returns the newest one (None if empty). Skipped items count as dropped.'''
+        with self.cond:
+            if not self.items:
+                return None
+            self.dropped += len(self.items) - 1
+            item = self.items.pop()
+            self.items.clear()
+            self.cond.notify_all()
+            return item
+
+    def stats(self):
+        with self.cond:
+            return {'depth': len(self.items), 'max_depth': self.max_depth, 'puts': self.puts,
+                    'dropped': self.dropped, 'blocked_s': round(self.blocked_time, 3)}
+
+
+class Stage(threading.Thread):
+    '''Pipeline stage thread calling fn repeatedly.
+
+    A source stage (inq is None) calls fn() and is expected to pace itself (e.g. by waiting on the DAQ).
+    Other stages call fn(item) for every item taken from inq. Results other than None are put on outq.
+
+    An exception from fn is counted and the call retried after a delay that doubles with every consecutive
+    failure, from retry_delay up to max_retry_delay [s]. After max_errors consecutive failures the stage stops,
+    keeps the last exception in `error` and calls on_failure(stage) (Pipeline uses it to stop every stage).
+    '''
+    def __init__(self, name, fn, inq = None, outq = None, verbose = True, max_errors = 10, retry_delay = 0.01,
+                 max_retry_delay = 1.0, on_failure = None):
+        super().__init__(name=name, daemon=True)
+        self.fn = fn
+        self.inq = inq
+        self.outq = outq
+        self.verbose = verbose
+        self.max_errors = max_errors
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.on_failure = on_failure
+        self.stop_event = threading.Event()
+        self.processed = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.error = None
+        self.busy_time = 0.0
+        self.started_at = None
+
+    def run(self):
+        self.started_at = time.perf_counter()
+        while not self.stop_event.is_set():
+            if self.inq is None:
+                args = ()
+            else:
+                item = self.inq.get(timeout=0.1)
+                if item is None:
+                    continue
+                args = (item,)
+
+            t0 = time.perf_counter()
+            try:
+                result = self.fn(*args)
+            except Exception as err:
+                self.busy_time += time.perf_counter() - t0
+                self._handle_error(err)
+                continue
+            self.busy_time += time.perf_counter() - t0
+
+            self.consecutive_errors = 0
+            self.processed += 1
+            if result is not None and self.outq is not None:
+                self.outq.put(result, self.stop_event)
+
+    def _handle_error(self, err):
+        '''Counts a failed call, then waits before the retry or gives up after max_errors in a row.'''
+        self.errors += 1
+        self.consecutive_errors += 1
+        self.error = err
+        if self.consecutive_errors >= self.max_errors:
+            if self.verbose:
+                print(f'Stopping {self.name} stage after {self.consecutive_errors} consecutive errors: {err}')
+            self.stop_event.set()
+            if self.on_failure is not None:
+                self.on_failure(self)
+            return
+        if self.verbose:
+            print(f'Error in {self.name} stage: {err}')
+        self.stop_event.wait(min(self.retry_delay*2**(self.consecutive_errors - 1), self.max_retry_delay))
+
+    def stats(self):
+        elapsed = time.perf_counter() - self.started_at if self.started_at else 0
+        return {'processed': self.processed, 'errors': self.errors,
+                'rate_hz': round(self.processed/elapsed, 2) if elapsed > 0 else 0.0,
+                'busy': round(self.busy_time/elapsed, 3) if elapsed > 0 else 0.0}
+
+
+class Pipeline:
+    '''Acquisition and computation stages feeding the latest result to a renderer.
+
+    - acquire: callable returning one raw data item per call, paced by the acquisition itself
+    - compute: callable turning a raw data item into a result
+    - queue_size: capacity of the acquire -> compute queue. When the computation falls behind, acquisition
+      blocks on it (backpressure, reported as blocked_s) rather than silently losing data.
+    - result_queue_size: capacity of the compute -> render queue. Results the renderer never picked up are
+      dropped oldest first and counted.
+    - max_errors: consecutive errors after which a stage gives up and the whole pipeline stops (see Stage and
+      `failed`)
+    '''
+    def __init__(self, acquire, compute, queue_size = 4, result_queue_size = 2, verbose = True, max_errors = 10):
+        self.raw_queue = BoundedQueue(queue_size)
+        self.result_queue = BoundedQueue(result_queue_size, drop_oldest=True)
+        self.stages = [Stage('acquire', acquire, outq=self.raw_queue, verbose=verbose, max_errors=max_errors, on_failure=self._on_failure),
+                       Stage('compute', compute, inq=self.raw_queue, outq=self.result_queue, verbose=verbose,
+                             max_errors=max_errors, on_failure=self._on_failure)]
+        self.rendered = 0
+        # Stage that stopped the pipeline after repeated errors, if any.
+        self.failed = None
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def stop(self):
+        for stage in self.stages:
+            stage.stop_event.set()
+        for stage in self.stages:
+            stage.join()
+
+    def _on_failure(self, stage):
+        # Called from the failing stage's thread, so the stages are only told to stop, not joined.
+        if self.failed is None:
+            self.failed = stage
+        for other in self.stages:
+            other.stop_event.set()
+
+    def latest(self):
+        '''Returns the newest computed result not yet rendered, or None.'''
+        result = self.result_queue.get_latest()
+        if result is not None:
+            self.rendered += 1
+        return result
+
+    def stats(self):
+        '''Per-stage and per-queue counters as a dict.'''
+        stats = {stage.name: stage.stats() for stage in self.stages}
+        stats['raw_queue'] = self.raw_queue.stats()
+        stats['result_queue'] = self.result_queue.stats()
+        stats['rendered'] = self.rendered
+        if self.failed is not None:
+            stats['failed'] = f'{self.failed.name}: {self.failed.error}'
+        return stats
+
+    def summary(self):
+        '''One line summary of the stats for display.'''
+        if self.failed is not None:
+            return f'pipeline stopped: {self.failed.name} stage failed {self.failed.consecutive_errors} times in a row ({self.failed.error})'
+        s = self.stats()
+        return (f"acq {s['acquire']['rate_hz']} Hz ({int(100*s['acquire']['busy'])}% busy, blocked {s['raw_queue']['blocked_s']} s) | "
+                f"compute {s['compute']['rate_hz']} Hz ({int(100*s['compute']['busy'])}% busy) | "
+                f"render {s['rendered']} frames, {s['result_queue']['dropped']} results dropped")
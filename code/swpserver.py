@@ -0,0 +1,223 @@
+"""
+Live Stokes publishing over a local socket.
+
+StokesServer runs an asyncio server in a background thread, listening on TCP ('host:port') or on a Unix socket
+('unix:/path'). The processing loop hands it every computed frame with publish(), which never waits on the network:
+the records are passed to the event loop, encoded once and copied to a bounded queue per subscriber. A subscriber
+that reads too slowly loses the oldest frames of its queue (counted as dropped) and is disconnected if a write
+stays stuck for stall_timeout seconds, so one stalled client cannot hold up the measurement or the other clients.
+
+Frames are sent as
+- 'json': one line per record, {"timestamp", "S0", "S1", "S2", "S3", "DOP", "warnings"}
+- 'binary': the records packed as swplog.RECORD_DTYPE (6 little-endian float64, 48 bytes each), without warnings
+
+subscribe() reads the stream from another program. Usage: python swpserver.py 127.0.0.1:5800 (prints the frames
+published by polvis --serve 127.0.0.1:5800)
+"""
+import argparse
+import asyncio
+import json
+import math
+import socket
+import threading
+import numpy as np
+from swplog import RECORD_DTYPE
+
+FORMATS = ('json', 'binary')
+
+
+def parse_address(address):
+    '''('unix', path) for 'unix:/path', or ('tcp', (host, port)) for 'host:port' (host defaults to 127.0.0.1).'''
+    if address.startswith('unix:'):
+        return 'unix', address[len('unix:'):]
+    host, sep, port = address.rpartition(':')
+    if not sep or not port.isdigit():
+        raise ValueError(f'Invalid server address {address} (expected host:port or unix:/path)')
+    return 'tcp', (host or '127.0.0.1', int(port))
+
+
+def encode(records, warnings = '', fmt = 'json'):
+    '''Wire format of one frame of Stokes records (see the module docstring).'''
+    records = np.asarray(records, dtype=RECORD_DTYPE)
+    if fmt == 'binary':
+        return records.tobytes()
+    lines = []
+    for r in records.tolist():
+        entry = dict(zip(RECORD_DTYPE.names, (v if math.isfinite(v) else None for v in r)))
+        entry['warnings'] = warnings
+        lines.append(json.dumps(entry))
+    return ('\n'.join(lines) + '\n').encode() if lines else b''
+
+
+class Subscriber:
+    '''A connected client and its queue of encoded frames.'''
+    def __init__(self, writer, queue_size):
+        self.writer = writer
+        self.peer = writer.get_extra_info('peername')
+        self.queue = asyncio.Queue(queue_size)
+        self.sent = 0
+        self.dropped = 0
+        self.task = None
+
+    def offer(self, payload):
+        '''Queues a frame, discarding the oldest queued one if the client is behind.'''
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(payload)
+
+
+class StokesServer:
+    '''Publishes Stokes frames to every client connected to a local socket.
+
+    - address: 'host:port' for TCP (port 0 picks a free one, see bound_address) or 'unix:/path'
+    - fmt: 'json' or 'binary' (see the module docstring)
+    - queue_size: frames held per client before the oldest are dropped
+    - stall_timeout: time [s] a write may stay blocked before its client is disconnected
+    '''
+    def __init__(self, address, fmt = 'json', queue_size = 64, stall_timeout = 2.0):
+        if fmt not in FORMATS:
+            raise ValueError(f'Unknown stream format: {fmt} (expected one of {FORMATS})')
+        self.address = address
+        self.kind, self.target = parse_address(address)
+        self.fmt = fmt
+        self.queue_size = queue_size
+        self.stall_timeout = stall_timeout
+        self.subscribers = set()
+        self.bound_address = None
+        self.published = 0
+        self.dropped = 0
+        self.disconnected = 0
+        self.loop = None
+        self._ready = threading.Event()
+        self._error = None
+        self._thread = None
+
+    def start(self):
+        '''Starts the server thread and waits until the socket is listening. Raises OSError if it cannot bind.'''
+        self._thread = threading.Thread(target=self._run, name='stokes-server', daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+
+    def publish(self, records, warnings = ''):
+        '''Sends a frame of Stokes records (swplog.RECORD_DTYPE) to every client. Safe to call from any thread and
+        returns immediately; records must not be modified afterwards.'''
+        if self.loop is None or not self.subscribers or not len(records):
+            return
+        self.loop.call_soon_threadsafe(self._broadcast, records, warnings)
+
+    def stats(self):
+        '''Frames published, frames dropped for slow clients and clients connected and disconnected so far.'''
+        return {'clients': len(self.subscribers), 'published': self.published,
+                'dropped': self.dropped + sum(s.dropped for s in list(self.subscribers)),
+                'disconnected': self.disconnected}
+
+    def stop(self):
+        '''Disconnects every client and stops the server thread.'''
+        if self.loop is not None and self._thread.is_alive():
+            self.loop.call_soon_threadsafe(self._stopping.set)
+            self._thread.join()
+
+    def _run(self):
+        loop = asyncio.new_event_loop()
+        self.loop = loop
+        try:
+            loop.run_until_complete(self._serve())
+        finally:
+            loop.close()
+
+    async def _serve(self):
+        self._stopping = asyncio.Event()
+        try:
+            if self.kind == 'unix':
+                server = await asyncio.start_unix_server(self._handle, path=self.target)
+            else:
+                server = await asyncio.start_server(self._handle, *self.target)
+        except OSError as err:
+            self._error = err
+            self.loop = None
+            self._ready.set()
+            return
+        self.bound_address = server.sockets[0].getsockname()
+        self._ready.set()
+
+        await self._stopping.wait()
+        server.close()
+        for subscriber in list(self.subscribers):
+            subscriber.task.cancel()
+        await asyncio.gather(*(s.task for s in list(self.subscribers)), return_exceptions=True)
+        await server.wait_closed()
+
+    def _broadcast(self, records, warnings):
+        payload = encode(records, warnings, self.fmt)
+        for subscriber in self.subscribers:
+            subscriber.offer(payload)
+        self.published += 1
+
+    async def _handle(self, reader, writer):
+        subscriber = Subscriber(writer, self.queue_size)
+        subscriber.task = asyncio.current_task()
+        self.subscribers.add(subscriber)
+        sock = writer.get_extra_info('socket')
+        if sock is not None and sock.family != socket.AF_UNIX:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            while True:
+                payload = await subscriber.queue.get()
+                writer.write(payload)
+                await asyncio.wait_for(writer.drain(), self.stall_timeout)
+                subscriber.sent += 1
+        except asyncio.TimeoutError:
+            # The client stopped reading: discard what is still buffered for it.
+            writer.transport.abort()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.subscribers.discard(subscriber)
+            self.dropped += subscriber.dropped
+            self.disconnected += 1
+            writer.close()
+            try:
+                await asyncio.wait_for(writer.wait_closed(), self.stall_timeout)
+            except (asyncio.TimeoutError, ConnectionError):
+                writer.transport.abort()
+
+
+def subscribe(address, fmt = 'json', timeout = None):
+    '''Connects to a StokesServer and yields its frames as they arrive: a dict per record ('json') or an array of
+    records ('binary'). Stops when the server closes the connection.'''
+    kind, target = parse_address(address)
+    sock = socket.socket(socket.AF_UNIX if kind == 'unix' else socket.AF_INET, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    sock.connect(target)
+    with sock:
+        if fmt == 'json':
+            with sock.makefile('r') as stream:
+                for line in stream:
+                    yield json.loads(line)
+            return
+        pending = b''
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return
+            pending += chunk
+            complete = len(pending)//RECORD_DTYPE.itemsize*RECORD_DTYPE.itemsize
+            if complete:
+                yield np.frombuffer(pending[:complete], dtype=RECORD_DTYPE)
+                pending = pending[complete:]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print the Stokes frames published by polvis --serve.')
+    parser.add_argument('address', help='server address, host:port or unix:/path')
+    parser.add_argument('--format', default='json', choices=FORMATS, help='stream format the server was started with')
+    args = parser.parse_args()
+
+    try:
+        for item in subscribe(args.address, args.format):
+            print(item, flush=True)
+    except KeyboardInterrupt:
+        pass
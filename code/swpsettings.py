@@ -0,0 +1,182 @@
+"""
+Shared access to the daq, swp and sim settings files.
+
+load() reads a settings file, checks that the required entries are present with the right types, fills in the
+optional ones that older files may lack and caches the result; later calls only stat the file and re-read it if
+it changed on disk, so they are cheap enough to make every frame. changed() tells whether a file was modified
+since it was last loaded (e.g. a calibration script updated swpsettings while polvis is running) and save()
+writes a file back and updates the cache. Scripts use load_or_exit(), which prints the usual hint to run
+gen_default_json.py instead of a traceback.
+"""
+import copy
+import json
+import os
+import sys
+import threading
+
+SETTINGS_FILES = {'daq': 'settings/daqsettings.json',
+                  'swp': 'settings/swpsettings.json',
+                  'sim': 'settings/simsettings.json'}
+
+_NUMBER = (int, float)
+_REQUIRED = object()
+
+# Entry name -> (accepted types, default). Entries without a default must be in the file.
+SCHEMAS = {
+    'daq': {'samples_per_channel': (int, _REQUIRED),
+            'scan_rate': (_NUMBER, _REQUIRED),
+            'channels': (list, _REQUIRED),
+            'timeout': (_NUMBER, _REQUIRED),
+            'backend': (str, 'mcc118'),
+            'polarimeters': (list, [])},
+    'swp': {'trigger_phase': (_NUMBER, _REQUIRED),
+            'wp_phi': (_NUMBER, _REQUIRED),
+            'bg_level': (_NUMBER, _REQUIRED),
+            'subsample_edges': (bool, False),
+            'auto_scale_y_trace': (bool, False),
+            'log_data_file': (str, ''),
+            'protect_overwrite': (bool, True)},
+    'sim': {'sim_digitize': (_NUMBER, _REQUIRED),
+            'sim_siglevel': (_NUMBER, _REQUIRED),
+            'sim_ns_level': (_NUMBER, _REQUIRED),
+            'sim_DOP': (_NUMBER, _REQUIRED),
+            'sim_bg_level': (_NUMBER, _REQUIRED),
+            'sim_wp_phi': (_NUMBER, _REQUIRED),
+            'sim_trigger_phase': (_NUMBER, _REQUIRED),
+            'sim_poltype': (str, _REQUIRED),
+            'sim_speed_drift': (_NUMBER, 0),
+            'sim_drift_period': (_NUMBER, 60),
+            'sim_jitter': (_NUMBER, 0),
+            'sim_trigger_noise': (_NUMBER, 0),
+            'sim_trigger_bounce': (_NUMBER, 0),
+            'sim_missed_triggers': (_NUMBER, 0),
+            'sim_clip_V': (_NUMBER, 10)},
+}
+
+# Entries that must be strictly positive.
+POSITIVE = {'samples_per_channel', 'scan_rate', 'timeout', 'sim_drift_period'}
+
+
+class SettingsError(ValueError):
+    '''A settings file is missing entries or has entries of the wrong type.'''
+
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def settings_path(kind, path = None):
+    '''Path of the settings file of the given kind ('daq', 'swp' or 'sim'), unless path is given.'''
+    if kind not in SCHEMAS:
+        raise ValueError(f'Unknown settings kind: {kind}')
+    return SETTINGS_FILES[kind] if path is None else path
+
+
+def validate(kind, params, path = '<settings>'):
+    '''Checks params against the schema of kind and returns a copy with the missing optional entries filled in.'''
+    params = copy.deepcopy(params)
+    errors = []
+    for name, (types, default) in SCHEMAS[kind].items():
+        if name not in params:
+            if default is _REQUIRED:
+                errors.append(f'missing {name}')
+            else:
+                params[name] = default
+            continue
+        value = params[name]
+        # bool is an int subclass, but true/false is never a valid number here.
+        if not isinstance(value, types) or (isinstance(value, bool) and types is not bool):
+            errors.append(f'{name} should be {_type_names(types)}, not {type(value).__name__}')
+        elif name in POSITIVE and value <= 0:
+            errors.append(f'{name} should be positive')
+    if kind == 'daq':
+        errors += _polarimeter_errors(params)
+    if errors:
+        raise SettingsError(f'Invalid settings file {path}: ' + ', '.join(errors))
+    return params
+
+
+def load(kind, path = None):
+    '''Returns the validated settings of the given kind, re-reading the file only if it changed since the last call.
+
+    The returned dict is a copy, so callers can modify it without affecting the cache.
+    Raises FileNotFoundError if the file does not exist and SettingsError if it is invalid.
+    '''
+    path = settings_path(kind, path)
+    key = os.path.abspath(path)
+    stamp = _stamp(path)
+    with _lock:
+        cached = _cache.get(key)
+        if cached is None or cached[0] != stamp:
+            with open(path, 'r') as f:
+                try:
+                    params = json.load(f)
+                except json.JSONDecodeError as err:
+                    raise SettingsError(f'Invalid settings file {path}: {err}') from None
+            cached = (stamp, validate(kind, params, path))
+            _cache[key] = cached
+        return copy.deepcopy(cached[1])
+
+
+def changed(kind, path = None):
+    '''True if the settings file was modified (or never loaded) since the last load().'''
+    path = settings_path(kind, path)
+    with _lock:
+        cached = _cache.get(os.path.abspath(path))
+    try:
+        return cached is None or cached[0] != _stamp(path)
+    except FileNotFoundError:
+        return True
+
+
+def save(kind, params, path = None):
+    '''Validates params and writes them to the settings file of the given kind, replacing it atomically.'''
+    path = settings_path(kind, path)
+    params = validate(kind, params, path)
+    with _lock:
+        with open(path + '.tmp', 'w') as f:
+            json.dump(params, f)
+        os.replace(path + '.tmp', path)
+        _cache[os.path.abspath(path)] = (_stamp(path), params)
+
+
+def load_or_exit(kind, path = None):
+    '''load() for scripts: prints what is wrong and exits instead of raising.'''
+    path = settings_path(kind, path)
+    try:
+        return load(kind, path)
+    except FileNotFoundError:
+        print(f'Error: settings file {path} not found.')
+        print('Run \'gen_default_json.py\' to generate default file first.')
+    except SettingsError as err:
+        print(f'Error: {err}')
+    sys.exit(1)
+
+
+def _polarimeter_errors(params):
+    '''Checks the channel layout of daq settings: 'channels' or every entry of 'polarimeters' needs distinct
+    photodiode and trigger channels 0-7.'''
+    errors = []
+    channels = params.get('channels')
+    if isinstance(channels, list) and not params['polarimeters'] and len(channels) < 2:
+        errors.append('channels should list the photodiode and trigger channels')
+    for k, entry in enumerate(params['polarimeters'] if isinstance(params['polarimeters'], list) else []):
+        if not isinstance(entry, dict):
+            errors.append(f'polarimeters[{k}] should be an object')
+            continue
+        pair = [entry.get('photodiode'), entry.get('trigger')]
+        if not all(isinstance(chan, int) and not isinstance(chan, bool) and 0 <= chan < 8 for chan in pair):
+            errors.append(f'polarimeters[{k}] needs photodiode and trigger channels 0-7')
+        elif pair[0] == pair[1]:
+            errors.append(f'polarimeters[{k}] uses channel {pair[0]} as both photodiode and trigger')
+    return errors
+
+
+def _stamp(path):
+    '''Modification time and size of a file, which change whenever it is rewritten.'''
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _type_names(types):
+    return ' or '.join(t.__name__ for t in types) if isinstance(types, tuple) else types.__name__
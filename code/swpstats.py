@@ -0,0 +1,180 @@
+"""
+Per-stage performance statistics.
+
+Code to be measured is wrapped in `with stats.stage('name'):`. Every stage keeps a latency histogram with
+log-spaced bins (fixed memory however long the run) along with count, total and maximum, so percentiles and the
+share of time per stage can be read at any point. Per-frame counters (frames/sec, samples dropped, chunks per
+frame, points per chunk) are kept alongside. summary() gives a few lines for an on-screen overlay and dump()
+writes everything as JSON, periodically with maybe_dump().
+
+NullStats has the same interface and does nothing, so instrumented code costs one method call per stage when
+statistics are disabled.
+"""
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+import numpy as np
+from swpjitter import RunningStats
+
+
+class LatencyHistogram:
+    '''Latency distribution of one stage, in log-spaced bins from min_s to max_s (bins_per_decade per decade).
+
+    Values outside the range are counted in the first or last bin; count, total and max are exact.
+    '''
+    def __init__(self, min_s = 1e-6, max_s = 10, bins_per_decade = 10):
+        self.log_min = np.log10(min_s)
+        self.bins_per_decade = bins_per_decade
+        num_bins = int(round((np.log10(max_s) - self.log_min)*bins_per_decade))
+        self.edges = 10**(self.log_min + np.arange(num_bins + 1)/bins_per_decade)
+        self.counts = np.zeros(num_bins, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        k = int((np.log10(max(seconds, 1e-12)) - self.log_min)*self.bins_per_decade)
+        self.counts[min(max(k, 0), len(self.counts) - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q):
+        '''Upper edge of the bin holding the q-th percentile [s] (within one bin width, about 26%).'''
+        if self.count == 0:
+            return np.nan
+        k = np.searchsorted(np.cumsum(self.counts), q/100*self.count)
+        return min(self.edges[min(k, len(self.counts) - 1) + 1], self.max)
+
+    def to_dict(self):
+        nonzero = np.nonzero(self.counts)[0]
+        return {'count': self.count, 'mean_ms': 1e3*self.total/self.count if self.count else None,
+                'p50_ms': 1e3*self.percentile(50) if self.count else None,
+                'p95_ms': 1e3*self.percentile(95) if self.count else None,
+                'p99_ms': 1e3*self.percentile(99) if self.count else None,
+                'max_ms': 1e3*self.max, 'total_s': self.total,
+                # Sparse histogram: upper bin edge [ms] -> count.
+                'histogram': {f'{1e3*self.edges[k+1]:.4g}': int(self.counts[k]) for k in nonzero}}
+
+
+class Stats:
+    '''Stage latencies and frame counters of a running acquisition.
+
+    - dump_file: JSON file written by maybe_dump() every dump_interval seconds (None disables)
+    - rate_window: time over which frames/sec is measured [s]
+    '''
+    enabled = True
+
+    def __init__(self, dump_file = None, dump_interval = 10, rate_window = 5):
+        self.dump_file = dump_file
+        self.dump_interval = dump_interval
+        self.rate_window = rate_window
+        self.stages = collections.OrderedDict()
+        self.frames = 0
+        self.samples = 0
+        self.samples_dropped = 0
+        self.chunks = RunningStats()
+        self.ppc = RunningStats()
+        self.started_at = time.time()
+        self.extra = {}
+        self._frame_times = collections.deque(maxlen=10000)
+        self._lock = threading.Lock()
+        self._last_dump = time.monotonic()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''Context manager timing the enclosed code as stage name.'''
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - t0)
+
+    def record(self, name, seconds):
+        '''Adds a latency measured elsewhere to stage name.'''
+        with self._lock:
+            histogram = self.stages.get(name)
+            if histogram is None:
+                histogram = self.stages[name] = LatencyHistogram()
+            histogram.add(seconds)
+
+    def frame(self, samples = 0, chunks = None, ppc = None):
+        '''Counts a processed frame of samples samples with its number of chunks and mean points per chunk.'''
+        with self._lock:
+            self.frames += 1
+            self.samples += samples
+            self._frame_times.append(time.monotonic())
+            if chunks is not None:
+                self.chunks.update([chunks])
+            if ppc is not None and ppc > 0:
+                self.ppc.update([ppc])
+
+    def dropped(self, samples):
+        '''Counts samples that were acquired but never processed (e.g. overwritten before they were read).'''
+        if samples > 0:
+            with self._lock:
+                self.samples_dropped += int(samples)
+
+    def fps(self):
+        '''Frames per second over the last rate_window seconds.'''
+        with self._lock:
+            now = time.monotonic()
+            recent = [t for t in self._frame_times if now - t <= self.rate_window]
+        if len(recent) < 2:
+            return 0.0
+        return (len(recent) - 1)/max(recent[-1] - recent[0], 1e-9)
+
+    def summary(self):
+        '''A few lines for an on-screen overlay: frame rate and counters, then median/p95 latency per stage.'''
+        fps = self.fps()
+        with self._lock:
+            stages = [(name, h.percentile(50), h.percentile(95)) for name, h in self.stages.items()]
+            lines = [f'{fps:.1f} frames/s   chunks/frame {self.chunks.mean:.1f}   PPC {self.ppc.mean:.0f}   '
+                     f'dropped {self.samples_dropped} samples']
+        lines += [f'{name:<15} {1e3*p50:7.2f} ms  p95 {1e3*p95:7.2f} ms' for name, p50, p95 in stages]
+        return '\n'.join(lines)
+
+    def to_dict(self):
+        fps = self.fps()
+        with self._lock:
+            return {'started_at': self.started_at, 'updated_at': time.time(), 'frames': self.frames,
+                    'frames_per_s': fps, 'samples': self.samples, 'samples_dropped': self.samples_dropped,
+                    'chunks_per_frame': self.chunks.to_dict(), 'ppc': self.ppc.to_dict(),
+                    'stages': {name: h.to_dict() for name, h in self.stages.items()}, **self.extra}
+
+    def dump(self, path = None):
+        '''Writes the statistics as JSON to path (default dump_file), replacing the previous dump atomically.'''
+        path = self.dump_file if path is None else path
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+        os.replace(path + '.tmp', path)
+        self._last_dump = time.monotonic()
+
+    def maybe_dump(self):
+        '''dump() if dump_interval seconds have passed since the previous one.'''
+        if self.dump_file is not None and time.monotonic() - self._last_dump > self.dump_interval:
+            self.dump()
+
+
+class NullStats:
+    '''Stand-in for Stats when instrumentation is disabled: every call returns immediately.'''
+    enabled = False
+    _null_stage = contextlib.nullcontext()
+
+    def stage(self, name):
+        return self._null_stage
+
+    def record(self, name, seconds):
+        pass
+
+    def frame(self, samples = 0, chunks = None, ppc = None):
+        pass
+
+    def dropped(self, samples):
+        pass
+
+    def maybe_dump(self):
+        pass
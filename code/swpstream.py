@@ -0,0 +1,210 @@
+"""
+Gap-free streaming acquisition from a DAQ backend (see daqbackend.py).
+
+A single CONTINUOUS scan is started once and drained by a background thread into a preallocated ring buffer,
+so the hat keeps sampling while frames are being processed and displayed. Consumers pull either the latest
+samples or every complete rotation since their last read.
+"""
+import threading
+import time
+import numpy as np
+import swptools as swp
+from daqbackend import READ_ALL_AVAILABLE
+
+
+class RingBuffer:
+    '''Preallocated circular buffer of multi-channel samples addressed by absolute sample index.
+
+    - capacity: number of samples per channel kept
+    - num_channels: number of interleaved channels in each written block
+    '''
+    def __init__(self, capacity, num_channels):
+        self.capacity = int(capacity)
+        self.num_channels = num_channels
+        self.data = np.zeros((self.capacity, num_channels))
+        # Absolute index of the next sample to be written, and of the first sample after the last discontinuity.
+        self.total_written = 0
+        self.valid_from = 0
+        self.lock = threading.Lock()
+
+    def write(self, block):
+        '''Appends an interleaved (or samples x channels) block, overwriting the oldest samples when full.'''
+        block = np.asarray(block, dtype=float).reshape(-1, self.num_channels)
+        # Only the last capacity samples of a longer block are kept, but every sample counts towards the indices.
+        dropped = max(len(block) - self.capacity, 0)
+        block = block[dropped:]
+        with self.lock:
+            start = (self.total_written + dropped) % self.capacity
+            first = min(len(block), self.capacity - start)
+            self.data[start:start+first] = block[:first]
+            self.data[:len(block)-first] = block[first:]
+            self.total_written += dropped + len(block)
+
+    def mark_discontinuity(self):
+        '''Flags that the next sample does not follow on from the previous one (e.g. after an overrun).'''
+        with self.lock:
+            self.valid_from = self.total_written
+
+    def oldest(self):
+        '''Absolute index of the oldest contiguous sample still held.'''
+        return max(self.total_written - self.capacity, self.valid_from)
+
+    def read(self, start, stop):
+        '''Returns a copy of samples [start, stop) as a samples x channels array, clamped to what is held.'''
+        with self.lock:
+            start = max(start, self.oldest())
+            stop = min(stop, self.total_written)
+            idx = np.arange(start, max(stop, start)) % self.capacity
+            return self.data[idx], start
+
+    def latest(self, num_samples):
+        '''Returns the most recent num_samples samples (fewer if not yet available).'''
+        stop = self.total_written
+        return self.read(stop - num_samples, stop)[0]
+
+
+class StreamReader(threading.Thread):
+    '''Runs one CONTINUOUS scan and drains it from a dedicated thread into a RingBuffer.
+
+    - backend: opened DAQBackend; its channels are interleaved in the ring buffer in ascending channel order
+    - scan_rate: samples per second per channel
+    - buffer_seconds: length of history kept in the ring buffer
+    - hat_buffer_seconds: size of the hat's own scan buffer
+    - poll_interval: sleep between reads when the hat buffer is empty [s]
+    - recorder: optional swprecord.RawRecorder receiving every block drained from the hat
+
+    Hardware and buffer overruns stop the scan. They are counted in `overruns`, reported to the terminal,
+    marked as a discontinuity in the ring buffer and the scan is restarted.
+    '''
+    def __init__(self, backend, scan_rate, buffer_seconds = 10, hat_buffer_seconds = 1, poll_interval = 0.01, verbose = True, recorder = None):
+        super().__init__(daemon=True)
+        self.backend = backend
+        self.num_channels = backend.num_channels
+        self.scan_rate = scan_rate
+        self.hat_buffer_size = int(scan_rate*hat_buffer_seconds)
+        self.poll_interval = poll_interval
+        self.verbose = verbose
+        self.ring = RingBuffer(scan_rate*buffer_seconds, self.num_channels)
+        self.recorder = recorder
+        self.overruns = 0
+        self.error = None
+        # (wall-clock time, absolute sample index) at the latest scan (re)start, see sample_time.
+        self.time_anchor = (time.time(), 0)
+        self._discontinuity = False
+        self._stop_event = threading.Event()
+
+    def run(self):
+        self._start_scan()
+        try:
+            while not self._stop_event.is_set():
+                read_result = self.backend.scan_read(READ_ALL_AVAILABLE, 0)
+                if read_result.hardware_overrun or read_result.buffer_overrun:
+                    self._handle_overrun(read_result)
+                    continue
+                if len(read_result.data) == 0:
+                    time.sleep(self.poll_interval)
+                    continue
+                self._store(read_result.data)
+        except Exception as err:
+            self.error = err
+            if self.verbose:
+                print(f'Error: streaming acquisition stopped ({err})')
+        finally:
+            self._stop_scan()
+
+    def stop(self):
+        '''Stops the reader thread and the scan.'''
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+
+    def wait_for_samples(self, num_samples, timeout = 5):
+        '''Blocks until num_samples contiguous samples are available. Returns False on timeout.'''
+        deadline = time.monotonic() + timeout
+        while self.ring.total_written - self.ring.oldest() < num_samples:
+            if time.monotonic() > deadline or self.error is not None:
+                return False
+            time.sleep(self.poll_interval)
+        return True
+
+    def wait_until(self, sample_index, timeout = 5):
+        '''Blocks until the absolute sample index sample_index has been acquired. Returns False on timeout.'''
+        deadline = time.monotonic() + timeout
+        while self.ring.total_written < sample_index:
+            if time.monotonic() > deadline or self.error is not None:
+                return False
+            time.sleep(self.poll_interval)
+        return True
+
+    def latest(self, num_samples):
+        '''Returns the most recent num_samples samples as a samples x channels array.'''
+        return self.ring.latest(num_samples)
+
+    def latest_rotations(self, num_rotations, trigger_channel = 1, **chunk_kwargs):
+        '''Returns the samples spanning the latest num_rotations complete rotations (None if not yet available).
+
+        The block starts at a trigger edge and ends with the sample after the closing edge, so extract_chunks on its
+        trigger column finds num_rotations+1 edges. Extra keyword arguments are passed to extract_chunks (see
+        _block_edges for subsample).
+        '''
+        block = self.ring.latest(self.ring.capacity)
+        edges = _block_edges(block[:, trigger_channel], chunk_kwargs)
+        if len(edges) < num_rotations + 1:
+            return None
+        return block[edges[-num_rotations-1]:edges[-1]+2]
+
+    def read_rotations(self, start, trigger_channel = 1, **chunk_kwargs):
+        '''Returns every complete rotation acquired since absolute sample index start.
+
+        Returns (block, next_start). block is None when fewer than one complete rotation is available. Passing
+        next_start to the following call continues from the last trigger edge, so consecutive blocks cover the
+        signal without gaps or overlap (other than the shared edge sample). Extra keyword arguments are passed to
+        extract_chunks (see _block_edges for subsample).
+        '''
+        block, start = self.ring.read(start, self.ring.total_written)
+        edges = _block_edges(block[:, trigger_channel], chunk_kwargs)
+        if len(edges) < 2:
+            return None, start
+        return block[edges[0]:edges[-1]+2], start + edges[-1]
+
+    def _store(self, data):
+        self.ring.write(data)
+        if self.recorder is not None:
+            self.recorder.write(data, discontinuity=self._discontinuity)
+        self._discontinuity = False
+
+    def sample_time(self, sample_index):
+        '''Returns the wall-clock time [s since epoch] at which absolute sample sample_index was acquired.
+
+        Counted at scan_rate from the latest scan (re)start, so it is exact for samples since the last overrun.
+        '''
+        anchor_time, anchor_index = self.time_anchor
+        return anchor_time + (np.asarray(sample_index) - anchor_index)/self.scan_rate
+
+    def _start_scan(self):
+        self.backend.scan_start(self.hat_buffer_size, self.scan_rate, continuous=True)
+        self.time_anchor = (time.time(), self.ring.total_written)
+
+    def _stop_scan(self):
+        self.backend.scan_stop()
+        self.backend.scan_cleanup()
+
+    def _handle_overrun(self, read_result):
+        self.overruns += 1
+        kind = 'hardware' if read_result.hardware_overrun else 'buffer'
+        if self.verbose:
+            print(f'Warning: DAQ {kind} overrun ({self.overruns} so far), restarting scan.')
+        # Keep whatever was read before the overrun, then restart with a discontinuity marker.
+        if len(read_result.data):
+            self._store(read_result.data)
+        self.ring.mark_discontinuity()
+        self._discontinuity = True
+        self._stop_scan()
+        self._start_scan()
+
+
+def _block_edges(trigger_data, chunk_kwargs):
+    '''Trigger edges of extract_chunks as sample indices to cut blocks at. Fractional edges (subsample=True) are
+    floored to the sample before each crossing, so a block cut there keeps the samples either side of its first and
+    last crossing and extract_chunks(subsample=True) on it finds the same fractional edges.'''
+    return np.floor(swp.extract_chunks(trigger_data, **chunk_kwargs)).astype(int)
@@ -1,26 +1,177 @@
+import functools
+import itertools
 import numpy as np
-import scipy.integrate as integ
 
-def extract_chunks(trigger_data, threshold = 1, schmidt = 10, TEST=[]):
+# Number of (chunk length, trigger phase) demodulation bases kept by the LRU cache.
+DEMOD_CACHE_SIZE = 64
+# Below this many chunks, chunk_coefficients demodulates chunk by chunk: grouping and gathering the chunks of each
+# length only pays off from about 10 chunks (3 per frame with the default settings).
+BATCH_MIN_CHUNKS = 10
+# Chunks demodulated on fractional borders, which bypass the cache (see demod_cache_info).
+_fractional_chunks = 0
+
+# Trigger edge mode of new calibrations (see subsample_edges). The trigger phase depends on where the edges are placed,
+# so calibrate_trigger_delay.py stores the mode with it (subsample_edges in swpsettings) and polvis, swpmulti and the
+# replay of recordings use the stored mode; mixing modes gives S1/S2 crosstalk. Integer edges keep the cached bases
+# (see demod_cache_info) and match calibrations made before the mode was stored.
+SUBSAMPLE_EDGES = False
+
+def extract_chunks(trigger_data, threshold = 1, schmidt = 10, TEST=[], num_channels = 1, channel = 0, subsample = False):
     '''Partitions wave data into chunks.
 
     - number of chunks is proportional to the spinning waveplate's frequency.
+    - trigger_data: trigger trace, or the raw interleaved read_result.data when num_channels > 1
+    - threshold: minimum sample-to-sample jump counted as a trigger edge
+    - schmidt: deadzone (in samples) after an edge during which further edges are suppressed
+    - num_channels, channel: interleaving of trigger_data; the trigger is taken from data[channel::num_channels]
+    - subsample: return fractional edge positions (see subsample_edges) instead of integer sample indices
     '''
-    triggers = np.array([])
-    deadzone = 0
+    # Strided view into the interleaved block, no intermediate list is built.
+    trigger_data = np.asarray(trigger_data, dtype=float)[channel::num_channels]
 
-    # deadzone is a buffer of arbitrary length to prevent the same delta being read twice, creating micro chunks.
-    for d in range(len(trigger_data)-1):
-        deadzone = max(0, deadzone-1)
-        # iterates along trigger_data until difference jumps dramatically (delta > 1).
-        # TODO: could be better implemented using the diff() function?
-        if trigger_data[d+1] - trigger_data[d] > threshold and deadzone == 0:
-            #print(f'Data around trigger y1: {TEST[d-5:d+5:1]}')
-            #print(f'Data around trigger y2: {trigger_data[d-2:d+5:1]}')
-            triggers = np.append(triggers,int(d))
-            deadzone = schmidt
+    # Every sample-to-sample jump larger than threshold is a candidate edge.
+    candidates = np.flatnonzero(np.diff(trigger_data) > threshold)
+    edges = _apply_deadzone(candidates, schmidt).astype(int)
 
-    return triggers.astype(int)
+    if subsample:
+        return subsample_edges(trigger_data, edges, schmidt)
+    return edges
+
+
+def subsample_edges(trigger_data, edges, search = 10):
+    '''Refines integer trigger edges from extract_chunks to fractional sample positions.
+
+    The edge is placed where the trigger crosses the level halfway between its low and high state, interpolated
+    linearly between the two samples either side of the crossing. The crossing is searched from one sample before
+    each edge to search samples after it, which covers Hall signals with a slow rise. Edges without a crossing in
+    that window keep their integer position plus one half (the unbiased estimate for an instantaneous step).
+    '''
+    trigger_data = np.asarray(trigger_data, dtype=float)
+    edges = np.asarray(edges, dtype=int)
+    if len(edges) == 0:
+        return edges.astype(float)
+
+    level = (np.min(trigger_data) + np.max(trigger_data))/2
+
+    # (edges) x (window) indices of the samples before each candidate crossing.
+    window = np.clip(edges[:, None] + np.arange(-1, max(search, 1)), 0, len(trigger_data) - 2)
+    before = trigger_data[window]
+    after = trigger_data[window + 1]
+    crossing = (before < level) & (after >= level)
+    found = crossing.any(axis=1)
+    first = np.argmax(crossing, axis=1)
+
+    rows = np.arange(len(edges))
+    j = window[rows, first]
+    lo, hi = before[rows, first], after[rows, first]
+    fraction = (level - lo)/np.where(hi > lo, hi - lo, 1)
+
+    return np.where(found, j + fraction, edges + 0.5)
+
+
+def _apply_deadzone(candidates, schmidt):
+    '''Drops candidate edges falling inside the deadzone of a previously accepted edge.
+
+    The deadzone is a buffer of arbitrary length to prevent the same delta being read twice, creating micro chunks.
+    An edge is accepted when it lies at least schmidt samples after the last accepted edge.
+    '''
+    if schmidt <= 1 or len(candidates) < 2:
+        return candidates
+
+    # Candidates further than schmidt from their predecessor are always accepted. Only clusters of close
+    # candidates spanning more than the deadzone need the sequential rule, and those are rare and short.
+    gaps = np.diff(candidates)
+    if np.all(gaps >= schmidt):
+        return candidates
+
+    starts = np.flatnonzero(np.r_[True, gaps >= schmidt])
+    ends = np.r_[starts[1:], len(candidates)]
+    keep = np.zeros(len(candidates), dtype=bool)
+    keep[starts] = True
+
+    long_clusters = candidates[ends-1] - candidates[starts] >= schmidt
+    for s, e in zip(starts[long_clusters], ends[long_clusters]):
+        last = candidates[s]
+        for k in range(s+1, e):
+            if candidates[k] - last >= schmidt:
+                keep[k] = True
+                last = candidates[k]
+
+    return candidates[keep]
+
+
+class EdgeTracker:
+    '''Streaming counterpart of extract_chunks for a trigger trace read block by block.
+
+    feed() returns the absolute sample indices of the edges in each new block, identical to what extract_chunks
+    would find on the whole trace: the last sample and the last accepted edge are carried over, so edges
+    straddling two blocks and deadzones reaching into the next block are handled. Memory use is constant.
+    '''
+    def __init__(self, threshold = 1, schmidt = 10):
+        self.threshold = threshold
+        self.schmidt = schmidt
+        self.reset()
+
+    def reset(self, samples_seen = None):
+        '''Forgets the carried-over state, e.g. after a discontinuity. Optionally sets the absolute sample index
+        of the next block.'''
+        self.last_sample = None
+        self.last_edge = None
+        if samples_seen is not None:
+            self.samples_seen = samples_seen
+        elif not hasattr(self, 'samples_seen'):
+            self.samples_seen = 0
+
+    def feed(self, trigger_data):
+        '''Returns the absolute indices of the edges found in the next block of the trigger trace.'''
+        trigger_data = np.asarray(trigger_data, dtype=float)
+        if len(trigger_data) == 0:
+            return np.zeros(0, dtype=int)
+
+        if self.last_sample is None:
+            trace, offset = trigger_data, self.samples_seen
+        else:
+            trace, offset = np.r_[self.last_sample, trigger_data], self.samples_seen - 1
+        candidates = np.flatnonzero(np.diff(trace) > self.threshold) + offset
+
+        if self.last_edge is not None:
+            # The previous accepted edge leads, so its deadzone applies to this block; it is dropped again after.
+            edges = _apply_deadzone(np.r_[self.last_edge, candidates], self.schmidt)[1:]
+        else:
+            edges = _apply_deadzone(candidates, self.schmidt)
+
+        self.samples_seen += len(trigger_data)
+        self.last_sample = trigger_data[-1]
+        if len(edges):
+            self.last_edge = edges[-1]
+        return edges.astype(int)
+
+
+def remove_background(photodiode_data, bg_level):
+    '''Photodiode signal with the background light (bg_level from swpsettings) removed: rectified, then offset once.
+    polvis, swpmulti and the replay of raw recordings all go through this so they report the same numbers.'''
+    return np.abs(photodiode_data) - bg_level
+
+
+def frame_warnings(input_data, borders, DOP, subsample = False, check_voltage = True):
+    '''Warnings about a processed block (background removed) and its chunk borders, as shown by polvis: too few points
+    per rotation (60 with fractional edges, 180 otherwise), unphysical DOP, too little light, fewer than 3 complete
+    chunks and, with check_voltage (live data), a signal outside the 2-10 V input range. Returns a list of strings.'''
+    num_chunks = len(borders) - 1
+    Nroll = np.mean(np.diff(borders)) if num_chunks > 0 else 0
+    mean_signal = np.mean(input_data)
+    warnings = []
+    if Nroll < (60 if subsample else 180):
+        warnings.append(f'PPC too low ({int(Nroll)})')
+    if DOP - 1 > .03:
+        warnings.append(f'Unphysical DOP ({round(DOP,3)})')
+    if mean_signal < 0.08:
+        warnings.append('Light level too low')
+    if num_chunks < 3:
+        warnings.append('Insufficient chunks')
+    if check_voltage and (mean_signal < 2 or np.max(input_data) > 10):
+        warnings.append('Signal voltage out of range (adjust gain)')
+    return warnings
 
 
 def get_stokes_from_chunk(chunk, wp_ret = np.pi/2, phs_ofst = 0, verbose = True):
@@ -38,15 +189,9 @@ Returns:
     stokes_vector (array_like): Calculated Stokes vector containing the four Stokes parameters S0, S1, S2, and S3.
     '''
 
-    a0,b0,c0,d0,n0 = 0,0,0,0,0
-    wt = np.linspace(0,2*np.pi,len(chunk))
-
-    # Calculating coefficients of equation (21) in polarimeter_analysis.pdf
-    a0 = integ.simpson(chunk,x=wt)/(2*np.pi)
-    n0 = integ.simpson(chunk*np.cos(2*(wt-phs_ofst)),x=wt)/np.pi   # not found in eq. (21) -- used for alignment check
-    b0 = integ.simpson(chunk*np.sin(2*(wt-phs_ofst)),x=wt)/np.pi
-    c0 = integ.simpson(chunk*np.cos(4*(wt-phs_ofst)),x=wt)/np.pi
-    d0 = integ.simpson(chunk*np.sin(4*(wt-phs_ofst)),x=wt)/np.pi
+    # Calculating coefficients of equation (21) in polarimeter_analysis.pdf as one 5xN dot product
+    # with the cached Simpson-weighted basis. n0 is not found in eq. (21) -- used for alignment check.
+    a0,n0,b0,c0,d0 = _demod_basis(len(chunk), phs_ofst) @ np.asarray(chunk, dtype=float)
 
     cos_delta = np.cos(wp_ret)
     sin_delta = np.sin(wp_ret)
@@ -74,64 +219,415 @@ Returns:
     return np.array([S0,S1,S2,S3])/normalization_factor
 
 
+def get_stokes_from_chunks(data, borders, wp_ret = np.pi/2, phs_ofst = 0, verbose = True):
+    '''Batched version of get_stokes_from_chunk. Demodulates every chunk of a data block in one vectorized pass.
+
+Chunks are the slices data[borders[k]:borders[k+1]] as returned by extract_chunks. Chunks of equal length are
+stacked and projected onto the Simpson-weighted 0, 2w and 4w kernels with a single matrix product, so the
+result is the same as calling get_stokes_from_chunk on each chunk in turn. Fractional borders from
+extract_chunks(subsample=True) are integrated over the exact angle between edges instead.
+
+Parameters:
+    data (array_like): Photodiode trace (background already subtracted).
+    borders (array_like): Chunk border indices (integer or fractional) from extract_chunks.
+    wp_ret (float): The waveplate retardance from swpsettings (default = pi/2).
+    phs_ofst (float): Trigger phase delay from swpsettings (default = 0).
+    verbose (boolean): Enables logging (currently to terminal).
+
+Returns:
+    stokes_vectors (ndarray): N x 4 array of normalized Stokes vectors, one row per chunk.
+    stokes_mean (ndarray): Frame average of the per-chunk Stokes vectors (NaN if there are no chunks).
+    '''
+    coeffs = chunk_coefficients(data, borders, phs_ofst)
+    stokes_vectors = _stokes_from_coefficients(coeffs, wp_ret, verbose)
+    if len(coeffs) == 0:
+        return stokes_vectors, np.full(4, np.nan)
+
+    return stokes_vectors, stokes_vectors.mean(axis=0)
+
+
+def chunk_coefficients(data, borders, phs_ofst = 0):
+    '''Returns the N x 5 coefficients [a0, n0, b0, c0, d0] of equation (21) for every chunk data[borders[k]:borders[k+1]].
+
+    Chunks of equal length are stacked and projected onto the cached demodulation basis with one matrix product
+    (one product per chunk below BATCH_MIN_CHUNKS chunks, where that is faster). Fractional (floating point) borders, as returned by extract_chunks(subsample=True), are demodulated on the
+    true angle grid instead (see _fractional_chunk_coefficients).
+    '''
+    data = np.asarray(data, dtype=float)
+    if np.issubdtype(np.asarray(borders).dtype, np.floating):
+        return _fractional_chunk_coefficients(data, np.asarray(borders), phs_ofst)
+    borders = np.asarray(borders, dtype=int)
+    num_chunks = max(len(borders)-1, 0)
+
+    coeffs = np.zeros((num_chunks, 5))
+    starts = borders[:-1]
+    lengths = np.diff(borders)
+    if num_chunks < BATCH_MIN_CHUNKS:
+        for k in range(num_chunks):
+            coeffs[k] = _demod_basis(lengths[k], phs_ofst) @ data[starts[k]:borders[k+1]]
+        return coeffs
+    for length in np.unique(lengths):
+        sel = lengths == length
+        # (chunks of this length) x length block of samples, projected in one product.
+        block = data[starts[sel, None] + np.arange(length)]
+        coeffs[sel] = block @ _demod_basis(length, phs_ofst).T
+
+    return coeffs
+
+
+def _fractional_chunk_coefficients(data, borders, phs_ofst):
+    '''Coefficients of chunks with fractional borders, integrated over the exact rotation between edges.
+
+    Sample n of the chunk starting at border e_k has angle 2pi*(n - e_k)/(e_{k+1} - e_k). The signal at the borders
+    themselves is interpolated between the neighbouring samples, so every chunk covers exactly 0..2pi and no
+    sample of phase is lost at either end. The trapezoid rule on this non-uniform grid is evaluated for all chunks
+    at once.
+    '''
+    global _fractional_chunks
+    num_chunks = max(len(borders)-1, 0)
+    if num_chunks == 0:
+        return np.zeros((0, 5))
+    _fractional_chunks += num_chunks
+
+    periods = np.diff(borders)
+    points = np.union1d(np.arange(np.ceil(borders[0]), np.floor(borders[-1]) + 1), borders)
+    values = np.interp(points, np.arange(len(data)), data)
+
+    # Points are sorted, so each chunk is the contiguous run between the positions of its two borders. A border
+    # gets angle 0 of the chunk it opens (2pi of the last chunk for the final border), which is the same point of
+    # the periodic kernels either way.
+    border_pos = np.searchsorted(points, borders)
+    points_per_chunk = np.diff(border_pos)
+    chunk_start = np.repeat(borders[:-1], points_per_chunk)
+    rad_per_sample = np.repeat(2*np.pi/periods, points_per_chunk)
+    wt = np.r_[(points[:-1] - chunk_start)*rad_per_sample, 2*np.pi] - phs_ofst
+
+    cos2 = np.cos(2*wt)
+    sin2 = np.sin(2*wt)
+    integrands = values*np.vstack([np.ones_like(wt), cos2, sin2, 2*cos2**2 - 1, 2*sin2*cos2])
+
+    # Trapezoid segments between consecutive points, summed per chunk.
+    dwt = np.diff(points)*rad_per_sample
+    segments = (integrands[:, :-1] + integrands[:, 1:])*dwt/2
+    coeffs = np.add.reduceat(segments, border_pos[:-1], axis=1).T
+    coeffs[:, 0] /= 2*np.pi
+    coeffs[:, 1:] /= np.pi
+    return coeffs
+
+
+def calibrate_trigger_phase(traces, **chunk_kwargs):
+    '''Finds the trigger phase delay at which the cos(2w) component of the signal vanishes.
+
+Each trace is reduced to the sums C and S of the cos(2wt) and sin(2wt) projections of its chunks (taken at zero
+phase, so once per chunk). The alignment term n0(phs) = C cos(2 phs) + S sin(2 phs) then has its zero crossings in
+closed form at phs = (atan2(S, C) + pi/2)/2 + k pi/2, and the smallest one in [0, pi/2) is used, as the brute force
+search in calibrate_trigger_delay.py did. Traces are averaged as angles with period pi/2 so results straddling
+0 and pi/2 do not bias the mean.
+
+Parameters:
+    traces (iterable): (input_data, trigger_data) pairs, one per acquisition.
+    chunk_kwargs: Passed on to extract_chunks.
+
+Returns:
+    phase (float): Calibrated trigger phase [rad].
+    standard_error (float): Standard error of the phase across traces [rad].
+    trace_phases (ndarray): Phase found for each trace with at least one complete chunk.
+    '''
+    trace_phases = []
+    for input_data, trigger_data in traces:
+        borders = extract_chunks(trigger_data, **chunk_kwargs)
+        if len(borders) < 2:
+            continue
+        coeffs = chunk_coefficients(input_data, borders, 0)
+        C, S = coeffs[:, 1].sum(), coeffs[:, 2].sum()
+        trace_phases.append(np.mod((np.arctan2(S, C) + np.pi/2)/2, np.pi/2))
+
+    trace_phases = np.array(trace_phases)
+    if len(trace_phases) == 0:
+        return np.nan, np.nan, trace_phases
+
+    # Circular mean and spread with period pi/2 (angles scaled by 4 onto the unit circle).
+    resultant = np.mean(np.exp(4j*trace_phases))
+    phase = np.mod(np.angle(resultant)/4, np.pi/2)
+    spread = np.sqrt(-2*np.log(min(np.abs(resultant), 1)))/4
+
+    return phase, spread/np.sqrt(len(trace_phases)), trace_phases
+
+
+def get_stokes_lockin(data, borders, wp_ret = np.pi/2, phs_ofst = 0, verbose = True):
+    '''Whole-block lock-in alternative to chunked Simpson integration.
+
+Every sample is tagged with a rotation angle interpolated linearly between the trigger edges (and extrapolated
+with the neighbouring rotation period before the first and after the last edge). The whole block is then
+least-squares projected onto the 0, 2w and 4w harmonics of equation (21) in one pass, so the partial rotations
+at both ends of the block contribute instead of being thrown away.
+
+Parameters:
+    data (array_like): Photodiode trace (background already subtracted).
+    borders (array_like): Trigger edge indices from extract_chunks, at least two are needed.
+    wp_ret (float): The waveplate retardance from swpsettings (default = pi/2).
+    phs_ofst (float): Trigger phase delay from swpsettings (default = 0).
+    verbose (boolean): Enables logging (currently to terminal).
+
+Returns:
+    stokes_vector (array_like): Normalized Stokes vector for the whole block (NaN if fewer than two edges).
+    '''
+    data = np.asarray(data, dtype=float)
+    borders = np.asarray(borders, dtype=float)
+    if len(borders) < 2:
+        if verbose:
+            print('Error! Lock-in demodulation needs at least two trigger edges.')
+        return np.full(4, np.nan)
+
+    wt = rotation_angle(len(data), borders) - phs_ofst
+
+    # cos/sin of 4(wt-phs) follow from the 2(wt-phs) terms by the double angle identities.
+    cos2 = np.cos(2*wt)
+    sin2 = np.sin(2*wt)
+    design = np.column_stack([np.ones_like(wt), cos2, sin2, 2*cos2**2 - 1, 2*sin2*cos2])
+
+    # Least squares fit of data = a0 + n0 cos2 + b0 sin2 + c0 cos4 + d0 sin4 via the 5x5 normal equations.
+    coeffs = np.linalg.solve(design.T @ design, design.T @ data)
+
+    return _stokes_from_coefficients(coeffs, wp_ret, verbose)[0]
+
+
+def rotation_angle(num_samples, borders):
+    '''Returns the waveplate angle (radians, unwrapped) of each of num_samples samples given trigger edge positions.
+
+    The angle is 2pi*k at the k-th edge and is interpolated linearly in between. Samples outside the first and
+    last edge are extrapolated using the period of the first and last rotation respectively.
+    '''
+    borders = np.asarray(borders, dtype=float)
+    samples = np.arange(num_samples)
+    rotation = np.interp(samples, borders, np.arange(len(borders)))
+
+    head = samples < borders[0]
+    tail = samples > borders[-1]
+    rotation[head] = (samples[head] - borders[0])/(borders[1] - borders[0])
+    rotation[tail] = len(borders) - 1 + (samples[tail] - borders[-1])/(borders[-1] - borders[-2])
+
+    return 2*np.pi*rotation
+
+
+class RollingStokes:
+    '''Running Stokes estimate updated once per rotation.
+
+    Keeps running sums of the per-rotation coefficients [a0, n0, b0, c0, d0] of equation (21), so every new rotation
+    updates the estimate in constant time and consecutive frames share all earlier work. Coefficients are averaged
+    before conversion, i.e. the estimate is that of the averaged signal.
+
+    - wp_ret, phs_ofst: waveplate retardance and trigger phase delay from swpsettings
+    - mode: 'sliding' (mean of the last window rotations) or 'exponential' (time constant time_constant [s])
+    - window: number of rotations averaged in sliding mode
+    - time_constant: time constant of the exponential average [s]; each rotation is weighted by its duration
+    '''
+    def __init__(self, wp_ret = np.pi/2, phs_ofst = 0, mode = 'sliding', window = 85, time_constant = 1.0, verbose = False):
+        if mode not in ('sliding', 'exponential'):
+            raise ValueError(f'Unknown averaging mode: {mode}')
+        self.wp_ret = wp_ret
+        self.phs_ofst = phs_ofst
+        self.mode = mode
+        self.window = int(window)
+        self.time_constant = time_constant
+        self.verbose = verbose
+        self.reset()
+
+    def reset(self):
+        '''Discards the averaging history.'''
+        self.history = np.zeros((self.window, 5))
+        self.total = np.zeros(5)
+        self.count = 0
+        self.average = None
+        self.rotations = 0
+
+    def update(self, coeffs, durations = None):
+        '''Adds the N x 5 coefficients of N consecutive rotations (and their durations [s], needed in exponential mode).
+
+        Returns the N x 4 normalized Stokes estimates available after each of the rotations.
+        '''
+        coeffs = np.atleast_2d(np.asarray(coeffs, dtype=float))
+        estimates = np.zeros((len(coeffs), 5))
+        if self.mode == 'sliding':
+            for k, c in enumerate(coeffs):
+                slot = self.rotations % self.window
+                self.total += c - self.history[slot]
+                self.history[slot] = c
+                self.count = min(self.count + 1, self.window)
+                self.rotations += 1
+                # Re-sum once per window so rounding errors of the running sum cannot accumulate.
+                if slot == self.window - 1:
+                    self.total = self.history.sum(axis=0)
+                estimates[k] = self.total/self.count
+        else:
+            if durations is None:
+                raise ValueError('Exponential averaging needs the duration of each rotation.')
+            weights = 1 - np.exp(-np.asarray(durations, dtype=float)/self.time_constant)
+            for k, c in enumerate(coeffs):
+                self.average = c.copy() if self.average is None else self.average + weights[k]*(c - self.average)
+                self.rotations += 1
+                estimates[k] = self.average
+
+        if len(coeffs) == 0:
+            return np.zeros((0, 4))
+        return _stokes_from_coefficients(estimates, self.wp_ret, self.verbose)
+
+    def feed(self, data, borders, scan_rate):
+        '''Demodulates the chunks of a block (see chunk_coefficients) and adds them. Returns the per-rotation estimates.'''
+        return self.update(chunk_coefficients(data, borders, self.phs_ofst), np.diff(borders)/scan_rate)
+
+    def latest(self):
+        '''Returns the current normalized Stokes estimate (NaN before the first rotation).'''
+        if self.rotations == 0:
+            return np.full(4, np.nan)
+        current = self.total/self.count if self.mode == 'sliding' else self.average
+        return _stokes_from_coefficients(current, self.wp_ret, False)[0]
+
+
+def get_frame_stokes(data, borders, wp_ret = np.pi/2, phs_ofst = 0, engine = 'chunked', verbose = True):
+    '''Returns the normalized Stokes vector of a data block using the selected demodulation engine.
+
+    - engine: 'chunked' averages get_stokes_from_chunks over the complete chunks between triggers,
+      'lockin' uses get_stokes_lockin over the whole block including partial rotations.
+    '''
+    if engine == 'lockin':
+        return get_stokes_lockin(data, borders, wp_ret, phs_ofst, verbose)
+    elif engine == 'chunked':
+        return get_stokes_from_chunks(data, borders, wp_ret, phs_ofst, verbose)[1]
+    else:
+        raise ValueError(f'Unknown Stokes engine: {engine}')
+
+
+def demod_cache_info():
+    '''Returns hit/miss counters and occupancy of the demodulation basis cache as a dict.
+
+    Chunks with fractional borders (extract_chunks(subsample=True)) are demodulated without the cache and counted
+    in 'fractional_chunks', so a run that never touches the cache shows it.
+    '''
+    info = _demod_basis.cache_info()
+    return {'hits': info.hits, 'misses': info.misses, 'size': info.currsize, 'maxsize': info.maxsize,
+            'fractional_chunks': _fractional_chunks}
+
+
+def demod_cache_clear():
+    '''Empties the demodulation basis cache and resets its counters. polvis calls this when the calibration changes.'''
+    global _fractional_chunks
+    _demod_basis.cache_clear()
+    _fractional_chunks = 0
+
+
+@functools.lru_cache(maxsize = DEMOD_CACHE_SIZE)
+def _demod_basis(length, phs_ofst):
+    '''Returns the 5 x length projection matrix giving the coefficients a0, n0, b0, c0, d0 of equation (21) for a chunk.
+
+    Each row is a Simpson weight vector over wt = linspace(0, 2pi, length) multiplied by its 0, 2w or 4w kernel.
+    Results are cached on (length, phs_ofst): chunk lengths only vary by a few samples around
+    scan_rate/rotation_rate and the trigger phase rarely changes, so nearly every chunk is a cache hit.
+    '''
+    # scipy is only needed here, once per cached basis, so importing it lazily keeps it out of startup.
+    import scipy.integrate as integ
+
+    wt = np.linspace(0,2*np.pi,length)
+    # Simpson weights are the integrals of the unit vectors, which matches integ.simpson exactly for any length.
+    weights = integ.simpson(np.eye(length), x=wt, axis=-1)
+
+    basis = np.vstack([weights/(2*np.pi),
+                       weights*np.cos(2*(wt-phs_ofst))/np.pi,
+                       weights*np.sin(2*(wt-phs_ofst))/np.pi,
+                       weights*np.cos(4*(wt-phs_ofst))/np.pi,
+                       weights*np.sin(4*(wt-phs_ofst))/np.pi])
+    # Shared between callers through the cache, so it must not be modified in place.
+    basis.setflags(write=False)
+
+    return basis
+
+
+def _stokes_from_coefficients(coeffs, wp_ret, verbose = True):
+    '''Converts rows of coefficients [a0, n0, b0, c0, d0] into normalized Stokes vectors (equations (22a-d)).'''
+    coeffs = np.atleast_2d(coeffs)
+
+    cos_delta = np.cos(wp_ret)
+    sin_delta = np.sin(wp_ret)
+
+    # Equations (22a-d) are linear in the coefficients, so all rows are converted with one 5 x 4 product:
+    # S1 = 4*c0/(1-cos_delta), S2 = 4*d0/(1-cos_delta), S3 = -2*b0/sin_delta, S0 = 2*a0 - (1+cos_delta)*S1/2.
+    to_stokes = np.zeros((5, 4))
+    to_stokes[0, 0] = 2
+    to_stokes[3, 0] = -2*(1+cos_delta)/(1-cos_delta)
+    to_stokes[3, 1] = 4/(1-cos_delta)
+    to_stokes[4, 2] = 4/(1-cos_delta)
+    to_stokes[2, 3] = -2/sin_delta
+    S = coeffs @ to_stokes
+    S0 = S[:, 0]
+
+    # The checks only print, so they are skipped on the quiet (per-frame) path.
+    if verbose:
+        if np.any(S0 == 0):
+            print('Error! S0 = 0. Something went terribly wrong! (Intensity (S0) is zero!)')
+        n0 = coeffs[:, 1]
+        misaligned = n0 > np.sqrt(np.sum(S[:, 1:]**2, axis=1))*1e-3
+        if np.any(misaligned):
+            print(f'Warning, large cos(2w) conponent detected in {np.count_nonzero(misaligned)} chunk(s) (max {np.max(n0)}). Check alignment!')
+
+    return S/np.where(S0 == 0, 1, S0)[:, None]
+
+
 def get_polarization_ellipse(S, num_points = 200, scale_by_dop = True, verbose = True):
-    '''Given an array of Stokes vectors, return x,y points for their polarization ellipse. 
+    '''Given a Stokes vector, or an (M,4) array of Stokes vectors, return x,y points for their polarization ellipse.
 
-    - num_points: number of points in x,y arrays
+    - num_points: number of points per half ellipse (x,y arrays hold 2*num_points points)
     - scale_by_dop: Scale down ellipse for partial polarization
     - verbose: enable logging (currently to terminal)
+
+    For a single Stokes vector x and y have shape (2*num_points,), for an (M,4) array they have shape (M, 2*num_points).
     '''
-    DOP = np.sqrt(S[1]**2 + S[2]**2 + S[3]**2)/S[0]
-    S = S/S[0]
-    for stokes_vector in S:
-        if abs(stokes_vector) > 1:
-            if verbose:
-                print(f'WARNING: S[{np.where(S[::]==stokes_vector)[0][0]}] is greater than 100% Clipping to 1.')
-            stokes_vector = stokes_vector/abs(stokes_vector)
+    S = np.asarray(S, dtype=float)
+    single = S.ndim == 1
+    S = np.atleast_2d(S)
+
+    DOP = np.sqrt(S[:,1]**2 + S[:,2]**2 + S[:,3]**2)/S[:,0]
+    S = S/S[:,:1]
+    if verbose:
+        for idx in np.flatnonzero(np.any(np.abs(S) > 1, axis=0)):
+            print(f'WARNING: S[{idx}] is greater than 100% Clipping to 1.')
 
     if scale_by_dop:
-        S1 = S[1]/DOP
-        S2 = S[2]/DOP
-        S3 = S[3]/DOP
+        S1 = S[:,1]/DOP
+        S2 = S[:,2]/DOP
+        S3 = S[:,3]/DOP
     else:
-        S1 = S[1]
-        S2 = S[2]
-        S3 = S[3]
+        S1 = S[:,1]
+        S2 = S[:,2]
+        S3 = S[:,3]
 
     psi = 0.5*np.arctan2(S2,S1)
-    chi = 0.5*np.arcsin(S3)
+    chi = 0.5*np.arcsin(np.clip(S3, -1, 1))
 
-    # TODO: Find out what 'a' is supposed to be doing... only used in b/a.. which is just b... ???
-    a = 1
-    b = np.tan(chi)
-
-    ba = b/a
-    rot = np.matrix([[np.cos(psi), -1*np.sin(psi)],
-                     [np.sin(psi), np.cos(psi)]])
-    x1, x2, y1, y2 = [], [], [], []
+    # Semi-major axis is 1, so the semi-minor axis over semi-major axis ratio is just tan(chi).
+    ba = np.tan(chi)[:, None]
+    cos_psi = np.cos(psi)[:, None]
+    sin_psi = np.sin(psi)[:, None]
 
     #create an x array for plotting ellipse y values
-    x = np.linspace(-a, a, num_points)
-
-    for x in x:
-        #cartesian equation of an ellipse
-        Y1 = ba*np.sqrt(a**2-x**2)
-        #Y1 reflection about the x-axis
-        #rotate the ellipse by psi
-        XY1 = np.matrix([[x],
-                         [Y1]])
-        XY2 = np.matrix([[x],
-                         [-Y1]])
-        y1.append(float((rot*XY1)[1]))
-        x1.append(float((rot*XY1)[0]))
-        y2.append(float((rot*XY2)[1]))
-        x2.append(float((rot*XY2)[0]))
+    x = np.linspace(-1, 1, num_points)
+
+    #cartesian equation of an ellipse, and its reflection about the x-axis
+    Y1 = ba*np.sqrt(1-x**2)
+    Y2 = -Y1
+
+    #rotate the ellipse by psi
+    x1 = x*cos_psi - Y1*sin_psi
+    y1 = x*sin_psi + Y1*cos_psi
+    x2 = x*cos_psi - Y2*sin_psi
+    y2 = x*sin_psi + Y2*cos_psi
 
     #x2, y2 reversed in order so that there is continuity in the ellipse (no line through the middle)
-    x = (x1+x2[::-1])
-    y = (y1+y2[::-1])
+    x = np.concatenate([x1, x2[:, ::-1]], axis=1)*DOP[:, None]
+    y = np.concatenate([y1, y2[:, ::-1]], axis=1)*DOP[:, None]
 
-    return np.array(x)*DOP, np.array(y)*DOP
+    if single:
+        return x[0], y[0]
+    return x, y
 
 
 #TODO: It might be nice to pull all simulation calculations out of polvis.py
@@ -139,7 +635,7 @@ def get_polarization_ellipse(S, num_points = 200, scale_by_dop = True, verbose =
 #      it without having to dig through multiple files. polvis.py can just have
 #      one call that returns multiple values that are then used. This will also 
 #      help keep polvis.py clean and straight forward for more generic users.
-def simulate_polarization_data(sim_S, w, t, sig_level = 1, ns_level = 0, digitize_mV = 0, v_bias = 0, dphi = np.pi/2, ofst = 0):
+def simulate_polarization_data(sim_S, w, t, sig_level = 1, ns_level = 0, digitize_mV = 0, v_bias = 0, dphi = np.pi/2, ofst = 0, rng = None, clip_V = 0):
     """Generates simulated polarization data from a given simulated array of Stokes vectors.
         - w: sim angular frequency
         - t: sim time domain
@@ -149,6 +645,8 @@ def simulate_polarization_data(sim_S, w, t, sig_level = 1, ns_level = 0, digitiz
         - v_bias: sim background voltage from ambient light on photodiode
         - dphi: sim waveplate retardance
         - ofst: sim trigger phase offset
+        - rng: np.random.Generator for the noise (default: the global numpy random state)
+        - clip_V: sim ADC input range, the trace saturates at +/-clip_V (0 disables)
         Output:
         - trace: simulated array of input voltages from photodiode
     """
@@ -160,11 +658,209 @@ def simulate_polarization_data(sim_S, w, t, sig_level = 1, ns_level = 0, digitiz
     c = (1-np.cos(dphi))*sim_S[1]/4
     d = (1-np.cos(dphi))*sim_S[2]/4
 
-    ns = ns_level*np.random.randn(num_points)
+    ns = ns_level*(np.random.randn(num_points) if rng is None else rng.standard_normal(num_points))
     trace = (a + b*np.sin(2*(w*t - ofst)) + c*np.cos(4*(w*t - ofst)) + d*np.sin(4*(w*t - ofst)))*sig_level + ns + v_bias
 
+    if clip_V > 0:
+        trace = np.clip(trace, -clip_V, clip_V)
+
     if digitize_mV > 0:
         trace = np.around(trace*1000/digitize_mV)*digitize_mV/1000
 
     return trace
 
+
+
+class FrameSimulator:
+    '''Batched version of simulate_polarization_data for many frames on the same time base.
+
+    The sin(2wt), cos(4wt) and sin(4wt) phase tables and the trigger trace are computed once, so a block of
+    frames for F Stokes vectors is a single (F x 4) @ (4 x N) product plus the noise. Noise comes from a seeded
+    np.random.Generator, making long runs reproducible.
+
+    - w, t: sim angular frequency and time domain, shared by every frame
+    - sig_level, ns_level, digitize_mV, v_bias, dphi, ofst: as in simulate_polarization_data
+    - trigger_level, trigger_width: height [V] and angular width [rad] of the once-per-rotation trigger pulse
+    - seed: seed of the noise generator (ignored when rng is given)
+    - clip_V: sim ADC input range, both traces saturate at +/-clip_V (0 disables)
+    - motor: optional MotorModel. Frames are then consecutive blocks of one run of that motor (speed drift, jitter,
+      trigger glitches), and the angle and trigger are simulated per frame instead of taken from the tables.
+    '''
+    def __init__(self, w, t, sig_level = 1, ns_level = 0, digitize_mV = 0, v_bias = 0, dphi = np.pi/2, ofst = 0,
+                 trigger_level = 5, trigger_width = np.pi/12, seed = None, rng = None, clip_V = 0, motor = None):
+        self.t = np.asarray(t, dtype=float)
+        self.sig_level = sig_level
+        self.ns_level = ns_level
+        self.digitize_mV = digitize_mV
+        self.v_bias = v_bias
+        self.ofst = ofst
+        self.clip_V = clip_V
+        self.motor = motor
+        self.rng = np.random.default_rng(seed) if rng is None else rng
+        # Time of the next frame on the motor's clock, frames follow on from each other.
+        self.elapsed = 0.0
+        self.frame_duration = self.t[-1] - self.t[0] + (self.t[1] - self.t[0]) if len(self.t) > 1 else 0.0
+
+        # Rows of the phase table: 1, sin(2(wt-ofst)), cos(4(wt-ofst)), sin(4(wt-ofst)).
+        self.phase_table = _phase_table(w*self.t - ofst)
+
+        # Coefficients [a, b, c, d] of equation (21) are linear in S: coefficients = S @ stokes_to_coeffs.
+        self.stokes_to_coeffs = np.array([[1/2, 0, 0, 0],
+                                          [(1+np.cos(dphi))/4, 0, (1-np.cos(dphi))/4, 0],
+                                          [0, 0, 0, (1-np.cos(dphi))/4],
+                                          [0, -np.sin(dphi)/2, 0, 0]])*sig_level
+
+        self.trigger = trigger_level*(np.mod(w*self.t, 2*np.pi) < trigger_width)
+        self.trigger.flags.writeable = False
+
+    def frames(self, sim_S):
+        '''Returns (input_data, trigger_data), both F x N, for an F x 4 array of Stokes vectors (or one vector, F = 1).
+
+        Without a motor model, trigger_data is a read-only broadcast view of the shared trigger trace.
+        '''
+        sim_S = np.atleast_2d(np.asarray(sim_S, dtype=float))
+        num_frames, num_points = len(sim_S), len(self.t)
+
+        if self.motor is None:
+            trace = (sim_S @ self.stokes_to_coeffs) @ self.phase_table
+            trigger = np.broadcast_to(self.trigger, trace.shape)
+        else:
+            trace = np.zeros((num_frames, num_points))
+            trigger = np.zeros((num_frames, num_points))
+            for k in range(num_frames):
+                theta, trigger[k] = self.motor.simulate(self.t + self.elapsed)
+                trace[k] = (sim_S[k] @ self.stokes_to_coeffs) @ _phase_table(theta - self.ofst)
+                self.elapsed += self.frame_duration
+
+        if self.ns_level:
+            trace += self.ns_level*self.rng.standard_normal((num_frames, num_points))
+        trace += self.v_bias
+
+        if self.clip_V > 0:
+            trace = np.clip(trace, -self.clip_V, self.clip_V)
+            if self.motor is not None:
+                trigger = np.clip(trigger, -self.clip_V, self.clip_V)
+
+        if self.digitize_mV > 0:
+            trace = np.around(trace*1000/self.digitize_mV)*self.digitize_mV/1000
+
+        return trace, trigger
+
+    def stream(self, sim_S, batch_frames = 1024):
+        '''Yields (input_data, trigger_data) blocks of at most batch_frames frames.
+
+        sim_S is an M x 4 array or any iterable of Stokes vectors (e.g. a generator for millions of frames), which is
+        consumed batch by batch so only one block is held in memory.
+        '''
+        vectors = iter(sim_S)
+        while True:
+            batch = list(itertools.islice(vectors, batch_frames))
+            if not batch:
+                return
+            yield self.frames(batch)
+
+
+def _phase_table(wt):
+    '''Rows 1, sin(2wt), cos(4wt), sin(4wt) of the simulated signal (wt already shifted by the trigger offset).'''
+    return np.vstack([np.ones_like(wt), np.sin(2*wt), np.cos(4*wt), np.sin(4*wt)])
+
+
+def simulate_polarization_frames(sim_S, w, t, sig_level = 1, ns_level = 0, digitize_mV = 0, v_bias = 0, dphi = np.pi/2, ofst = 0, seed = None):
+    '''Generates F simulated frames in one call. Returns (input_data, trigger_data), both F x N.
+
+    Same parameters as simulate_polarization_data, with sim_S an F x 4 array of Stokes vectors and seed the seed of
+    the noise generator. To generate further frames on the same time base, use a FrameSimulator directly.
+    '''
+    return FrameSimulator(w, t, sig_level, ns_level, digitize_mV, v_bias, dphi, ofst, seed=seed).frames(sim_S)
+
+
+class MotorModel:
+    '''Rotation angle and Hall trigger of a non-ideal waveplate motor, for simulating realistic acquisitions.
+
+    The rotation period varies slowly (sinusoidal speed drift) and from one rotation to the next (jitter), and the
+    trigger pulse can be noisy, bounce (a spurious second pulse shortly after the real one, i.e. a double trigger)
+    or be missed altogether. Per-rotation periods and glitches are drawn as rotations are reached, and only the
+    rotations around the latest time are kept, so arbitrarily long runs are simulated in constant memory. With
+    every option at 0 the angle is w*t (to rounding) and the trigger a clean pulse once per rotation.
+
+    - w: nominal angular frequency [rad/s]
+    - drift: amplitude of the speed drift, as a fraction of w
+    - drift_period: period of the speed drift [s]
+    - jitter: standard deviation of the rotation period, as a fraction of the nominal period
+    - trigger_level, trigger_width: height [V] and angular width [rad] of the trigger pulse
+    - trigger_noise: standard deviation of the noise on the trigger signal [V]
+    - bounce: probability per rotation of a bounce pulse, starting 1 to 3 trigger widths after the real one
+    - missed: probability per rotation that the trigger pulse is missing
+    - seed: seed of the generator for all random draws (ignored when rng is given)
+    '''
+    def __init__(self, w, drift = 0, drift_period = 60, jitter = 0, trigger_level = 5, trigger_width = np.pi/12,
+                 trigger_noise = 0, bounce = 0, missed = 0, seed = None, rng = None):
+        self.period = 2*np.pi/w
+        self.drift = drift
+        self.drift_period = drift_period
+        self.jitter = jitter
+        self.trigger_level = trigger_level
+        self.trigger_width = trigger_width
+        self.trigger_noise = trigger_noise
+        self.bounce = bounce
+        self.missed = missed
+        self.rng = np.random.default_rng(seed) if rng is None else rng
+
+        # Start time of rotations first_rotation, first_rotation+1, ... and their glitches.
+        self.first_rotation = 0
+        self.starts = np.zeros(1)
+        self.is_missed = np.zeros(1, dtype=bool)
+        self.bounce_at = np.full(1, np.inf)
+        self._draw_rotations(1)
+
+    def simulate(self, t):
+        '''Returns (theta, trigger_data): the rotation angle [rad] and the trigger trace at times t.
+
+        Times must not go back by more than the current rotation between calls.
+        '''
+        t = np.asarray(t, dtype=float)
+        if len(t) == 0:
+            return np.zeros(0), np.zeros(0)
+        if t[0] < self.starts[0]:
+            raise ValueError('MotorModel times must be increasing from one call to the next.')
+
+        while self.starts[-1] <= t[-1]:
+            self._draw_rotations(int((t[-1] - self.starts[-1])/self.period) + 2)
+
+        idx = np.searchsorted(self.starts, t, side='right') - 1
+        fraction = (t - self.starts[idx])/(self.starts[idx+1] - self.starts[idx])
+        rotation = self.first_rotation + idx
+        theta = 2*np.pi*(rotation + fraction)
+
+        phase = 2*np.pi*fraction
+        pulse = (phase < self.trigger_width) & ~self.is_missed[idx]
+        pulse |= (phase >= self.bounce_at[idx]) & (phase < self.bounce_at[idx] + self.trigger_width/3)
+        trigger = self.trigger_level*pulse
+        if self.trigger_noise:
+            trigger = trigger + self.trigger_noise*self.rng.standard_normal(len(t))
+
+        # Forget rotations that ended before this block, keeping the one in progress.
+        self.first_rotation += idx[-1]
+        self.starts = self.starts[idx[-1]:]
+        self.is_missed = self.is_missed[idx[-1]:]
+        self.bounce_at = self.bounce_at[idx[-1]:]
+
+        return theta, trigger
+
+    def _draw_rotations(self, num):
+        '''Appends num rotations with random periods and glitches.'''
+        # Drift is slow, so evaluating it at the nominal start time of each rotation is enough.
+        nominal_starts = self.starts[-1] + self.period*np.arange(num)
+        periods = self.period/(1 + self.drift*np.sin(2*np.pi*nominal_starts/self.drift_period))
+        if self.jitter:
+            periods *= np.maximum(1 + self.jitter*self.rng.standard_normal(num), 0.1)
+        self.starts = np.r_[self.starts, self.starts[-1] + np.cumsum(periods)]
+
+        is_missed = self.rng.random(num) < self.missed if self.missed else np.zeros(num, dtype=bool)
+        bounce_at = np.full(num, np.inf)
+        if self.bounce:
+            bounced = self.rng.random(num) < self.bounce
+            bounce_at[bounced] = self.trigger_width*(1 + 2*self.rng.random(np.count_nonzero(bounced)))
+        # Glitches belong to the rotation that starts at starts[k]; the last start has none drawn yet.
+        self.is_missed = np.r_[self.is_missed, is_missed][:len(self.starts)]
+        self.bounce_at = np.r_[self.bounce_at, bounce_at][:len(self.starts)]
@@ -0,0 +1,28 @@
+"""
+Shared fixtures. The scripts live in code/ and read their settings from ./settings, so tests import them from the
+parent directory and run in a temporary directory holding default settings (simulated backend).
+"""
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import swpsettings
+
+DAQ_SETTINGS = {'samples_per_channel': 1000, 'scan_rate': 20000, 'channels': [0, 2], 'timeout': 5, 'backend': 'sim'}
+SWP_SETTINGS = {'trigger_phase': 0.404, 'wp_phi': 1.982, 'bg_level': 0.003, 'log_data_file': ''}
+SIM_SETTINGS = {'sim_digitize': 1000*20/(2**12), 'sim_siglevel': 1, 'sim_ns_level': 0.03, 'sim_DOP': 0.7,
+                'sim_bg_level': 0.003, 'sim_wp_phi': 1.982, 'sim_trigger_phase': 0.404, 'sim_poltype': 'right'}
+
+
+@pytest.fixture
+def settings_dir(tmp_path, monkeypatch):
+    '''Temporary working directory with settings/ and data/ as gen_default_json.py would create them (sim backend).'''
+    monkeypatch.chdir(tmp_path)
+    os.mkdir('settings')
+    os.mkdir('data')
+    swpsettings.save('daq', DAQ_SETTINGS)
+    swpsettings.save('swp', SWP_SETTINGS)
+    swpsettings.save('sim', SIM_SETTINGS)
+    return tmp_path
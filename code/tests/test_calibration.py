@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+import swpsettings
+import swptools as swp
+
+TRUE_PHASE = 0.404
+WP_PHI = 1.982
+S_TRUE = np.array([1, 0.3, 0.5, 0.6])
+
+
+@pytest.fixture(scope='module')
+def traces():
+    '''Noiseless traces at about 235 points per rotation, rotation period not a whole number of samples.'''
+    t = np.arange(4000)/20000
+    simulator = swp.FrameSimulator(2*np.pi*5100/60, t, dphi=WP_PHI, ofst=TRUE_PHASE, seed=1)
+    return simulator.frames(np.tile(S_TRUE, (5, 1)))
+
+
+def stokes_error(traces, phase, subsample):
+    input_data, trigger_data = traces
+    borders = swp.extract_chunks(trigger_data[0], subsample=subsample)
+    S = swp.get_stokes_from_chunks(input_data[0], borders, WP_PHI, phase, verbose=False)[0].mean(axis=0)
+    return np.max(np.abs(S - S_TRUE))
+
+
+@pytest.mark.parametrize('subsample', [False, True])
+def test_trigger_phase_only_holds_for_its_edge_mode(traces, subsample):
+    phase = swp.calibrate_trigger_phase(zip(*traces), subsample=subsample)[0]
+    assert stokes_error(traces, phase, subsample) < 0.01
+    assert stokes_error(traces, phase, not subsample) > 0.03
+
+
+def test_fractional_edges_recover_the_true_phase(traces):
+    phase = swp.calibrate_trigger_phase(zip(*traces), subsample=True)[0]
+    assert phase == pytest.approx(TRUE_PHASE, abs=2e-3)
+
+
+def test_files_without_edge_mode_are_integer_calibrations(settings_dir):
+    assert swpsettings.load('swp')['subsample_edges'] is False
+
+
+def test_polvis_uses_the_stored_edge_mode(settings_dir, monkeypatch, capsys):
+    import polvis
+    monkeypatch.setattr(polvis, 'run_offline', True)
+    monkeypatch.setattr(polvis, 'use_pipeline', False)
+    polvis.setup()
+    assert polvis.fractional_edges is False
+
+    params = swpsettings.load('swp')
+    params['subsample_edges'] = True
+    swpsettings.save('swp', params)
+    polvis.load_calibration()
+    assert polvis.fractional_edges is True
+    assert 'Warning' not in capsys.readouterr().out
+
+    monkeypatch.setattr(polvis, 'subsample_triggers', False)
+    polvis.load_calibration()
+    assert polvis.fractional_edges is False
+    assert 'recalibrate' in capsys.readouterr().out
+    polvis.shutdown()
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+matplotlib = pytest.importorskip('matplotlib')
+matplotlib.use('Agg')
+
+import polvis
+
+
+@pytest.fixture
+def offline_polvis(settings_dir, monkeypatch):
+    '''polvis set up for offline frames computed in the calling thread.'''
+    monkeypatch.setattr(polvis, 'run_offline', True)
+    monkeypatch.setattr(polvis, 'use_pipeline', False)
+    monkeypatch.setattr(polvis, 'do_save', False)
+    yield polvis
+    polvis.shutdown()
+    from matplotlib import pyplot as plt
+    plt.close('all')
+
+
+@pytest.mark.parametrize('blit', [True, False])
+def test_trace_view_shows_the_whole_block(offline_polvis, monkeypatch, blit):
+    monkeypatch.setattr(polvis, 'poincare', False)
+    monkeypatch.setattr(polvis, 'blit', blit)
+    polvis.setup()
+    polvis.setup_figure()
+    polvis.init_animation()
+    polvis.fig.canvas.draw()
+    polvis.animate_fun(0)
+    polvis.fig.canvas.draw()
+
+    x = polvis.ln3.get_xdata()
+    assert polvis.ax3.bbox.width > 100
+    assert tuple(polvis.ax3.get_xlim()) == (0, polvis.num_samples)
+    assert len(x) > 100 and x[0] == 0 and x[-1] >= 0.99*(polvis.num_samples - 1)
+
+
+def test_blitted_frame_matches_full_redraw(offline_polvis, monkeypatch):
+    monkeypatch.setattr(polvis, 'poincare', True)
+    monkeypatch.setattr(polvis, 'blit', True)
+    polvis.setup()
+    polvis.setup_figure()
+    polvis.init_animation()
+    polvis.renderer = polvis.BlitRenderer(polvis.fig, polvis.animated_artists())
+    polvis.blit_idx = 0
+    polvis.fig.canvas.draw()
+    for _ in range(3):
+        polvis.blit_step()
+    blitted = np.asarray(polvis.fig.canvas.buffer_rgba()).copy()
+
+    # Full redraw of the same state, without the blitter drawing the artists a second time.
+    polvis.renderer._draw_artists = lambda: None
+    for artist in polvis.animated_artists():
+        artist.set_animated(False)
+    polvis.fig.canvas.draw()
+    full = np.asarray(polvis.fig.canvas.buffer_rgba())
+
+    # Only antialiased edges where moving artists cross axis spines may differ (they are drawn over them).
+    assert np.mean(np.any(blitted != full, axis=2)) < 0.002
+
+
+def test_decimate_trace_keeps_the_envelope():
+    data = np.sin(np.linspace(0, 20*np.pi, 100000))
+    data[12345] = 5
+    x, y = polvis.decimate_trace(data, 500)
+    assert len(x) <= 500
+    assert y.max() == 5 and np.isclose(y.min(), -1, atol=1e-3)
@@ -0,0 +1,33 @@
+import numpy as np
+
+from swpjitter import AllanDeviation, JitterAnalyzer
+
+
+def test_allan_deviation_of_a_steady_stream_is_zero_across_a_reset():
+    allan = AllanDeviation(octaves=3)
+    allan.update(np.ones(9))
+    allan.reset()
+    allan.update(2*np.ones(9))
+    factors, adev = allan.deviation()
+    assert np.array_equal(factors, [1, 2, 4]) and np.all(adev == 0)
+    # Differences within each run only: 8 + 8 at factor 1.
+    assert allan.num_diffs[0] == 16
+
+
+def trigger(periods_samples, length):
+    '''Trigger trace with a 5 V pulse every periods_samples samples.'''
+    trace = np.zeros(length)
+    trace[np.arange(5, length, periods_samples)[:, None] + np.arange(10)] = 5
+    return trace
+
+
+def test_overrun_does_not_join_periods_or_allan_averages():
+    analyzer = JitterAnalyzer(1000)
+    analyzer.feed(trigger(100, 2000))
+    analyzer.discontinuity()
+    analyzer.feed(trigger(150, 3000))
+
+    assert analyzer.periods.count == 19 + 19
+    assert analyzer.periods.min == 0.1 and analyzer.periods.max == 0.15
+    factors, adev = analyzer.allan.deviation()
+    assert np.all(adev == 0)
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+import swplog
+
+
+def records(n, start = 0):
+    out = np.zeros(n, dtype=swplog.RECORD_DTYPE)
+    out['timestamp'] = np.arange(start, start + n)
+    out['S0'] = 1
+    out['DOP'] = 0.5
+    return out
+
+
+def test_log_many_is_buffered_like_log(tmp_path):
+    path = str(tmp_path/'log.npy')
+    logger = swplog.StokesLogger(path, buffer_records=100, flush_interval=3600)
+    for k in range(9):
+        logger.log_many(records(10, 10*k))
+    logger.log(90, [1, 0, 0, 0], 0.5)
+    assert logger.count == 0 and len(swplog.read_log(path)) == 0
+
+    # Filling the buffer writes it, and a batch larger than the buffer is written buffer by buffer.
+    logger.log_many(records(259, 91))
+    assert logger.count == 300 and logger.buffered == 50
+    logger.close()
+
+    log = swplog.read_log(path)
+    assert np.array_equal(log['timestamp'], np.arange(350))
+    assert np.array_equal(np.load(path)['timestamp'], np.arange(350))
+
+
+def test_log_many_flushes_after_the_interval(tmp_path):
+    path = str(tmp_path/'log.npy')
+    with swplog.StokesLogger(path, buffer_records=100, flush_interval=0) as logger:
+        logger.log_many(records(3))
+        assert logger.count == 3 and logger.buffered == 0
+
+
+def test_reopened_log_is_appended_to(tmp_path):
+    path = str(tmp_path/'log.npy')
+    with swplog.StokesLogger(path) as logger:
+        logger.log_many(records(5))
+    with swplog.StokesLogger(path) as logger:
+        assert logger.count == 5
+        logger.log_many(records(7, 5))
+    assert np.array_equal(np.load(path)['timestamp'], np.arange(12))
+
+
+def test_records_past_a_stale_header_are_kept(tmp_path):
+    path = str(tmp_path/'log.npy')
+    with swplog.StokesLogger(path) as logger:
+        logger.log_many(records(4))
+    # A crash between writing records and updating the header, with a partial record at the end.
+    with open(path, 'ab') as f:
+        f.write(records(2, 4).tobytes() + b'\x00'*5)
+    assert len(swplog.read_log(path)) == 6
+
+    with swplog.StokesLogger(path) as logger:
+        assert logger.count == 6
+        logger.log_many(records(1, 6))
+    assert np.array_equal(np.load(path)['timestamp'], np.arange(7))
+
+
+def test_log_with_other_records_is_not_appended_to(tmp_path):
+    path = str(tmp_path/'log.npy')
+    swplog.StokesLogger(path).close()
+    with pytest.raises(ValueError):
+        swplog.StokesLogger(path, dtype=[('timestamp', '<f8')])
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+import polvis
+import swpsettings
+import swptools as swp
+from daqbackend import polarimeters_from_settings
+from swpmulti import process_rotations
+
+
+@pytest.mark.parametrize('num_samples', [1000, 300])
+def test_process_rotations_matches_polvis(settings_dir, monkeypatch, num_samples):
+    for flag, value in {'run_offline': True, 'use_pipeline': False, 'per_rotation_output': True, 'engine': 'chunked'}.items():
+        monkeypatch.setattr(polvis, flag, value)
+    polvis.setup()
+    # Live checks (signal voltage range), without a stream reader.
+    monkeypatch.setattr(polvis, 'run_offline', False)
+    monkeypatch.setattr(polvis, 'stream_acquisition', False)
+
+    raw_data, trigger_data = (x[0, :num_samples] for x in polvis.simulator.frames([3, 0.5, 0.8, 1.2]))
+    frame = polvis.process_frame(swp.remove_background(raw_data, polvis.bg_level), trigger_data, 0)
+    polarimeter, = polarimeters_from_settings(swpsettings.load('daq'))
+    records, S, warnings = process_rotations(polarimeter, raw_data, trigger_data, 0, polvis.scan_rate)
+    polvis.shutdown()
+
+    assert np.array_equal(records, frame['rotations'])
+    assert np.allclose(S, frame['S'], equal_nan=True)
+    assert frame['warnings'] == 'warnings: ' + ''.join(w + '    ' for w in warnings)
+    assert ('Insufficient chunks' in warnings) == (num_samples < 1000)
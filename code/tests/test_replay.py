@@ -0,0 +1,51 @@
+import glob
+import numpy as np
+import pytest
+
+import polvis
+import swprecord
+import swptools as swp
+
+
+@pytest.mark.parametrize('run_offline, stream_acquisition', [(True, False), (False, False), (False, True)])
+def test_replay_matches_live_rotations(settings_dir, monkeypatch, run_offline, stream_acquisition):
+    for flag, value in {'run_offline': run_offline, 'stream_acquisition': stream_acquisition, 'use_pipeline': False,
+                        'record_raw': True, 'per_rotation_output': True, 'engine': 'chunked', 'do_save': False}.items():
+        monkeypatch.setattr(polvis, flag, value)
+    polvis.setup()
+    try:
+        live = []
+        for idx in range(4):
+            input_data, trigger_data, _, block_time = polvis.fetch_input_data(idx)
+            live.append(polvis.process_frame(input_data, trigger_data, block_time)['rotations']['S1'])
+    finally:
+        polvis.shutdown()
+    live = np.concatenate(live)
+
+    path, = glob.glob('data/*.swpraw')
+    replay = swprecord.RawReplay(path)
+    assert replay.samples == 'raw'
+    replayed = np.concatenate([S[:, 1]/S[:, 0] for _, S in swprecord.replay_stokes(replay)])
+    # Streaming frames end at the last complete rotation, so the replay may have a rotation more at the end.
+    assert len(live) > 10 and len(replayed) - len(live) in (0, 1)
+    assert np.allclose(replayed[:len(live)], live, atol=1e-9)
+
+
+def test_background_is_removed_once(tmp_path):
+    t = np.arange(20000)/20000
+    simulator = swp.FrameSimulator(2*np.pi*85, t, v_bias=0.5, dphi=1.982, ofst=0.404)
+    S_true = np.array([1, 0.3, 0.5, 0.6])
+    input_data, trigger_data = (x[0] for x in simulator.frames(S_true))
+    calibration = {'trigger_phase': 0.404, 'wp_phi': 1.982, 'bg_level': 0.5, 'subsample': True}
+
+    def replayed(name, samples, photodiode):
+        path = str(tmp_path/name)
+        with swprecord.RawRecorder(path, 20000, [0, 2], calibration, samples=samples) as recorder:
+            recorder.write(np.c_[photodiode, trigger_data])
+        S = np.concatenate([S for _, S in swprecord.replay_stokes(swprecord.RawReplay(path))]).mean(axis=0)
+        return S/S[0]
+
+    assert np.allclose(replayed('raw.swpraw', 'raw', input_data), S_true, atol=1e-3)
+    assert np.allclose(replayed('processed.swpraw', 'processed', input_data - 0.5), S_true, atol=1e-3)
+    with pytest.raises(ValueError):
+        swprecord.RawRecorder(str(tmp_path/'x.swpraw'), 20000, [0, 2], calibration, samples='filtered')
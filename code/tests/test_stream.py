@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+import swpsettings
+import swptools as swp
+from daqbackend import open_polarimeter
+from swpstream import RingBuffer, StreamReader
+
+
+def samples(start, stop):
+    '''Two-channel block whose values are the absolute sample indices.'''
+    index = np.arange(start, stop, dtype=float)
+    return np.c_[index, -index]
+
+
+def test_ring_buffer_keeps_absolute_indices_when_a_block_overflows():
+    ring = RingBuffer(10, 2)
+    ring.write(samples(0, 7))
+    ring.write(samples(7, 32))
+    assert ring.total_written == 32 and ring.oldest() == 22
+
+    block, start = ring.read(0, 32)
+    assert start == 22 and np.array_equal(block, samples(22, 32))
+    ring.write(samples(32, 35))
+    assert np.array_equal(ring.read(25, 35)[0], samples(25, 35))
+    assert np.array_equal(ring.latest(4), samples(31, 35))
+
+
+def test_ring_buffer_does_not_read_across_a_discontinuity():
+    ring = RingBuffer(10, 2)
+    ring.write(samples(0, 4))
+    ring.mark_discontinuity()
+    ring.write(samples(4, 8))
+    block, start = ring.read(0, 8)
+    assert start == 4 and np.array_equal(block, samples(4, 8))
+
+
+@pytest.fixture
+def reader(settings_dir):
+    '''StreamReader (not started) whose ring buffer holds 20000 samples of simulated photodiode and trigger traces.'''
+    backend = open_polarimeter(swpsettings.load('daq'))[0]
+    reader = StreamReader(backend, 20000, buffer_seconds=2)
+    t = np.arange(20000)/20000
+    input_data, trigger_data = swp.FrameSimulator(2*np.pi*85.3, t, ofst=0.404).frames([1, 0.3, 0.5, 0.6])
+    # Slow trigger rise, so fractional edges lie well away from the integer ones.
+    trigger_data = np.convolve(trigger_data[0], np.ones(3)/3)[:len(t)]
+    reader.ring.write(np.c_[input_data[0], trigger_data])
+    return reader
+
+
+def test_latest_rotations_with_fractional_edges(reader):
+    trigger = reader.ring.latest(20000)[:, 1]
+    integer_edges = swp.extract_chunks(trigger)
+    edges = swp.extract_chunks(trigger, subsample=True)
+    assert np.any(edges % 1)
+
+    block = reader.latest_rotations(5, 1, subsample=True)
+    start, stop = int(edges[-6]), int(edges[-1]) + 2
+    assert start > integer_edges[-6]
+    assert np.array_equal(block, reader.ring.latest(20000)[start:stop])
+    assert np.allclose(swp.extract_chunks(block[:, 1], subsample=True), edges[-6:] - start)
+
+
+def test_read_rotations_with_fractional_edges(reader):
+    trigger = reader.ring.latest(20000)[:, 1]
+    edges = swp.extract_chunks(trigger, subsample=True)
+
+    block, cursor = reader.read_rotations(0, 1, subsample=True)
+    first = cursor + 2 - len(block)
+    found = swp.extract_chunks(block[:, 1], subsample=True) + first
+    assert np.allclose(found, edges)
+    assert reader.read_rotations(cursor, 1, subsample=True)[0] is None